@@ -0,0 +1,204 @@
+import hashlib
+
+from flask import Blueprint, Response, abort, jsonify, request
+from flask_login import current_user
+
+from models import Livro
+from repositorio import (
+    LIMITE_SUGESTOES,
+    MAX_LOTE_CIRCULACAO,
+    buscar_nas_unidades,
+    buscar_por_id,
+    buscar_por_titulo,
+    devolver_lote,
+    emprestar_lote,
+    ler_painel,
+    ler_versao,
+    listar_atrasados,
+    listar_livros_do_usuario,
+    listar_livros_pagina,
+    sugerir_usuarios,
+)
+
+api_bp = Blueprint("api", __name__, url_prefix="/api/v1")
+
+LIMITE_MAXIMO = 100
+MIN_CARACTERES_SUGESTAO = 2
+CAMPOS_PUBLICOS = ("id", "titulo", "autor", "ano", "disponivel")
+CAMPOS_ADMIN = Livro.__slots__
+
+
+@api_bp.before_request
+def exigir_login():
+    if not current_user.is_authenticated:
+        return jsonify(erro="Autenticacao necessaria."), 401
+
+
+@api_bp.errorhandler(400)
+@api_bp.errorhandler(403)
+@api_bp.errorhandler(404)
+def erro_json(erro):
+    return jsonify(erro=erro.description), erro.code
+
+
+def _campos_permitidos():
+    return CAMPOS_ADMIN if current_user.tipo == "admin" else CAMPOS_PUBLICOS
+
+
+def _campos_pedidos(permitidos):
+    pedido = request.args.get("campos", "").strip()
+    if not pedido:
+        return permitidos
+
+    campos = tuple(campo.strip() for campo in pedido.split(",") if campo.strip())
+    invalidos = [campo for campo in campos if campo not in permitidos]
+    if invalidos:
+        abort(400, description=f"Campos invalidos: {', '.join(invalidos)}.")
+    return campos
+
+
+def _serializar(livro, campos):
+    return {campo: getattr(livro, campo) for campo in campos}
+
+
+def _responder(gerar_corpo):
+    # A ETag combina a versao do catalogo (mantida por triggers) com a URL e
+    # o perfil de quem pergunta. Se o cliente ja tem essa versao, responde 304
+    # sem executar a consulta da listagem.
+    versao = ler_versao("catalogo")
+    chave = f"{versao}|{current_user.id}|{current_user.tipo}|{request.full_path}"
+    etag = hashlib.sha1(chave.encode()).hexdigest()
+
+    if request.if_none_match.contains(etag):
+        resposta = Response(status=304)
+    else:
+        resposta = jsonify(gerar_corpo())
+    resposta.set_etag(etag)
+    resposta.headers["Cache-Control"] = "private, no-cache"
+    return resposta
+
+
+@api_bp.route("/livros")
+def livros():
+    campos = _campos_pedidos(_campos_permitidos())
+    termo = request.args.get("q", "").strip()
+    apos = request.args.get("apos", type=int)
+    limite = max(1, min(request.args.get("limite", 25, type=int), LIMITE_MAXIMO))
+
+    def corpo():
+        if termo:
+            encontrados = buscar_por_titulo(termo, limite=limite)
+            return {"dados": [_serializar(livro, campos) for livro in encontrados], "proximo": None}
+
+        pagina = listar_livros_pagina(apos=apos, limite=limite)
+        return {
+            "dados": [_serializar(livro, campos) for livro in pagina["livros"]],
+            "proximo": pagina["proximo"],
+        }
+
+    return _responder(corpo)
+
+
+@api_bp.route("/unidades/livros")
+def livros_nas_unidades():
+    # Sem ETag: o resultado depende da versao do catalogo de cada unidade.
+    campos = _campos_pedidos(_campos_permitidos())
+    termo = request.args.get("q", "").strip()
+    if not termo:
+        abort(400, description="Informe o termo de busca em q.")
+    limite = max(1, min(request.args.get("limite", 25, type=int), LIMITE_MAXIMO))
+
+    encontrados = buscar_nas_unidades(termo, limite=limite)
+    return jsonify(dados=[{"unidade": unidade, **_serializar(livro, campos)} for unidade, livro in encontrados])
+
+
+@api_bp.route("/livros/<int:id_livro>")
+def livro(id_livro):
+    campos = _campos_pedidos(_campos_permitidos())
+
+    def corpo():
+        encontrado = buscar_por_id(id_livro)
+        if encontrado is None:
+            abort(404, description="Livro nao encontrado.")
+        return _serializar(encontrado, campos)
+
+    return _responder(corpo)
+
+
+@api_bp.route("/meus-livros")
+def meus_livros():
+    # O proprio usuario ve a data de devolucao dos seus emprestimos.
+    campos = _campos_pedidos(CAMPOS_PUBLICOS + ("data_devolucao",))
+
+    def corpo():
+        encontrados = listar_livros_do_usuario(current_user.id)
+        return {"dados": [_serializar(livro, campos) for livro in encontrados]}
+
+    return _responder(corpo)
+
+
+@api_bp.route("/atrasados")
+def atrasados():
+    if current_user.tipo != "admin":
+        abort(403, description="Apenas admin pode ver emprestimos atrasados.")
+
+    apos_data = request.args.get("apos_data", "")
+    apos_id = request.args.get("apos_id", type=int)
+    apos = (apos_data, apos_id) if apos_data and apos_id else None
+    limite = max(1, min(request.args.get("limite", 25, type=int), LIMITE_MAXIMO))
+
+    # Sem ETag: o resultado muda com a data, nao so com a versao do catalogo.
+    pagina = listar_atrasados(apos=apos, limite=limite)
+    proximo = dict(zip(("apos_data", "apos_id"), pagina["proximo"])) if pagina["proximo"] else None
+    return jsonify(dados=pagina["atrasados"], proximo=proximo)
+
+
+@api_bp.route("/estatisticas")
+def estatisticas():
+    if current_user.tipo != "admin":
+        abort(403, description="Apenas admin pode ver as estatisticas.")
+
+    return jsonify(ler_painel())
+
+
+@api_bp.route("/emprestimos/lote", methods=["POST"])
+def emprestimos_lote():
+    # {"acao": "emprestar" | "devolver", "livros": [ids], "usuario_id": id}
+    # com o token CSRF no cabecalho X-CSRFToken.
+    if current_user.tipo != "admin":
+        abort(403, description="Apenas admin pode registrar emprestimos.")
+
+    dados = request.get_json(silent=True) or {}
+    livros = dados.get("livros")
+    if not isinstance(livros, list) or not livros or not all(isinstance(id_livro, int) for id_livro in livros):
+        abort(400, description="Informe a lista de ids em livros.")
+    if len(livros) > MAX_LOTE_CIRCULACAO:
+        abort(400, description=f"No maximo {MAX_LOTE_CIRCULACAO} livros por lote.")
+
+    acao = dados.get("acao")
+    if acao == "emprestar":
+        usuario_id = dados.get("usuario_id")
+        if not isinstance(usuario_id, int):
+            abort(400, description="Informe usuario_id.")
+        resultados = emprestar_lote(livros, usuario_id)
+    elif acao == "devolver":
+        resultados = devolver_lote(livros)
+    else:
+        abort(400, description="Acao invalida.")
+
+    return jsonify(resultados=[{"id": id_livro, "resultado": resultado} for id_livro, resultado in resultados])
+
+
+@api_bp.route("/usuarios/sugestoes")
+def sugestoes_usuarios():
+    # Chamado a cada tecla (com debounce) pelo formulario de emprestimo.
+    if current_user.tipo != "admin":
+        abort(403, description="Apenas admin pode buscar usuarios.")
+
+    termo = request.args.get("q", "").strip()
+    limite = max(1, min(request.args.get("limite", LIMITE_SUGESTOES, type=int), LIMITE_SUGESTOES))
+    dados = sugerir_usuarios(termo, limite=limite) if len(termo) >= MIN_CARACTERES_SUGESTAO else []
+
+    resposta = jsonify(dados=dados)
+    resposta.headers["Cache-Control"] = "private, max-age=30"
+    return resposta
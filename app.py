@@ -1,9 +1,10 @@
+import io
 import os
+import re
 import secrets
-import sqlite3
-from datetime import datetime, timedelta
+from datetime import date
 
-from flask import Flask, abort, flash, redirect, render_template, request, session, url_for
+from flask import Blueprint, Flask, Response, abort, flash, redirect, render_template, request, session, url_for
 from flask_login import (
     LoginManager,
     UserMixin,
@@ -12,36 +13,68 @@ from flask_login import (
     login_user,
     logout_user,
 )
-from werkzeug.security import check_password_hash, generate_password_hash
-
-from database import conectar, criar_tabelas
-from models import Livro
-from services import adicionar_livro, atualizar_livro, buscar_por_titulo, listar_livros, remover_livro
-
-app = Flask(__name__)
-app.secret_key = os.getenv("SECRET_KEY", "dev-insecure-change-me")
-
-criar_tabelas()
-
-def _criar_admin_padrao():
-    conn = conectar()
-    cursor = conn.cursor()
-    cursor.execute("SELECT COUNT(*) AS total FROM usuarios")
-    total = cursor.fetchone()["total"]
-    if total == 0:
-        senha_hash = generate_password_hash("admin")
-        cursor.execute(
-            "INSERT INTO usuarios (nome, email, senha, tipo) VALUES (?, ?, ?, ?)",
-            ("Admin", "admin@admin.com", senha_hash, "admin"),
-        )
-        conn.commit()
-    conn.close()
+from markupsafe import Markup, escape
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+from api import api_bp
+from backup import init_app as init_backup
+from cache import CacheLRU, GrupoCaches
+from comandos import criar_admin_padrao, registrar_comandos
+from database import (
+    UNIDADES,
+    VERSAO_SCHEMA,
+    criar_tabela_limites,
+    criar_tabelas_unidades,
+    init_app as init_db,
+    unidade_atual,
+    usando_unidade,
+    versao_schema_arquivo,
+)
+from exportacao import CONSULTAS, FORMATOS as FORMATOS_EXPORTACAO, comprimir, gerar as gerar_exportacao
+from importacao import formato_por_nome, importar_livros, ler_linhas
+from limites import LimiteExcedido, verificar_tentativa
+from metricas import init_app as init_metricas
+from models import CONFLITO, NAO_ENCONTRADO, OK, SEM_ALTERACAO, ULTIMO_ADMIN, EmailDuplicado, Livro
+from repositorio import (
+    BACKEND,
+    MAX_LOTE_CIRCULACAO,
+    adicionar_livro,
+    alterar_tipo_usuario,
+    atualizar_livro,
+    atualizar_senha,
+    buscar_por_id,
+    buscar_por_ids,
+    buscar_por_titulo,
+    buscar_usuario,
+    buscar_usuario_por_email,
+    contar_usuarios,
+    criar_tabelas,
+    criar_usuario,
+    devolver_livro,
+    devolver_lote,
+    emprestar_livro,
+    emprestar_lote,
+    ler_painel,
+    ler_versao,
+    listar_atrasados,
+    listar_livros_do_usuario,
+    listar_livros_pagina,
+    listar_usuarios_pagina,
+    remover_livro,
+    total_usuarios,
+)
+from senhas import HashOcupado, eh_hash, gerar_hash, precisa_atualizar, verificar_hash
 
-_criar_admin_padrao()
+bp = Blueprint("biblioteca", __name__)
 
 login_manager = LoginManager()
-login_manager.init_app(app)
-login_manager.login_view = "login"
+login_manager.login_view = "biblioteca.login"
+
+# Quantos proxies reversos (o da Render, por exemplo) ficam na frente do app.
+# Com 0, X-Forwarded-For e ignorado; acima disso, o ProxyFix confia nesse
+# numero de saltos e request.remote_addr passa a ser o IP do cliente, que e
+# a chave do limitador de tentativas.
+PROXIES_CONFIAVEIS = int(os.getenv("PROXIES_CONFIAVEIS", "0"))
 
 
 class Usuario(UserMixin):
@@ -52,55 +85,58 @@ class Usuario(UserMixin):
         self.tipo = tipo
 
 
-@login_manager.user_loader
-def load_user(user_id):
-    conn = conectar()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM usuarios WHERE id = ?", (user_id,))
-    user = cursor.fetchone()
-    conn.close()
-
-    if user:
-        return Usuario(user["id"], user["nome"], user["email"], user["tipo"])
-    return None
+# Cache dos usuarios carregados pelo Flask-Login. As rotas que alteram um
+# usuario o invalidam neste processo; com USUARIO_CACHE_VERSAO=1 o worker
+# tambem confere o contador "usuarios" do banco, mantido por triggers, no
+# maximo a cada USUARIO_CACHE_VERSAO_INTERVALO segundos, para enxergar
+# alteracoes feitas por outros workers sem uma consulta por request.
+# Cada unidade tem o proprio cache, ja que ids e versoes se repetem entre
+# os bancos.
+usuarios_cache = GrupoCaches(lambda: CacheLRU(
+    tamanho_max=int(os.getenv("USUARIO_CACHE_TAMANHO", "1024")),
+    ttl=float(os.getenv("USUARIO_CACHE_TTL", "60")),
+))
+USUARIO_CACHE_VERSAO = os.getenv("USUARIO_CACHE_VERSAO", "1") == "1"
+USUARIO_CACHE_VERSAO_INTERVALO = float(os.getenv("USUARIO_CACHE_VERSAO_INTERVALO", "5"))
 
 
-def _migrar_senhas_legadas():
-    conn = conectar()
-    cursor = conn.cursor()
-    cursor.execute("SELECT id, senha FROM usuarios")
-    usuarios = cursor.fetchall()
+def _invalidar_usuario(user_id):
+    usuarios_cache.de(unidade_atual()).invalidar(str(user_id))
 
-    atualizados = []
-    for usuario in usuarios:
-        senha = usuario["senha"]
-        if not senha.startswith(("pbkdf2:", "scrypt:")):
-            atualizados.append((generate_password_hash(senha), usuario["id"]))
 
-    if atualizados:
-        cursor.executemany("UPDATE usuarios SET senha = ? WHERE id = ?", atualizados)
-        conn.commit()
+# Fragmentos HTML da tabela do acervo, por (busca, pagina). O cache e
+# descartado sempre que a versao do catalogo muda. O token CSRF varia por
+# sessao, entao o fragmento guarda um marcador trocado a cada request.
+acervo_cache = GrupoCaches(lambda: CacheLRU(
+    tamanho_max=int(os.getenv("ACERVO_CACHE_ITENS", "256")),
+    bytes_max=int(os.getenv("ACERVO_CACHE_BYTES", str(8 * 1024 * 1024))),
+))
+_MARCADOR_CSRF = "__csrf_token_acervo__"
 
-    conn.close()
+# Total exibido na pagina de usuarios, por termo de busca. O COUNT percorre
+# a tabela inteira, entao o valor e reaproveitado por alguns segundos.
+usuarios_contagem_cache = GrupoCaches(lambda: CacheLRU(
+    tamanho_max=256,
+    ttl=float(os.getenv("USUARIOS_CONTAGEM_TTL", "60")),
+))
 
 
-_migrar_senhas_legadas()
+@login_manager.user_loader
+def load_user(user_id):
+    cache = usuarios_cache.de(unidade_atual())
+    if USUARIO_CACHE_VERSAO and cache.versao_vencida(USUARIO_CACHE_VERSAO_INTERVALO):
+        cache.sincronizar_versao(ler_versao("usuarios"))
 
+    usuario = cache.obter(str(user_id))
+    if usuario is not None:
+        return usuario
 
-def _listar_livros_do_usuario(usuario_id):
-    conn = conectar()
-    cursor = conn.cursor()
-    cursor.execute(
-        """
-        SELECT * FROM livros
-        WHERE usuario_id = ?
-        AND disponivel = 0
-        """,
-        (usuario_id,),
-    )
-    livros = cursor.fetchall()
-    conn.close()
-    return livros
+    user = buscar_usuario(user_id)
+    if user:
+        usuario = Usuario(user["id"], user["nome"], user["email"], user["tipo"])
+        cache.guardar(str(user_id), usuario)
+        return usuario
+    return None
 
 
 def _csrf_token():
@@ -109,12 +145,21 @@ def _csrf_token():
     return session["csrf_token"]
 
 
-@app.context_processor
+@bp.app_template_filter("data_br")
+def data_br(valor):
+    # Datas sao gravadas em ISO (aaaa-mm-dd); na tela ficam dd/mm/aaaa.
+    try:
+        return date.fromisoformat(str(valor)[:10]).strftime("%d/%m/%Y")
+    except ValueError:
+        return valor
+
+
+@bp.app_context_processor
 def inject_csrf_token():
     return {"csrf_token": _csrf_token()}
 
 
-@app.before_request
+@bp.before_app_request
 def validate_csrf():
     _csrf_token()
     if request.method in {"POST", "PUT", "PATCH", "DELETE"}:
@@ -123,289 +168,259 @@ def validate_csrf():
             abort(400, description="CSRF token invalido.")
 
 
-@app.route("/login", methods=["GET", "POST"])
+@bp.app_errorhandler(HashOcupado)
+def hash_ocupado(erro):
+    return "Servidor ocupado, tente novamente em instantes.", 503, {"Retry-After": "1"}
+
+
+@bp.app_errorhandler(LimiteExcedido)
+def limite_excedido(erro):
+    return "Muitas tentativas, aguarde antes de tentar novamente.", 429, {"Retry-After": str(erro.espera)}
+
+
+@bp.route("/login", methods=["GET", "POST"])
 def login():
     if request.method == "POST":
         email = request.form["email"].strip().lower()
         senha = request.form["senha"]
+        verificar_tentativa(request.remote_addr, email)
 
-        conn = conectar()
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM usuarios WHERE email = ?", (email,))
-        user = cursor.fetchone()
+        user = buscar_usuario_por_email(email)
 
         if not user:
-            conn.close()
             flash("Email ou senha invalidos.", "danger")
             return render_template("login.html")
 
         senha_armazenada = user["senha"]
-        senha_valida = False
 
-        if senha_armazenada.startswith(("pbkdf2:", "scrypt:")):
-            senha_valida = check_password_hash(senha_armazenada, senha)
+        if eh_hash(senha_armazenada):
+            senha_valida = verificar_hash(senha_armazenada, senha)
         else:
             senha_valida = secrets.compare_digest(senha_armazenada, senha)
-            if senha_valida:
-                nova_hash = generate_password_hash(senha)
-                cursor.execute("UPDATE usuarios SET senha = ? WHERE id = ?", (nova_hash, user["id"]))
-                conn.commit()
 
-        conn.close()
+        # Senhas legadas em texto puro ou com custo diferente do configurado
+        # sao regravadas no primeiro login bem-sucedido.
+        if senha_valida and (not eh_hash(senha_armazenada) or precisa_atualizar(senha_armazenada)):
+            atualizar_senha(user["id"], gerar_hash(senha))
 
         if senha_valida:
             usuario = Usuario(user["id"], user["nome"], user["email"], user["tipo"])
             login_user(usuario)
             flash("Login realizado com sucesso!", "success")
-            return redirect(url_for("index"))
+            return redirect(url_for("biblioteca.index"))
 
         flash("Email ou senha invalidos.", "danger")
 
     # Verificar se é primeiro acesso
-    conn = conectar()
-    cursor = conn.cursor()
-    cursor.execute("SELECT COUNT(*) AS total FROM usuarios")
-    total = cursor.fetchone()["total"]
-    conn.close()
-    primeiro_acesso = total <= 1
+    primeiro_acesso = total_usuarios() <= 1
 
     return render_template("login.html", primeiro_acesso=primeiro_acesso)
 
 
-@app.route("/recuperar-senha", methods=["GET", "POST"])
+@bp.route("/recuperar-senha", methods=["GET", "POST"])
 def recuperar_senha():
     if request.method == "POST":
         email = request.form["email"].strip().lower()
         nova_senha = request.form["senha"]
         confirmar_senha = request.form["confirmar_senha"]
+        verificar_tentativa(request.remote_addr, email)
 
         if nova_senha != confirmar_senha:
             flash("As senhas nao coincidem.", "danger")
             return render_template("recuperar_senha.html")
 
-        conn = conectar()
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM usuarios WHERE email = ?", (email,))
-        usuario = cursor.fetchone()
+        usuario = buscar_usuario_por_email(email)
 
         if not usuario:
-            conn.close()
             flash("Usuario nao encontrado", "warning")
             return render_template("recuperar_senha.html")
 
-        cursor.execute(
-            "UPDATE usuarios SET senha = ? WHERE id = ?",
-            (generate_password_hash(nova_senha), usuario["id"]),
-        )
-        conn.commit()
-        conn.close()
+        atualizar_senha(usuario["id"], gerar_hash(nova_senha))
+        _invalidar_usuario(usuario["id"])
 
         flash("Senha atualizada com sucesso. Faça login com a nova senha.", "success")
-        return redirect(url_for("login"))
+        return redirect(url_for("biblioteca.login"))
 
     return render_template("recuperar_senha.html")
 
 
-@app.route("/admin/trocar-senha", methods=["GET", "POST"])
+@bp.route("/admin/trocar-senha", methods=["GET", "POST"])
 @login_required
 def trocar_senha_admin():
     if current_user.tipo != "admin":
         flash("Acesso restrito ao administrador!", "danger")
-        return redirect(url_for("index"))
+        return redirect(url_for("biblioteca.index"))
 
     if request.method == "POST":
         senha_atual = request.form["senha_atual"]
         nova_senha = request.form["nova_senha"]
         confirmar_senha = request.form["confirmar_senha"]
 
-        conn = conectar()
-        cursor = conn.cursor()
-        cursor.execute("SELECT senha FROM usuarios WHERE id = ?", (current_user.id,))
-        usuario = cursor.fetchone()
+        usuario = buscar_usuario(current_user.id)
 
-        if not usuario or not check_password_hash(usuario["senha"], senha_atual):
-            conn.close()
+        if not usuario or not verificar_hash(usuario["senha"], senha_atual):
             flash("Senha atual incorreta.", "danger")
-            return redirect(url_for("trocar_senha_admin"))
+            return redirect(url_for("biblioteca.trocar_senha_admin"))
 
         if nova_senha != confirmar_senha:
-            conn.close()
             flash("As senhas novas nao coincidem.", "danger")
-            return redirect(url_for("trocar_senha_admin"))
+            return redirect(url_for("biblioteca.trocar_senha_admin"))
 
-        cursor.execute(
-            "UPDATE usuarios SET senha = ? WHERE id = ?",
-            (generate_password_hash(nova_senha), current_user.id),
-        )
-        conn.commit()
-        conn.close()
+        atualizar_senha(current_user.id, gerar_hash(nova_senha))
+        _invalidar_usuario(current_user.id)
 
         flash("Senha de administrador atualizada com sucesso.", "success")
-        return redirect(url_for("usuarios"))
+        return redirect(url_for("biblioteca.usuarios"))
 
     return render_template("trocar_senha_admin.html")
 
 
-@app.route("/logout", methods=["POST"])
+@bp.route("/logout", methods=["POST"])
 @login_required
 def logout():
     logout_user()
     flash("Logout realizado!", "info")
-    return redirect(url_for("login"))
+    return redirect(url_for("biblioteca.login"))
 
 
-@app.route("/registro", methods=["GET", "POST"])
+@bp.route("/registro", methods=["GET", "POST"])
 def registro():
     if request.method == "POST":
         nome = request.form["nome"].strip()
         email = request.form["email"].strip().lower()
         senha = request.form["senha"]
-        senha_hash = generate_password_hash(senha)
+        senha_hash = gerar_hash(senha)
 
-        conn = conectar()
-        cursor = conn.cursor()
         try:
-            cursor.execute(
-                "INSERT INTO usuarios (nome, email, senha, tipo) VALUES (?, ?, ?, ?)",
-                (nome, email, senha_hash, "usuario"),
-            )
-            conn.commit()
-        except sqlite3.IntegrityError:
-            conn.close()
+            criar_usuario(nome, email, senha_hash)
+        except EmailDuplicado:
             flash("Ja existe usuario com esse email.", "warning")
             return render_template("registro.html")
 
-        conn.close()
+        usuarios_contagem_cache.de(unidade_atual()).limpar()
         flash("Usuario cadastrado com sucesso!", "success")
-        return redirect(url_for("login"))
+        return redirect(url_for("biblioteca.login"))
 
     return render_template("registro.html")
 
 
-@app.route("/")
+@bp.route("/")
 @login_required
 def index():
     if current_user.tipo == "admin":
         termo = request.args.get("busca", "").strip()
-        livros = buscar_por_titulo(termo) if termo else listar_livros()
-        return render_template("index.html", livros=livros)
+        apos = request.args.get("apos", type=int)
+        antes = request.args.get("antes", type=int)
+        return render_template("index.html", tabela=_tabela_acervo(termo, apos, antes))
 
-    livros = _listar_livros_do_usuario(current_user.id)
+    livros = listar_livros_do_usuario(current_user.id)
     return render_template("meus_livros.html", livros=livros)
 
 
-@app.route("/meus-livros")
+def _tabela_acervo(termo, apos, antes):
+    # A versao e lida antes da consulta: se uma escrita ocorrer no meio, o
+    # fragmento fica sob a versao antiga e e descartado no proximo request.
+    cache = acervo_cache.de(unidade_atual())
+    cache.sincronizar_versao(ler_versao("catalogo"))
+    chave = (termo, None, None) if termo else ("", apos, antes)
+
+    html = cache.obter(chave)
+    if html is None:
+        if termo:
+            livros, pagina = buscar_por_titulo(termo), None
+        else:
+            pagina = listar_livros_pagina(apos=apos, antes=antes)
+            livros = pagina["livros"]
+        html = render_template("_tabela_livros.html", livros=livros, pagina=pagina, csrf_token=_MARCADOR_CSRF)
+        cache.guardar(chave, html)
+
+    return Markup(html.replace(_MARCADOR_CSRF, escape(_csrf_token())))
+
+
+@bp.route("/meus-livros")
 @login_required
 def meus_livros():
-    livros = _listar_livros_do_usuario(current_user.id)
+    livros = listar_livros_do_usuario(current_user.id)
     return render_template("meus_livros.html", livros=livros)
 
 
-@app.route("/usuarios")
+def _cursor_usuario(prefixo):
+    # Cursor da paginacao de usuarios: (nome, id) em ?apos_nome=&apos_id=.
+    nome = request.args.get(f"{prefixo}_nome")
+    id_usuario = request.args.get(f"{prefixo}_id", type=int)
+    if nome is None or id_usuario is None:
+        return None
+    return nome, id_usuario
+
+
+@bp.route("/usuarios")
 @login_required
 def usuarios():
     if current_user.tipo != "admin":
         flash("Acesso restrito ao administrador!", "danger")
-        return redirect(url_for("index"))
+        return redirect(url_for("biblioteca.index"))
 
     termo = request.args.get("q", "").strip()
-    pagina = request.args.get("page", 1, type=int)
-    por_pagina = 8
-
-    conn = conectar()
-    cursor = conn.cursor()
-
-    filtros = []
-    params = []
-    if termo:
-        filtros.append("(nome LIKE ? OR email LIKE ?)")
-        like = f"%{termo}%"
-        params.extend([like, like])
-
-    where_clause = f"WHERE {' AND '.join(filtros)}" if filtros else ""
-    total_query = f"SELECT COUNT(*) AS total FROM usuarios {where_clause}"
-    cursor.execute(total_query, params)
-    total = cursor.fetchone()["total"]
-
-    total_paginas = max((total + por_pagina - 1) // por_pagina, 1)
-    pagina = max(1, min(pagina, total_paginas))
-    offset = (pagina - 1) * por_pagina
-
-    dados_query = f"""
-        SELECT id, nome, email, tipo
-        FROM usuarios
-        {where_clause}
-        ORDER BY nome
-        LIMIT ? OFFSET ?
-    """
-    cursor.execute(dados_query, [*params, por_pagina, offset])
-    lista_usuarios = cursor.fetchall()
-    conn.close()
+    apos = _cursor_usuario("apos")
+    antes = _cursor_usuario("antes")
+
+    pagina = listar_usuarios_pagina(termo, apos=apos, antes=antes)
+
+    cache = usuarios_contagem_cache.de(unidade_atual())
+    total = cache.obter(termo)
+    if total is None:
+        total = contar_usuarios(termo)
+        cache.guardar(termo, total)
 
     return render_template(
         "usuarios.html",
-        usuarios=lista_usuarios,
+        usuarios=pagina["usuarios"],
         q=termo,
-        pagina=pagina,
-        total_paginas=total_paginas,
+        anterior=pagina["anterior"],
+        proximo=pagina["proximo"],
         total=total,
     )
 
 
-@app.route("/usuarios/<int:id_usuario>/tipo", methods=["POST"])
+@bp.route("/usuarios/<int:id_usuario>/tipo", methods=["POST"])
 @login_required
 def atualizar_tipo_usuario(id_usuario):
     if current_user.tipo != "admin":
         flash("Acesso restrito ao administrador!", "danger")
-        return redirect(url_for("index"))
+        return redirect(url_for("biblioteca.index"))
 
     novo_tipo = request.form.get("tipo", "").strip()
     if novo_tipo not in {"admin", "usuario"}:
         flash("Tipo de usuario invalido.", "danger")
-        return redirect(url_for("usuarios"))
+        return redirect(url_for("biblioteca.usuarios"))
 
     if id_usuario == current_user.id:
         flash("Nao e permitido alterar o proprio tipo de conta.", "warning")
-        return redirect(url_for("usuarios"))
-
-    conn = conectar()
-    cursor = conn.cursor()
+        return redirect(url_for("biblioteca.usuarios"))
 
-    cursor.execute("SELECT id, tipo FROM usuarios WHERE id = ?", (id_usuario,))
-    usuario_alvo = cursor.fetchone()
-    if not usuario_alvo:
-        conn.close()
+    resultado = alterar_tipo_usuario(id_usuario, novo_tipo)
+    if resultado == NAO_ENCONTRADO:
         flash("Usuario nao encontrado.", "warning")
-        return redirect(url_for("usuarios"))
-
-    tipo_atual = usuario_alvo["tipo"]
-    if tipo_atual == novo_tipo:
-        conn.close()
+        return redirect(url_for("biblioteca.usuarios"))
+    if resultado == SEM_ALTERACAO:
         flash("Nenhuma alteracao foi necessaria.", "info")
-        return redirect(url_for("usuarios"))
-
-    if tipo_atual == "admin" and novo_tipo == "usuario":
-        cursor.execute("SELECT COUNT(*) AS total FROM usuarios WHERE tipo = 'admin'")
-        total_admins = cursor.fetchone()["total"]
-        if total_admins <= 1:
-            conn.close()
-            flash("Nao e possivel remover o ultimo administrador.", "danger")
-            return redirect(url_for("usuarios"))
+        return redirect(url_for("biblioteca.usuarios"))
+    if resultado == ULTIMO_ADMIN:
+        flash("Nao e possivel remover o ultimo administrador.", "danger")
+        return redirect(url_for("biblioteca.usuarios"))
 
-    cursor.execute("UPDATE usuarios SET tipo = ? WHERE id = ?", (novo_tipo, id_usuario))
-    conn.commit()
-    conn.close()
+    _invalidar_usuario(id_usuario)
 
     flash("Tipo de usuario atualizado com sucesso.", "success")
-    return redirect(url_for("usuarios"))
+    return redirect(url_for("biblioteca.usuarios"))
 
 
-@app.route("/adicionar", methods=["GET", "POST"])
+@bp.route("/adicionar", methods=["GET", "POST"])
 @login_required
 def adicionar():
     if current_user.tipo != "admin":
         flash("Acesso restrito ao administrador!", "danger")
-        return redirect(url_for("index"))
+        return redirect(url_for("biblioteca.index"))
 
     if request.method == "POST":
         titulo = request.form["titulo"].strip()
@@ -416,24 +431,78 @@ def adicionar():
         adicionar_livro(livro)
 
         flash("Livro adicionado com sucesso!", "success")
-        return redirect(url_for("index"))
+        return redirect(url_for("biblioteca.index"))
 
     return render_template("adicionar.html")
 
 
-@app.route("/editar/<int:id_livro>", methods=["GET", "POST"])
+@bp.route("/importar", methods=["GET", "POST"])
+@login_required
+def importar():
+    if current_user.tipo != "admin":
+        flash("Acesso restrito ao administrador!", "danger")
+        return redirect(url_for("biblioteca.index"))
+
+    if request.method == "POST":
+        arquivo = request.files.get("arquivo")
+        if not arquivo or not arquivo.filename:
+            flash("Selecione um arquivo CSV ou JSON Lines.", "warning")
+            return render_template("importar.html")
+
+        # O Werkzeug ja grava uploads grandes em disco; aqui o arquivo e lido
+        # linha a linha, sem carregar o conteudo inteiro em memoria.
+        formato = request.form.get("formato") or formato_por_nome(arquivo.filename)
+        entrada = io.TextIOWrapper(arquivo.stream, encoding="utf-8-sig", newline="")
+        try:
+            resultado = importar_livros(ler_linhas(entrada, formato))
+        except UnicodeDecodeError:
+            flash("O arquivo deve estar codificado em UTF-8.", "danger")
+            return render_template("importar.html")
+
+        flash(f"Importacao concluida: {resultado['inseridas']} livros adicionados.", "success")
+        return render_template("importar.html", resultado=resultado)
+
+    return render_template("importar.html")
+
+
+@bp.route("/exportar/<tipo>.<formato>")
+@login_required
+def exportar(tipo, formato):
+    if current_user.tipo != "admin":
+        flash("Acesso restrito ao administrador!", "danger")
+        return redirect(url_for("biblioteca.index"))
+
+    if tipo not in CONSULTAS or formato not in FORMATOS_EXPORTACAO:
+        abort(404)
+
+    # Sem Content-Length: o corpo sai em chunks conforme o cursor avanca.
+    nome_arquivo = f"{tipo}.{formato}"
+    mimetype = "text/csv" if formato == "csv" else "application/x-ndjson"
+    blocos = gerar_exportacao(tipo, formato)
+    if request.args.get("gzip") == "1":
+        blocos = comprimir(blocos)
+        nome_arquivo += ".gz"
+        mimetype = "application/gzip"
+
+    return Response(
+        blocos,
+        mimetype=mimetype,
+        headers={"Content-Disposition": f'attachment; filename="{nome_arquivo}"'},
+    )
+
+
+@bp.route("/editar/<int:id_livro>", methods=["GET", "POST"])
 @login_required
 def editar(id_livro):
     if current_user.tipo != "admin":
         flash("Acesso restrito ao administrador!", "danger")
-        return redirect(url_for("index"))
+        return redirect(url_for("biblioteca.index"))
 
-    livros = listar_livros()
-    livro = next((l for l in livros if l["id"] == id_livro), None)
+    livro = buscar_por_id(id_livro)
 
     if not livro:
         flash("Livro nao encontrado!", "warning")
-        return redirect(url_for("index"))
+        return redirect(url_for("biblioteca.index"))
 
     if request.method == "POST":
         atualizar_livro(
@@ -443,121 +512,201 @@ def editar(id_livro):
             int(request.form["ano"]),
         )
         flash("Livro atualizado com sucesso!", "success")
-        return redirect(url_for("index"))
+        return redirect(url_for("biblioteca.index"))
 
     return render_template("editar.html", livro=livro)
 
 
-@app.route("/remover/<int:id_livro>", methods=["POST"])
+@bp.route("/remover/<int:id_livro>", methods=["POST"])
 @login_required
 def remover(id_livro):
     if current_user.tipo != "admin":
         flash("Acesso restrito ao administrador!", "danger")
-        return redirect(url_for("index"))
+        return redirect(url_for("biblioteca.index"))
 
-    remover_livro(id_livro)
-    flash("Livro removido com sucesso!", "success")
-    return redirect(url_for("index"))
+    resultado = remover_livro(id_livro)
+    if resultado == NAO_ENCONTRADO:
+        flash("Livro nao encontrado!", "warning")
+    elif resultado == CONFLITO:
+        flash("Livro emprestado: registre a devolucao antes de remover.", "warning")
+    else:
+        flash("Livro removido com sucesso!", "success")
+    return redirect(url_for("biblioteca.index"))
 
 
-@app.route("/emprestar/<int:id_livro>", methods=["GET", "POST"])
+@bp.route("/emprestar/<int:id_livro>", methods=["GET", "POST"])
 @login_required
 def emprestar(id_livro):
     if current_user.tipo != "admin":
         flash("Apenas admin pode emprestar livros!", "danger")
-        return redirect(url_for("index"))
+        return redirect(url_for("biblioteca.index"))
 
-    conn = conectar()
-    cursor = conn.cursor()
+    if request.method == "POST":
+        usuario_id = request.form.get("usuario_id", type=int)
+        if usuario_id is None:
+            flash("Selecione um usuario.", "warning")
+            return redirect(url_for("biblioteca.emprestar", id_livro=id_livro))
+
+        # Sem SELECT previo: o UPDATE condicional decide quem leva o livro.
+        resultado = emprestar_livro(id_livro, usuario_id)
+        if resultado == NAO_ENCONTRADO:
+            flash("Livro nao encontrado!", "warning")
+        elif resultado == CONFLITO:
+            flash("Livro ja esta emprestado!", "warning")
+        else:
+            flash("Livro emprestado com sucesso!", "success")
+        return redirect(url_for("biblioteca.index"))
 
-    cursor.execute("SELECT disponivel FROM livros WHERE id = ?", (id_livro,))
-    livro = cursor.fetchone()
+    livro = buscar_por_id(id_livro)
 
     if not livro:
         flash("Livro nao encontrado!", "warning")
-        conn.close()
-        return redirect(url_for("index"))
+        return redirect(url_for("biblioteca.index"))
 
-    if livro["disponivel"] == 0:
+    if livro.disponivel == 0:
         flash("Livro ja esta emprestado!", "warning")
-        conn.close()
-        return redirect(url_for("index"))
+        return redirect(url_for("biblioteca.index"))
 
-    if request.method == "POST":
-        usuario_id = request.form["usuario_id"]
-        data_devolucao = datetime.now() + timedelta(days=7)
-
-        cursor.execute(
-            """
-            UPDATE livros
-            SET disponivel = 0,
-                usuario_id = ?,
-                data_devolucao = ?
-            WHERE id = ?
-            """,
-            (usuario_id, data_devolucao.strftime("%d/%m/%Y"), id_livro),
-        )
+    # O leitor e escolhido pela busca /api/v1/usuarios/sugestoes; a pagina
+    # nao depende mais da quantidade de usuarios.
+    return render_template("emprestar.html", livro=livro, id_livro=id_livro)
 
-        conn.commit()
-        conn.close()
 
-        flash("Livro emprestado com sucesso!", "success")
-        return redirect(url_for("index"))
+@bp.route("/devolver/<int:id_livro>", methods=["POST"])
+@login_required
+def devolver(id_livro):
+    if current_user.tipo != "admin":
+        flash("Apenas admin pode registrar devolucao!", "danger")
+        return redirect(url_for("biblioteca.index"))
+
+    resultado = devolver_livro(id_livro)
+    if resultado == NAO_ENCONTRADO:
+        flash("Livro nao encontrado!", "warning")
+    elif resultado == CONFLITO:
+        flash("Livro ja esta disponivel!", "warning")
+    else:
+        flash("Livro devolvido com sucesso!", "success")
+    return redirect(url_for("biblioteca.index"))
 
-    cursor.execute(
-        """
-        SELECT id, nome
-        FROM usuarios
-        WHERE tipo = 'usuario'
-        ORDER BY nome
-        """
-    )
-    usuarios_disponiveis = cursor.fetchall()
-    conn.close()
 
-    return render_template("emprestar.html", usuarios=usuarios_disponiveis, id_livro=id_livro)
+@bp.route("/circulacao", methods=["GET", "POST"])
+@login_required
+def circulacao():
+    if current_user.tipo != "admin":
+        flash("Apenas admin pode registrar emprestimos!", "danger")
+        return redirect(url_for("biblioteca.index"))
+
+    if request.method == "GET":
+        return render_template("circulacao.html")
+
+    # Ids lidos pelo leitor de codigo de barras: um por linha, ou separados
+    # por espaco ou virgula.
+    ids = [int(numero) for numero in re.findall(r"\d+", request.form.get("livros", ""))]
+    acao = request.form.get("acao")
+    if not ids:
+        flash("Informe ao menos um livro.", "warning")
+        return render_template("circulacao.html")
+    if len(ids) > MAX_LOTE_CIRCULACAO:
+        flash(f"Informe no maximo {MAX_LOTE_CIRCULACAO} livros por vez.", "warning")
+        return render_template("circulacao.html")
+
+    if acao == "emprestar":
+        usuario_id = request.form.get("usuario_id", type=int)
+        if usuario_id is None:
+            flash("Selecione um usuario.", "warning")
+            return render_template("circulacao.html")
+        resultados = emprestar_lote(ids, usuario_id)
+    elif acao == "devolver":
+        resultados = devolver_lote(ids)
+    else:
+        abort(400, description="Acao invalida.")
+
+    titulos = {livro.id: livro.titulo for livro in buscar_por_ids(ids)}
+    feitos = sum(1 for _, resultado in resultados if resultado == OK)
+    flash(f"{feitos} de {len(resultados)} livros processados.", "success" if feitos == len(resultados) else "warning")
+    return render_template(
+        "circulacao.html",
+        acao=acao,
+        resultados=[(id_livro, titulos.get(id_livro), resultado) for id_livro, resultado in resultados],
+    )
 
 
-@app.route("/devolver/<int:id_livro>", methods=["POST"])
+@bp.route("/atrasados")
 @login_required
-def devolver(id_livro):
+def atrasados():
     if current_user.tipo != "admin":
-        flash("Apenas admin pode registrar devolucao!", "danger")
-        return redirect(url_for("index"))
+        flash("Apenas admin pode ver emprestimos atrasados!", "danger")
+        return redirect(url_for("biblioteca.index"))
 
-    conn = conectar()
-    cursor = conn.cursor()
+    apos_data = request.args.get("apos_data", "")
+    apos_id = request.args.get("apos_id", type=int)
+    apos = (apos_data, apos_id) if apos_data and apos_id else None
 
-    cursor.execute("SELECT disponivel FROM livros WHERE id = ?", (id_livro,))
-    livro = cursor.fetchone()
+    pagina = listar_atrasados(apos=apos)
+    return render_template("atrasados.html", atrasados=pagina["atrasados"], proximo=pagina["proximo"], hoje=date.today())
 
-    if not livro:
-        flash("Livro nao encontrado!", "warning")
-        conn.close()
-        return redirect(url_for("index"))
 
-    if livro["disponivel"] == 1:
-        flash("Livro ja esta disponivel!", "warning")
-        conn.close()
-        return redirect(url_for("index"))
-
-    cursor.execute(
-        """
-        UPDATE livros
-        SET disponivel = 1,
-            usuario_id = NULL,
-            data_devolucao = NULL
-        WHERE id = ?
-        """,
-        (id_livro,),
-    )
+@bp.route("/estatisticas")
+@login_required
+def estatisticas():
+    if current_user.tipo != "admin":
+        flash("Apenas admin pode ver as estatisticas!", "danger")
+        return redirect(url_for("biblioteca.index"))
+
+    return render_template("estatisticas.html", painel=ler_painel())
+
+
+def create_app(config=None):
+    app = Flask(__name__)
+    app.secret_key = os.getenv("SECRET_KEY", "dev-insecure-change-me")
+    if config:
+        app.config.update(config)
+
+    # As unidades sao bancos SQLite separados; com outro backend todas
+    # leriam e escreveriam o mesmo acervo.
+    if UNIDADES and BACKEND != "sqlite":
+        raise RuntimeError(f"UNIDADES exige DATABASE_BACKEND=sqlite (atual: {BACKEND}).")
+
+    proxies = app.config.get("PROXIES_CONFIAVEIS", PROXIES_CONFIAVEIS)
+    if proxies:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=proxies, x_proto=proxies)
+
+    init_db(app)
+    init_metricas(app)
+    init_backup(app)
+    login_manager.init_app(app)
+    app.register_blueprint(bp)
+    app.register_blueprint(api_bp)
+    registrar_comandos(app)
+
+    # Nenhuma escrita no banco ao iniciar o worker: o schema e criado e
+    # migrado por "flask --app app init-db"; aqui so conferimos a versao.
+    # Com outro backend o SQLite local tem so a tabela do limitador.
+    bancos = (("principal", None), *UNIDADES.items()) if BACKEND == "sqlite" else ()
+    for unidade, caminho in bancos:
+        versao = versao_schema_arquivo(caminho)
+        if versao < VERSAO_SCHEMA:
+            app.logger.warning(
+                "Banco %s na versao %s do schema (esperada %s). Execute 'flask --app app init-db'.",
+                unidade,
+                versao,
+                VERSAO_SCHEMA,
+            )
+
+    return app
 
-    conn.commit()
-    conn.close()
 
-    flash("Livro devolvido com sucesso!", "success")
-    return redirect(url_for("index"))
+app = create_app()
 
 
 if __name__ == "__main__":
+    criar_tabelas()
+    if BACKEND != "sqlite":
+        # O limitador de tentativas continua no SQLite local.
+        criar_tabela_limites()
+    criar_admin_padrao()
+    criar_tabelas_unidades()
+    for unidade in UNIDADES:
+        with usando_unidade(unidade):
+            criar_admin_padrao()
     app.run(debug=os.getenv("FLASK_DEBUG") == "1")
@@ -0,0 +1,361 @@
+import gzip
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import sqlite3
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from datetime import datetime
+
+import database
+from database import UNIDADES, versao_schema
+
+try:
+    import fcntl
+except ImportError:  # Windows: sem trava entre processos
+    fcntl = None
+
+log_backup = logging.getLogger("biblioteca.backup")
+
+# Copias online com a API de backup do SQLite. A origem fica em uma unica
+# transacao de leitura durante toda a copia: em WAL isso nao bloqueia
+# escritores, e a copia e um retrato do banco no instante em que comecou
+# (sem a transacao, cada escrita de outra conexao reiniciaria a copia).
+DIRETORIO = os.getenv("BACKUP_DIR", "backups")
+PAGINAS_POR_PASSO = int(os.getenv("BACKUP_PAGINAS", "256"))
+PAUSA = float(os.getenv("BACKUP_PAUSA_MS", "2")) / 1000
+ESPERA_LOCK = float(os.getenv("BACKUP_ESPERA_LOCK_MS", "50")) / 1000
+MANTER = int(os.getenv("BACKUP_MANTER", "7"))
+COMPACTAR = os.getenv("BACKUP_GZIP", "1") == "1"
+
+# Backup agendado: 0 desliga. Com varios workers, uma trava de arquivo em
+# DIRETORIO garante que so um processo faz as copias.
+INTERVALO = float(os.getenv("BACKUP_INTERVALO_MIN", "0")) * 60
+
+RELATORIO = "ultimo.json"
+_ARQUIVO = re.compile(r"^(?P<banco>.+)-(?P<momento>\d{8}T\d{9})\.db(?:\.gz)?$")
+BLOCO = 1024 * 1024
+
+
+class BackupInvalido(RuntimeError):
+    pass
+
+
+def bancos():
+    # (nome, caminho) de cada banco copiado: o principal e o de cada unidade.
+    return [("principal", database.DATABASE), *UNIDADES.items()]
+
+
+def _copiar(origem, destino, paginas, pausa):
+    medidas = {"passos": 0, "esperas": 0, "espera_s": 0.0}
+
+    def progresso(status, restantes, total):
+        medidas["passos"] += 1
+        if status in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED):
+            medidas["esperas"] += 1
+            medidas["espera_s"] += ESPERA_LOCK
+        elif restantes and pausa:
+            time.sleep(pausa)
+
+    fonte = sqlite3.connect(origem, isolation_level=None)
+    alvo = sqlite3.connect(destino, isolation_level=None)
+    try:
+        fonte.execute(f"PRAGMA busy_timeout = {database.BUSY_TIMEOUT_MS}")
+        inicio = time.perf_counter()
+        fonte.execute("BEGIN")
+        fonte.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+        medidas["espera_s"] += time.perf_counter() - inicio
+
+        fonte.backup(alvo, pages=paginas, progress=progresso, sleep=ESPERA_LOCK)
+        fonte.execute("COMMIT")
+
+        # A copia vira um arquivo unico, sem -wal, e e conferida antes de
+        # ser compactada.
+        alvo.execute("PRAGMA journal_mode = DELETE")
+        integridade = alvo.execute("PRAGMA quick_check").fetchone()[0]
+        if integridade != "ok":
+            raise BackupInvalido(f"Copia de {origem} corrompida: {integridade}")
+        medidas["versao"] = versao_schema(alvo)
+    finally:
+        alvo.close()
+        fonte.close()
+    return medidas
+
+
+class _SaidaComHash:
+    def __init__(self, arquivo):
+        self.arquivo = arquivo
+        self.hash = hashlib.sha256()
+
+    def write(self, dados):
+        self.hash.update(dados)
+        return self.arquivo.write(dados)
+
+    def flush(self):
+        self.arquivo.flush()
+
+
+def _gravar(copia, final, compactar):
+    # Grava em ".parcial" e renomeia: um backup interrompido nunca fica
+    # com o nome de um backup valido.
+    parcial = f"{final}.parcial"
+    with open(copia, "rb") as entrada, open(parcial, "wb") as arquivo:
+        saida = _SaidaComHash(arquivo)
+        if compactar:
+            with gzip.GzipFile(fileobj=saida, mode="wb", compresslevel=6) as compactado:
+                shutil.copyfileobj(entrada, compactado, BLOCO)
+        else:
+            shutil.copyfileobj(entrada, saida, BLOCO)
+        arquivo.flush()
+        os.fsync(arquivo.fileno())
+    os.replace(parcial, final)
+
+    soma = saida.hash.hexdigest()
+    with open(f"{final}.sha256", "w", encoding="utf-8") as arquivo:
+        arquivo.write(f"{soma}  {os.path.basename(final)}\n")
+    return soma
+
+
+def listar_backups(banco, diretorio=None):
+    # Backups de um banco, do mais novo para o mais antigo.
+    diretorio = diretorio or DIRETORIO
+    if not os.path.isdir(diretorio):
+        return []
+    arquivos = []
+    for nome in os.listdir(diretorio):
+        encontrado = _ARQUIVO.match(nome)
+        if encontrado and encontrado["banco"] == banco:
+            arquivos.append((encontrado["momento"], os.path.join(diretorio, nome)))
+    return [caminho for _, caminho in sorted(arquivos, reverse=True)]
+
+
+def rotacionar(banco, manter=None, diretorio=None):
+    manter = MANTER if manter is None else manter
+    removidos = listar_backups(banco, diretorio)[manter:] if manter > 0 else []
+    for caminho in removidos:
+        for arquivo in (caminho, f"{caminho}.sha256"):
+            if os.path.exists(arquivo):
+                os.remove(arquivo)
+    return removidos
+
+
+def fazer_backup(banco, caminho, diretorio=None, compactar=None, manter=None,
+                 paginas=None, pausa=None):
+    diretorio = diretorio or DIRETORIO
+    compactar = COMPACTAR if compactar is None else compactar
+    os.makedirs(diretorio, exist_ok=True)
+
+    # Data e hora ate milissegundos: a ordem dos nomes e a ordem dos backups.
+    momento = datetime.now()
+    carimbo = f"{momento:%Y%m%dT%H%M%S}{momento.microsecond // 1000:03d}"
+    final = os.path.join(diretorio, f"{banco}-{carimbo}.db" + (".gz" if compactar else ""))
+    copia = os.path.join(diretorio, f".{banco}.copia.db")
+    if os.path.exists(copia):
+        os.remove(copia)
+
+    inicio = time.perf_counter()
+    try:
+        medidas = _copiar(
+            caminho,
+            copia,
+            PAGINAS_POR_PASSO if paginas is None else paginas,
+            PAUSA if pausa is None else pausa,
+        )
+        tamanho_banco = os.path.getsize(copia)
+        soma = _gravar(copia, final, compactar)
+    finally:
+        if os.path.exists(copia):
+            os.remove(copia)
+    duracao = time.perf_counter() - inicio
+
+    resultado = {
+        "banco": banco,
+        "arquivo": final,
+        "sha256": soma,
+        "versao": medidas["versao"],
+        "bytes_banco": tamanho_banco,
+        "bytes": os.path.getsize(final),
+        "duracao_s": round(duracao, 3),
+        "mb_por_s": round(tamanho_banco / 1e6 / duracao, 1) if duracao else None,
+        "passos": medidas["passos"],
+        "esperas_lock": medidas["esperas"],
+        "espera_lock_s": round(medidas["espera_s"], 3),
+        "removidos": rotacionar(banco, manter, diretorio),
+    }
+    log_backup.info(
+        "Backup %s: %s (%d bytes) em %.2fs, %.1f MB/s, %d passos, %d esperas de lock (%.3fs)",
+        banco, final, resultado["bytes"], duracao, resultado["mb_por_s"] or 0,
+        resultado["passos"], resultado["esperas_lock"], resultado["espera_lock_s"],
+    )
+    return resultado
+
+
+def fazer_backups(diretorio=None, **opcoes):
+    diretorio = diretorio or DIRETORIO
+    os.makedirs(diretorio, exist_ok=True)
+    resultados = [
+        fazer_backup(banco, caminho, diretorio=diretorio, **opcoes)
+        for banco, caminho in bancos()
+        if os.path.exists(caminho)
+    ]
+    relatorio = os.path.join(diretorio, RELATORIO)
+    with open(f"{relatorio}.tmp", "w", encoding="utf-8") as saida:
+        json.dump({"em": datetime.now().isoformat(timespec="seconds"), "backups": resultados}, saida, indent=2)
+    os.replace(f"{relatorio}.tmp", relatorio)
+    return resultados
+
+
+@contextmanager
+def _banco_extraido(arquivo):
+    if not arquivo.endswith(".gz"):
+        yield arquivo
+        return
+
+    extraido = f"{arquivo[:-3]}.extraido"
+    try:
+        with gzip.open(arquivo, "rb") as entrada, open(extraido, "wb") as saida:
+            shutil.copyfileobj(entrada, saida, BLOCO)
+        yield extraido
+    finally:
+        if os.path.exists(extraido):
+            os.remove(extraido)
+
+
+def _conferir_soma(arquivo):
+    sidecar = f"{arquivo}.sha256"
+    if not os.path.exists(sidecar):
+        return None
+    with open(sidecar, encoding="utf-8") as entrada:
+        esperada = entrada.read().split()[0]
+
+    soma = hashlib.sha256()
+    with open(arquivo, "rb") as entrada:
+        for bloco in iter(lambda: entrada.read(BLOCO), b""):
+            soma.update(bloco)
+    if soma.hexdigest() != esperada:
+        raise BackupInvalido(f"{arquivo}: sha256 nao confere com {sidecar}.")
+    return esperada
+
+
+def _conferir_banco(caminho):
+    conn = sqlite3.connect(f"file:{caminho}?mode=ro", uri=True)
+    try:
+        integridade = [linha[0] for linha in conn.execute("PRAGMA integrity_check")]
+        if integridade != ["ok"]:
+            raise BackupInvalido(f"integrity_check: {'; '.join(integridade[:5])}")
+        return {
+            "versao": versao_schema(conn),
+            "livros": conn.execute("SELECT COUNT(*) FROM livros").fetchone()[0],
+            "usuarios": conn.execute("SELECT COUNT(*) FROM usuarios").fetchone()[0],
+        }
+    except sqlite3.DatabaseError as erro:
+        raise BackupInvalido(f"{caminho}: {erro}") from None
+    finally:
+        conn.close()
+
+
+def verificar(arquivo):
+    # Confere o sha256 (quando ha o arquivo .sha256) e a integridade do
+    # banco descompactado; levanta BackupInvalido se algo falhar.
+    soma = _conferir_soma(arquivo)
+    try:
+        with _banco_extraido(arquivo) as extraido:
+            resumo = _conferir_banco(extraido)
+    except (OSError, EOFError, zlib.error) as erro:
+        raise BackupInvalido(f"{arquivo}: {erro}") from None
+    return {"arquivo": arquivo, "sha256": soma, **resumo}
+
+
+def restaurar(arquivo, caminho):
+    # Restaura pela propria API de backup, com o app no ar: a copia entra
+    # sob o lock de escrita do banco, e as conexoes abertas dos workers
+    # passam a ler o conteudo restaurado. Os contadores de versao avancam
+    # alem dos atuais para que os caches dos workers sejam descartados.
+    resumo = verificar(arquivo)
+    with _banco_extraido(arquivo) as extraido:
+        fonte = sqlite3.connect(f"file:{extraido}?mode=ro", uri=True)
+        alvo = sqlite3.connect(caminho, isolation_level=None)
+        try:
+            alvo.execute(f"PRAGMA busy_timeout = {database.BUSY_TIMEOUT_MS}")
+            try:
+                versoes = dict(alvo.execute("SELECT nome, valor FROM versoes").fetchall())
+            except sqlite3.OperationalError:
+                versoes = {}
+
+            inicio = time.perf_counter()
+            fonte.backup(alvo, sleep=ESPERA_LOCK)
+            resumo["duracao_s"] = round(time.perf_counter() - inicio, 3)
+
+            for nome, valor in versoes.items():
+                alvo.execute(
+                    "UPDATE versoes SET valor = MAX(valor, ?) + 1 WHERE nome = ?",
+                    (valor, nome),
+                )
+        finally:
+            alvo.close()
+            fonte.close()
+    return resumo
+
+
+# ==============================
+# AGENDAMENTO
+# ==============================
+
+_agendador_pid = None
+_agendador_lock = threading.Lock()
+
+
+def _tentar_travar(diretorio):
+    os.makedirs(diretorio, exist_ok=True)
+    trava = open(os.path.join(diretorio, ".agendador.lock"), "a")
+    if fcntl is None:
+        return trava
+    try:
+        fcntl.flock(trava, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        trava.close()
+        return None
+    return trava
+
+
+def _backup_pendente(diretorio):
+    relatorio = os.path.join(diretorio, RELATORIO)
+    return not os.path.exists(relatorio) or time.time() - os.path.getmtime(relatorio) >= INTERVALO
+
+
+def _agendar(diretorio):
+    # Todo worker roda este laco; so quem obtem a trava faz backups. Se esse
+    # worker morrer, a trava e liberada e outro assume no ciclo seguinte.
+    trava = None
+    while True:
+        if trava is None:
+            trava = _tentar_travar(diretorio)
+        if trava is not None and _backup_pendente(diretorio):
+            try:
+                fazer_backups(diretorio)
+            except Exception:
+                log_backup.exception("Backup agendado falhou.")
+        time.sleep(min(INTERVALO, 60))
+
+
+def _iniciar_agendador():
+    global _agendador_pid
+    # Threads nao sobrevivem ao fork: cada worker inicia a sua no primeiro
+    # request.
+    if _agendador_pid == os.getpid():
+        return
+    with _agendador_lock:
+        if _agendador_pid == os.getpid():
+            return
+        _agendador_pid = os.getpid()
+        threading.Thread(target=_agendar, args=(DIRETORIO,), name="backup", daemon=True).start()
+
+
+def init_app(app):
+    if INTERVALO > 0:
+        app.before_request(_iniciar_agendador)
@@ -0,0 +1,394 @@
+import http.cookiejar
+import json
+import math
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from datetime import date, datetime, timedelta
+
+from database import conectar, criar_tabelas
+from models import chave_livro
+from senhas import gerar_hash
+
+# (livros, usuarios) de cada escala pronta.
+ESCALAS = {
+    "1k": (1_000, 200),
+    "100k": (100_000, 20_000),
+    "1m": (1_000_000, 100_000),
+}
+LOTE_GERACAO = 10_000
+
+ADMIN_EMAIL = "bench-admin@bench.test"
+SENHA = "bench123"
+
+# Peso de cada operacao na mistura padrao.
+MISTURA = {
+    "index": 30,
+    "busca": 20,
+    "meus_livros": 15,
+    "usuarios": 10,
+    "emprestar": 10,
+    "devolver": 10,
+    "api_livros": 5,
+}
+
+_PALAVRAS = (
+    "casa noite mar tempo vida amor guerra cidade sombra luz caminho rio "
+    "memorias segredo jardim sertao estrela historia viagem silencio fogo "
+    "python flask dados sistemas redes algoritmos banco projeto codigo"
+).split()
+_NOMES = "Ana Bruno Carla Davi Eva Fabio Gil Helena Igor Julia Lucas Marta Nuno Olga Paulo Rita".split()
+_SOBRENOMES = "Silva Souza Lima Rocha Costa Alves Pereira Gomes Ribeiro Martins Araujo Barros".split()
+
+
+def _nome(rnd):
+    return f"{rnd.choice(_NOMES)} {rnd.choice(_SOBRENOMES)}"
+
+
+def _titulo(rnd):
+    return " ".join(rnd.choice(_PALAVRAS) for _ in range(rnd.randint(2, 4))).capitalize()
+
+
+def gerar_dados(livros, usuarios, emprestados=0.1, semente=42, progresso=None):
+    # Popula o banco atual (database.DATABASE) com um acervo e leitores
+    # sinteticos. Todos os leitores usam a mesma senha, com um unico hash,
+    # para que a geracao nao seja dominada pelo custo do hash.
+    rnd = random.Random(semente)
+    criar_tabelas()
+    conn = conectar()
+    senha_hash = gerar_hash(SENHA)
+
+    conn.execute(
+        "INSERT OR IGNORE INTO usuarios (nome, email, senha, tipo) VALUES (?, ?, ?, 'admin')",
+        ("Bench Admin", ADMIN_EMAIL, senha_hash),
+    )
+    primeiro_leitor = conn.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM usuarios").fetchone()[0]
+    for inicio in range(0, usuarios, LOTE_GERACAO):
+        conn.executemany(
+            "INSERT INTO usuarios (nome, email, senha, tipo) VALUES (?, ?, ?, 'usuario')",
+            [
+                (_nome(rnd), f"leitor{primeiro_leitor + numero}@bench.test", senha_hash)
+                for numero in range(inicio, min(inicio + LOTE_GERACAO, usuarios))
+            ],
+        )
+        conn.commit()
+        if progresso:
+            progresso("usuarios", min(inicio + LOTE_GERACAO, usuarios))
+    leitores = [linha[0] for linha in conn.execute("SELECT id FROM usuarios WHERE tipo = 'usuario'")]
+
+    hoje = date.today()
+    for inicio in range(0, livros, LOTE_GERACAO):
+        lote = []
+        for _ in range(inicio, min(inicio + LOTE_GERACAO, livros)):
+            titulo, autor, ano = _titulo(rnd), _nome(rnd), rnd.randint(1850, hoje.year)
+            lote.append((titulo, autor, ano, chave_livro(titulo, autor, ano)))
+        conn.executemany("INSERT INTO livros (titulo, autor, ano, disponivel, chave) VALUES (?, ?, ?, 1, ?)", lote)
+        conn.commit()
+        if progresso:
+            progresso("livros", min(inicio + LOTE_GERACAO, livros))
+
+    # Parte do acervo emprestada, com devolucoes previstas entre 30 dias
+    # atras e 14 dias a frente (ou seja, uma fracao atrasada).
+    if leitores and emprestados:
+        ids = [linha[0] for linha in conn.execute("SELECT id FROM livros WHERE disponivel = 1")]
+        for id_livro in rnd.sample(ids, int(len(ids) * emprestados)):
+            prevista = hoje + timedelta(days=rnd.randint(-30, 14))
+            usuario_id = rnd.choice(leitores)
+            conn.execute(
+                "UPDATE livros SET disponivel = 0, usuario_id = ?, data_devolucao = ? WHERE id = ?",
+                (usuario_id, prevista.isoformat(), id_livro),
+            )
+            conn.execute(
+                """
+                INSERT INTO emprestimos (livro_id, usuario_id, emprestado_em, devolucao_prevista)
+                VALUES (?, ?, ?, ?)
+                """,
+                (id_livro, usuario_id, f"{prevista - timedelta(days=7)} 10:00:00", prevista.isoformat()),
+            )
+        conn.commit()
+
+    conn.execute("ANALYZE")
+    conn.commit()
+    conn.close()
+    return {"livros": livros, "usuarios": usuarios, "emprestados": int(livros * emprestados)}
+
+
+class SessaoCliente:
+    # Sessao sobre o test client do Flask: mede a aplicacao sem rede.
+    def __init__(self, app):
+        self.cliente = app.test_client()
+
+    def get(self, caminho):
+        resposta = self.cliente.get(caminho)
+        return resposta.status_code, resposta.get_data()
+
+    def post(self, caminho, dados):
+        resposta = self.cliente.post(caminho, data=dados)
+        return resposta.status_code, resposta.get_data()
+
+
+class _SemRedirecionar(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class SessaoHttp:
+    # Sessao HTTP com cookies, sem seguir redirecionamentos (como o test client).
+    def __init__(self, base):
+        self.base = base.rstrip("/")
+        self.abridor = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()),
+            _SemRedirecionar,
+        )
+
+    def _abrir(self, pedido):
+        try:
+            with self.abridor.open(pedido, timeout=30) as resposta:
+                return resposta.status, resposta.read()
+        except urllib.error.HTTPError as erro:
+            return erro.code, erro.read()
+
+    def get(self, caminho):
+        return self._abrir(self.base + caminho)
+
+    def post(self, caminho, dados):
+        corpo = urllib.parse.urlencode(dados).encode()
+        return self._abrir(urllib.request.Request(self.base + caminho, data=corpo))
+
+
+def _token_csrf(sessao, caminho):
+    _, corpo = sessao.get(caminho)
+    encontrado = re.search(rb'name="csrf_token" value="([^"]+)"', corpo)
+    return encontrado.group(1).decode() if encontrado else ""
+
+
+def _entrar(sessao, email):
+    token = _token_csrf(sessao, "/login")
+    status, _ = sessao.post("/login", {"email": email, "senha": SENHA, "csrf_token": token})
+    if status != 302:
+        raise RuntimeError(f"Login de {email} falhou (status {status}).")
+    return token
+
+
+class _Usuario:
+    # Usuario virtual: uma sessao de admin e uma de leitor.
+    def __init__(self, nova_sessao, contexto, rnd):
+        self.rnd = rnd
+        self.contexto = contexto
+        self.admin = nova_sessao()
+        self.token = _entrar(self.admin, ADMIN_EMAIL)
+        self.leitor = nova_sessao()
+        _entrar(self.leitor, rnd.choice(contexto["emails"]))
+
+    def executar(self, operacao):
+        rnd, contexto = self.rnd, self.contexto
+        if operacao == "index":
+            apos = rnd.choice((None, rnd.randint(1, contexto["max_livro"])))
+            return self.admin.get(f"/?apos={apos}" if apos else "/")
+        if operacao == "busca":
+            return self.admin.get(f"/?busca={rnd.choice(_PALAVRAS)[:rnd.randint(3, 6)]}")
+        if operacao == "meus_livros":
+            return self.leitor.get("/meus-livros")
+        if operacao == "usuarios":
+            termo = rnd.choice(("", "", rnd.choice(_NOMES).lower()[:3], rnd.choice(_SOBRENOMES).lower()))
+            return self.admin.get(f"/usuarios?q={termo}")
+        if operacao == "emprestar":
+            dados = {"usuario_id": rnd.choice(contexto["leitores"]), "csrf_token": self.token}
+            return self.admin.post(f"/emprestar/{rnd.randint(1, contexto['max_livro'])}", dados)
+        if operacao == "devolver":
+            return self.admin.post(f"/devolver/{rnd.randint(1, contexto['max_livro'])}", {"csrf_token": self.token})
+        if operacao == "api_livros":
+            return self.admin.get(f"/api/v1/livros?apos={rnd.randint(0, contexto['max_livro'])}")
+        raise ValueError(f"Operacao desconhecida: {operacao}")
+
+
+def _contexto():
+    conn = conectar()
+    leitores = conn.execute(
+        "SELECT id, email FROM usuarios WHERE tipo = 'usuario' ORDER BY id LIMIT 1000"
+    ).fetchall()
+    max_livro = conn.execute("SELECT COALESCE(MAX(id), 1) FROM livros").fetchone()[0]
+    conn.close()
+    if not leitores:
+        raise RuntimeError("Banco sem leitores; gere os dados com gerar_dados().")
+    return {
+        "leitores": [linha["id"] for linha in leitores],
+        "emails": [linha["email"] for linha in leitores],
+        "max_livro": max_livro,
+    }
+
+
+def percentil(valores, p):
+    # Nearest-rank sobre a lista ja ordenada.
+    if not valores:
+        return 0.0
+    posicao = max(0, math.ceil(p / 100 * len(valores)) - 1)
+    return valores[posicao]
+
+
+def _resumir(amostras, erros):
+    rotas = {}
+    for operacao, tempos in sorted(amostras.items()):
+        tempos.sort()
+        rotas[operacao] = {
+            "requisicoes": len(tempos),
+            "erros": erros.get(operacao, 0),
+            "media_ms": round(sum(tempos) / len(tempos) * 1000, 3),
+            "p50_ms": round(percentil(tempos, 50) * 1000, 3),
+            "p95_ms": round(percentil(tempos, 95) * 1000, 3),
+            "p99_ms": round(percentil(tempos, 99) * 1000, 3),
+            "max_ms": round(tempos[-1] * 1000, 3),
+        }
+    return rotas
+
+
+def executar(nova_sessao, requisicoes=1000, concorrencia=4, mistura=None, semente=1):
+    # Cada thread e um usuario virtual que sorteia operacoes pela mistura e
+    # registra o tempo de cada uma.
+    mistura = mistura or MISTURA
+    operacoes, pesos = zip(*mistura.items())
+    contexto = _contexto()
+
+    amostras = {operacao: [] for operacao in operacoes}
+    erros = {}
+    trava = threading.Lock()
+    falhas = []
+
+    def trabalhar(indice, quantidade, barreira):
+        rnd = random.Random(semente + indice)
+        try:
+            usuario = _Usuario(nova_sessao, contexto, rnd)
+        except Exception as erro:
+            falhas.append(erro)
+            barreira.abort()
+            return
+        try:
+            barreira.wait()
+        except threading.BrokenBarrierError:
+            return
+
+        locais = {operacao: [] for operacao in operacoes}
+        erros_locais = {}
+        for operacao in rnd.choices(operacoes, pesos, k=quantidade):
+            inicio = time.perf_counter()
+            status, _ = usuario.executar(operacao)
+            locais[operacao].append(time.perf_counter() - inicio)
+            if status >= 400:
+                erros_locais[operacao] = erros_locais.get(operacao, 0) + 1
+
+        with trava:
+            for operacao, tempos in locais.items():
+                amostras[operacao].extend(tempos)
+            for operacao, total in erros_locais.items():
+                erros[operacao] = erros.get(operacao, 0) + total
+
+    barreira = threading.Barrier(concorrencia + 1)
+    partes = [requisicoes // concorrencia + (1 if i < requisicoes % concorrencia else 0) for i in range(concorrencia)]
+    threads = [threading.Thread(target=trabalhar, args=(i, parte, barreira)) for i, parte in enumerate(partes)]
+    for thread in threads:
+        thread.start()
+    try:
+        barreira.wait()
+    except threading.BrokenBarrierError:
+        pass
+    inicio = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    duracao = time.perf_counter() - inicio
+    if falhas:
+        raise falhas[0]
+
+    amostras = {operacao: tempos for operacao, tempos in amostras.items() if tempos}
+    total = sum(len(tempos) for tempos in amostras.values())
+    return {
+        "data": datetime.now().isoformat(timespec="seconds"),
+        "requisicoes": total,
+        "concorrencia": concorrencia,
+        "duracao_s": round(duracao, 3),
+        "throughput_rps": round(total / duracao, 1) if duracao else 0.0,
+        "erros": sum(erros.values()),
+        "rotas": _resumir(amostras, erros),
+    }
+
+
+def _porta_livre():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class ServidorGunicorn:
+    # Sobe "gunicorn app:app" local apontando para o banco informado.
+    def __init__(self, caminho_banco, workers=2, threads=1):
+        self.porta = _porta_livre()
+        self.base = f"http://127.0.0.1:{self.porta}"
+        self.comando = [
+            sys.executable, "-m", "gunicorn", "app:app",
+            "--bind", f"127.0.0.1:{self.porta}",
+            "--workers", str(workers),
+            "--threads", str(threads),
+            "--preload",
+        ]
+        # Os usuarios virtuais entram todos de uma vez com o mesmo admin; o
+        # limitador de tentativas de login ficaria no caminho.
+        self.ambiente = dict(os.environ, DATABASE_PATH=os.path.abspath(caminho_banco), LIMITE_TENTATIVAS="0")
+        self.processo = None
+
+    def __enter__(self):
+        self.processo = subprocess.Popen(
+            self.comando,
+            env=self.ambiente,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        limite = time.monotonic() + 30
+        while time.monotonic() < limite:
+            if self.processo.poll() is not None:
+                raise RuntimeError("gunicorn terminou durante a inicializacao.")
+            try:
+                urllib.request.urlopen(self.base + "/login", timeout=1).close()
+                return self
+            except OSError:
+                time.sleep(0.2)
+        self.__exit__()
+        raise RuntimeError("gunicorn nao respondeu em 30s.")
+
+    def __exit__(self, *args):
+        if self.processo and self.processo.poll() is None:
+            self.processo.terminate()
+            self.processo.wait(10)
+
+
+def comparar(atual, base, tolerancia=0.2):
+    # Lista as regressoes de "atual" em relacao a "base": p95 de uma rota ou
+    # throughput piores que a tolerancia (0.2 = 20%).
+    regressoes = []
+    if atual["throughput_rps"] < base["throughput_rps"] * (1 - tolerancia):
+        regressoes.append(
+            f"throughput: {atual['throughput_rps']} req/s (base {base['throughput_rps']} req/s)"
+        )
+    for rota, medidas in atual["rotas"].items():
+        anterior = base["rotas"].get(rota)
+        if anterior and medidas["p95_ms"] > anterior["p95_ms"] * (1 + tolerancia):
+            regressoes.append(f"{rota}: p95 {medidas['p95_ms']}ms (base {anterior['p95_ms']}ms)")
+    return regressoes
+
+
+def salvar(resultado, caminho):
+    with open(caminho, "w", encoding="utf-8") as saida:
+        json.dump(resultado, saida, indent=2, ensure_ascii=False)
+        saida.write("\n")
+
+
+def carregar(caminho):
+    with open(caminho, encoding="utf-8") as entrada:
+        return json.load(entrada)
@@ -0,0 +1,123 @@
+import threading
+import time
+from collections import OrderedDict
+
+_AUSENTE = object()
+
+
+class CacheLRU:
+    def __init__(self, tamanho_max=1024, ttl=None, bytes_max=None, medir=len):
+        self.tamanho_max = tamanho_max
+        self.ttl = ttl
+        # Com bytes_max, o peso de cada valor (medir(valor)) tambem limita o
+        # cache; itens sozinhos maiores que o limite nao sao guardados.
+        self.bytes_max = bytes_max
+        self.medir = medir
+        self.versao = None
+        self._versao_conferida_em = None
+        self.hits = 0
+        self.misses = 0
+        self._bytes = 0
+        self._itens = OrderedDict()
+        self._lock = threading.Lock()
+
+    def obter(self, chave, padrao=None):
+        agora = time.monotonic()
+        with self._lock:
+            item = self._itens.get(chave, _AUSENTE)
+            if item is not _AUSENTE:
+                valor, expira_em, _ = item
+                if expira_em is None or expira_em > agora:
+                    self._itens.move_to_end(chave)
+                    self.hits += 1
+                    return valor
+                self._remover(chave)
+            self.misses += 1
+            return padrao
+
+    def _remover(self, chave):
+        item = self._itens.pop(chave, None)
+        if item is not None:
+            self._bytes -= item[2]
+
+    def guardar(self, chave, valor):
+        expira_em = time.monotonic() + self.ttl if self.ttl else None
+        peso = self.medir(valor) if self.bytes_max else 0
+        with self._lock:
+            self._remover(chave)
+            if self.bytes_max and peso > self.bytes_max:
+                return
+            self._itens[chave] = (valor, expira_em, peso)
+            self._bytes += peso
+            while len(self._itens) > self.tamanho_max or (self.bytes_max and self._bytes > self.bytes_max):
+                _, (_, _, peso_antigo) = self._itens.popitem(last=False)
+                self._bytes -= peso_antigo
+
+    def invalidar(self, chave):
+        with self._lock:
+            self._remover(chave)
+
+    def limpar(self):
+        with self._lock:
+            self._itens.clear()
+            self._bytes = 0
+
+    def sincronizar_versao(self, versao):
+        # Versao vinda do banco: se outro processo alterou os dados, descarta
+        # tudo o que foi carregado antes.
+        if versao != self.versao:
+            self.limpar()
+            self.versao = versao
+
+    def versao_vencida(self, intervalo):
+        # Verdadeiro no maximo uma vez a cada "intervalo" segundos: so entao
+        # quem chama precisa ler a versao no banco.
+        agora = time.monotonic()
+        with self._lock:
+            if self._versao_conferida_em is not None and agora - self._versao_conferida_em < intervalo:
+                return False
+            self._versao_conferida_em = agora
+            return True
+
+    def estatisticas(self):
+        with self._lock:
+            return {
+                "itens": len(self._itens),
+                "tamanho_max": self.tamanho_max,
+                "bytes": self._bytes,
+                "bytes_max": self.bytes_max,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+class GrupoCaches:
+    # Um CacheLRU independente por chave (por exemplo, por unidade), cada um
+    # com a propria versao: a troca de versao de um nao limpa os outros.
+    def __init__(self, fabrica):
+        self.fabrica = fabrica
+        self._caches = {}
+        self._lock = threading.Lock()
+
+    def de(self, chave):
+        with self._lock:
+            cache = self._caches.get(chave)
+            if cache is None:
+                cache = self._caches[chave] = self.fabrica()
+            return cache
+
+    def limpar(self):
+        with self._lock:
+            caches = list(self._caches.values())
+        for cache in caches:
+            cache.limpar()
+
+    def estatisticas(self):
+        with self._lock:
+            caches = list(self._caches.values())
+        total = {"itens": 0, "bytes": 0, "hits": 0, "misses": 0}
+        for cache in caches:
+            for chave, valor in cache.estatisticas().items():
+                if chave in total:
+                    total[chave] += valor
+        return total
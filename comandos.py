@@ -0,0 +1,385 @@
+import os
+import sys
+import time
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+import backup
+import database
+import limites
+import repositorio
+from database import VERSAO_SCHEMA, conectar, criar_tabelas_unidades
+from exportacao import CONSULTAS, FORMATOS as FORMATOS_EXPORTACAO, comprimir, gerar as gerar_exportacao
+from importacao import FORMATOS, LIMITE_ERROS, LOTE_IMPORTACAO, formato_por_nome, importar_livros, ler_linhas
+from models import EmailDuplicado
+from repositorio import criar_tabelas, criar_usuario, reconstruir_estatisticas, total_usuarios
+from senhas import gerar_hash, mapear_hashes
+
+LOTE_SENHAS = 200
+
+
+def criar_admin_padrao():
+    if total_usuarios() > 0:
+        return False
+    criar_usuario("Admin", "admin@admin.com", gerar_hash("admin"), "admin")
+    return True
+
+
+def migrar_senhas_legadas(lote=LOTE_SENHAS, progresso=None):
+    # Percorre os usuarios com senha em texto puro por id, em lotes: cada lote
+    # e calculado em paralelo no pool de hash e gravado em uma transacao.
+    conn = conectar()
+    cursor = conn.cursor()
+
+    migradas = 0
+    ultimo_id = 0
+    while True:
+        cursor.execute(
+            """
+            SELECT id, senha FROM usuarios
+            WHERE id > ?
+            AND senha NOT LIKE 'pbkdf2:%'
+            AND senha NOT LIKE 'scrypt:%'
+            ORDER BY id
+            LIMIT ?
+            """,
+            (ultimo_id, lote),
+        )
+        legados = cursor.fetchall()
+        if not legados:
+            break
+
+        hashes = mapear_hashes([usuario["senha"] for usuario in legados])
+        cursor.executemany(
+            "UPDATE usuarios SET senha = ? WHERE id = ?",
+            [(senha_hash, usuario["id"]) for senha_hash, usuario in zip(hashes, legados)],
+        )
+        conn.commit()
+
+        migradas += len(legados)
+        ultimo_id = legados[-1]["id"]
+        if progresso:
+            progresso(len(legados))
+
+    conn.close()
+    return migradas
+
+
+def _contar_senhas_legadas():
+    conn = conectar()
+    total = conn.execute(
+        "SELECT COUNT(*) AS total FROM usuarios WHERE senha NOT LIKE 'pbkdf2:%' AND senha NOT LIKE 'scrypt:%'"
+    ).fetchone()["total"]
+    conn.close()
+    return total
+
+
+@click.command("init-db")
+@with_appcontext
+def init_db_comando():
+    """Cria o banco ou aplica as migracoes pendentes."""
+    aplicadas = criar_tabelas()
+    if aplicadas:
+        click.echo(f"Migracoes aplicadas: {', '.join(map(str, aplicadas))}.")
+    else:
+        click.echo(f"Schema ja esta na versao {repositorio.VERSAO_SCHEMA}.")
+
+    if repositorio.BACKEND != "sqlite":
+        # So o limitador de tentativas continua no SQLite local.
+        database.criar_tabela_limites()
+
+    if criar_admin_padrao():
+        click.echo("Admin padrao criado: admin@admin.com / admin")
+
+    for unidade, aplicadas in criar_tabelas_unidades().items():
+        if aplicadas:
+            click.echo(f"[{unidade}] Migracoes aplicadas: {', '.join(map(str, aplicadas))}.")
+        else:
+            click.echo(f"[{unidade}] Schema ja esta na versao {VERSAO_SCHEMA}.")
+        with database.usando_unidade(unidade):
+            if criar_admin_padrao():
+                click.echo(f"[{unidade}] Admin padrao criado: admin@admin.com / admin")
+
+
+@click.command("migrate-passwords")
+@click.option("--lote", default=LOTE_SENHAS, show_default=True, help="Usuarios por transacao.")
+@with_appcontext
+def migrar_senhas_comando(lote):
+    """Converte senhas legadas em texto puro para hash."""
+    total = _contar_senhas_legadas()
+    if not total:
+        click.echo("Nenhuma senha legada encontrada.")
+        return
+
+    inicio = time.perf_counter()
+    with click.progressbar(length=total, label="Migrando senhas") as barra:
+        migradas = migrar_senhas_legadas(lote=lote, progresso=barra.update)
+    duracao = time.perf_counter() - inicio
+    click.echo(f"{migradas} senhas migradas em {duracao:.1f}s ({migradas / duracao:.0f}/s).")
+
+
+@click.command("create-admin")
+@click.option("--nome", prompt=True)
+@click.option("--email", prompt=True)
+@click.option("--senha", prompt=True, hide_input=True, confirmation_prompt=True)
+@with_appcontext
+def criar_admin_comando(nome, email, senha):
+    """Cadastra um novo administrador."""
+    try:
+        criar_usuario(nome.strip(), email.strip().lower(), gerar_hash(senha), "admin")
+    except EmailDuplicado:
+        raise click.ClickException("Ja existe usuario com esse email.") from None
+
+    click.echo(f"Administrador {email.strip().lower()} criado.")
+
+
+@click.command("import-books")
+@click.argument("arquivo", type=click.Path(exists=True, dir_okay=False))
+@click.option("--formato", type=click.Choice(FORMATOS), help="Padrao: deduzido pela extensao.")
+@click.option("--lote", default=LOTE_IMPORTACAO, show_default=True, help="Linhas por transacao.")
+@with_appcontext
+def importar_livros_comando(arquivo, formato, lote):
+    """Importa livros de um arquivo CSV ou JSON Lines (titulo, autor, ano)."""
+    formato = formato or formato_por_nome(arquivo)
+
+    def progresso(parcial):
+        click.echo(f"  {parcial['lidas']} linhas lidas, {parcial['inseridas']} inseridas", err=True)
+
+    with open(arquivo, encoding="utf-8-sig", newline="") as entrada:
+        resultado = importar_livros(ler_linhas(entrada, formato), lote=lote, progresso=progresso)
+
+    for numero, mensagem in resultado["erros"]:
+        click.echo(f"Linha {numero}: {mensagem}", err=True)
+    if resultado["invalidas"] > LIMITE_ERROS:
+        click.echo(f"... e mais {resultado['invalidas'] - LIMITE_ERROS} linhas invalidas.", err=True)
+
+    click.echo(
+        f"{resultado['lidas']} linhas lidas: {resultado['inseridas']} inseridas, "
+        f"{resultado['duplicadas']} duplicadas, {resultado['invalidas']} invalidas "
+        f"em {resultado['duracao']:.1f}s ({resultado['linhas_por_segundo']:.0f} linhas/s)."
+    )
+
+
+@click.command("export")
+@click.argument("tipo", type=click.Choice(sorted(CONSULTAS)))
+@click.option("--formato", type=click.Choice(FORMATOS_EXPORTACAO), default="csv", show_default=True)
+@click.option("--gzip", "compactar", is_flag=True, help="Compacta a saida com gzip.")
+@click.option("--saida", type=click.Path(dir_okay=False, writable=True), help="Padrao: saida padrao.")
+@with_appcontext
+def exportar_comando(tipo, formato, compactar, saida):
+    """Exporta livros ou emprestimos ativos em CSV ou JSON Lines."""
+    blocos = gerar_exportacao(tipo, formato)
+    if compactar:
+        blocos = comprimir(blocos)
+
+    destino = open(saida, "wb") if saida else sys.stdout.buffer
+    try:
+        for bloco in blocos:
+            destino.write(bloco)
+    finally:
+        if saida:
+            destino.close()
+
+
+# O harness de benchmark (e o que ele importa) so e carregado pelos proprios
+# comandos, nunca no boot dos workers; as escalas repetem benchmark.ESCALAS.
+ESCALAS_BENCHMARK = ("100k", "1k", "1m")
+
+
+def _usar_banco(caminho):
+    # Os comandos de benchmark nunca tocam no banco configurado da aplicacao.
+    database.DATABASE = os.path.abspath(caminho)
+
+
+@click.command("bench-data")
+@click.option("--banco", default="bench.db", show_default=True, type=click.Path(dir_okay=False))
+@click.option("--escala", type=click.Choice(ESCALAS_BENCHMARK), default="1k", show_default=True)
+@click.option("--livros", type=int, help="Sobrescreve a quantidade de livros da escala.")
+@click.option("--usuarios", type=int, help="Sobrescreve a quantidade de leitores da escala.")
+@click.option("--emprestados", default=0.1, show_default=True, help="Fracao do acervo emprestada.")
+@click.option("--substituir", is_flag=True, help="Apaga o banco se ele ja existir.")
+@with_appcontext
+def gerar_dados_comando(banco, escala, livros, usuarios, emprestados, substituir):
+    """Gera um banco sintetico para o benchmark."""
+    import benchmark
+
+    if os.path.exists(banco):
+        if not substituir:
+            raise click.ClickException(f"{banco} ja existe; use --substituir para recriar.")
+        database.fechar_pools()
+        for sufixo in ("", "-wal", "-shm"):
+            if os.path.exists(banco + sufixo):
+                os.remove(banco + sufixo)
+
+    padrao_livros, padrao_usuarios = benchmark.ESCALAS[escala]
+    _usar_banco(banco)
+
+    def progresso(tabela, total):
+        click.echo(f"  {tabela}: {total}", err=True)
+
+    inicio = time.perf_counter()
+    gerados = benchmark.gerar_dados(
+        livros if livros is not None else padrao_livros,
+        usuarios if usuarios is not None else padrao_usuarios,
+        emprestados=emprestados,
+        progresso=progresso,
+    )
+    click.echo(
+        f"{gerados['livros']} livros, {gerados['usuarios']} leitores e {gerados['emprestados']} emprestimos "
+        f"em {time.perf_counter() - inicio:.1f}s. Admin: {benchmark.ADMIN_EMAIL} / {benchmark.SENHA}"
+    )
+
+
+@click.command("bench")
+@click.option("--banco", default="bench.db", show_default=True, type=click.Path(exists=True, dir_okay=False))
+@click.option("--alvo", type=click.Choice(("cliente", "gunicorn")), default="cliente", show_default=True,
+              help="Test client no proprio processo ou gunicorn local.")
+@click.option("--requisicoes", default=2000, show_default=True)
+@click.option("--concorrencia", default=4, show_default=True, help="Usuarios virtuais simultaneos.")
+@click.option("--workers", default=2, show_default=True, help="Workers do gunicorn.")
+@click.option("--saida", type=click.Path(dir_okay=False, writable=True), help="Grava o resultado em JSON.")
+@click.option("--comparar", "base", type=click.Path(exists=True, dir_okay=False),
+              help="Resultado JSON anterior; falha se houver regressao.")
+@click.option("--tolerancia", default=0.2, show_default=True, help="Piora aceita sobre a base (0.2 = 20%).")
+@with_appcontext
+def bench_comando(banco, alvo, requisicoes, concorrencia, workers, saida, base, tolerancia):
+    """Mede throughput e latencia (p50/p95/p99) por rota."""
+    import benchmark
+
+    if alvo == "gunicorn":
+        with benchmark.ServidorGunicorn(banco, workers=workers) as servidor:
+            _usar_banco(banco)
+            resultado = benchmark.executar(
+                lambda: benchmark.SessaoHttp(servidor.base),
+                requisicoes=requisicoes,
+                concorrencia=concorrencia,
+            )
+        resultado["workers"] = workers
+    else:
+        _usar_banco(banco)
+        limites.ATIVO = False
+        app = current_app._get_current_object()
+        resultado = benchmark.executar(
+            lambda: benchmark.SessaoCliente(app),
+            requisicoes=requisicoes,
+            concorrencia=concorrencia,
+        )
+    resultado["alvo"] = alvo
+    resultado["banco"] = os.path.basename(banco)
+
+    click.echo(f"{resultado['requisicoes']} requisicoes em {resultado['duracao_s']}s: "
+               f"{resultado['throughput_rps']} req/s, {resultado['erros']} erros")
+    click.echo(f"{'rota':<12} {'n':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for rota, medidas in resultado["rotas"].items():
+        click.echo(f"{rota:<12} {medidas['requisicoes']:>6} {medidas['p50_ms']:>9.2f} "
+                   f"{medidas['p95_ms']:>9.2f} {medidas['p99_ms']:>9.2f}")
+
+    if saida:
+        benchmark.salvar(resultado, saida)
+
+    if base:
+        regressoes = benchmark.comparar(resultado, benchmark.carregar(base), tolerancia)
+        for regressao in regressoes:
+            click.echo(f"Regressao: {regressao}", err=True)
+        if regressoes:
+            sys.exit(1)
+
+
+@click.command("rebuild-stats")
+@click.option("--verificar", is_flag=True, help="So compara com os resumos atuais, sem grava-los.")
+@with_appcontext
+def rebuild_stats_comando(verificar):
+    """Recalcula do zero as tabelas de estatisticas e mostra as divergencias."""
+    divergencias = reconstruir_estatisticas(verificar=verificar)
+    for tabela, chave, mantido, recalculado in divergencias:
+        click.echo(f"{tabela}[{chave}]: {mantido} -> {recalculado}")
+
+    if not divergencias:
+        click.echo("Estatisticas consistentes.")
+    elif verificar:
+        click.echo(f"{len(divergencias)} divergencias encontradas.", err=True)
+        sys.exit(1)
+    else:
+        click.echo(f"{len(divergencias)} divergencias corrigidas.")
+
+
+@click.command("backup")
+@click.option("--diretorio", type=click.Path(file_okay=False), help="Padrao: BACKUP_DIR.")
+@click.option("--gzip/--sem-gzip", "compactar", default=None, help="Padrao: BACKUP_GZIP.")
+@click.option("--manter", type=int, help="Backups mantidos por banco (padrao: BACKUP_MANTER).")
+@click.option("--paginas", type=int, help="Paginas copiadas por passo (padrao: BACKUP_PAGINAS).")
+@with_appcontext
+def backup_comando(diretorio, compactar, manter, paginas):
+    """Copia o banco principal e o de cada unidade com o app no ar."""
+    resultados = backup.fazer_backups(diretorio, compactar=compactar, manter=manter, paginas=paginas)
+    for resultado in resultados:
+        click.echo(
+            f"[{resultado['banco']}] {resultado['arquivo']}: {resultado['bytes']} bytes "
+            f"(banco {resultado['bytes_banco']}) em {resultado['duracao_s']}s, {resultado['mb_por_s']} MB/s, "
+            f"{resultado['passos']} passos, {resultado['esperas_lock']} esperas de lock "
+            f"({resultado['espera_lock_s']}s)"
+        )
+        for removido in resultado["removidos"]:
+            click.echo(f"  removido {removido}")
+
+
+@click.command("backup-verify")
+@click.argument("arquivos", nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+@with_appcontext
+def backup_verify_comando(arquivos):
+    """Confere sha256 e integridade de backups."""
+    invalidos = 0
+    for arquivo in arquivos:
+        try:
+            resumo = backup.verificar(arquivo)
+        except backup.BackupInvalido as erro:
+            invalidos += 1
+            click.echo(f"{arquivo}: INVALIDO ({erro})", err=True)
+            continue
+        soma = "sha256 ok" if resumo["sha256"] else "sem .sha256"
+        click.echo(f"{arquivo}: ok, {soma}, schema {resumo['versao']}, "
+                   f"{resumo['livros']} livros, {resumo['usuarios']} usuarios")
+    if invalidos:
+        sys.exit(1)
+
+
+@click.command("backup-restore")
+@click.argument("arquivo", type=click.Path(exists=True, dir_okay=False))
+@click.option("--unidade", type=click.Choice(sorted(database.UNIDADES)),
+              help="Restaura o banco da unidade em vez do principal (unidades existem so com o SQLite).")
+@click.option("--sim", is_flag=True, help="Nao pede confirmacao.")
+@with_appcontext
+def backup_restore_comando(arquivo, unidade, sim):
+    """Verifica um backup e o restaura sobre o banco em uso."""
+    with database.usando_unidade(unidade):
+        caminho = database.caminho_atual()
+        if not sim:
+            click.confirm(f"Substituir todo o conteudo de {caminho} por {arquivo}?", abort=True)
+
+        try:
+            resumo = backup.restaurar(arquivo, caminho)
+        except backup.BackupInvalido as erro:
+            raise click.ClickException(f"Backup invalido: {erro}") from None
+
+        database.fechar_pools()
+        click.echo(f"{caminho} restaurado em {resumo['duracao_s']}s: schema {resumo['versao']}, "
+                   f"{resumo['livros']} livros, {resumo['usuarios']} usuarios.")
+        aplicadas = database.criar_tabelas()
+        if aplicadas:
+            click.echo(f"Migracoes aplicadas: {', '.join(map(str, aplicadas))}.")
+
+
+def registrar_comandos(app):
+    app.cli.add_command(init_db_comando)
+    app.cli.add_command(migrar_senhas_comando)
+    app.cli.add_command(criar_admin_comando)
+    app.cli.add_command(importar_livros_comando)
+    app.cli.add_command(exportar_comando)
+    app.cli.add_command(gerar_dados_comando)
+    app.cli.add_command(bench_comando)
+    app.cli.add_command(rebuild_stats_comando)
+    app.cli.add_command(backup_comando)
+    app.cli.add_command(backup_verify_comando)
+    app.cli.add_command(backup_restore_comando)
@@ -1,17 +1,437 @@
 import os
+import queue
+import random
 import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from flask import g, has_app_context, request
+
+from metricas import instrumentar, varredura_intencional
+from models import chave_livro
 
 DATABASE = os.getenv("DATABASE_PATH", "biblioteca.db")
 
-def conectar():
-    conn = sqlite3.connect(DATABASE)
+
+def _ler_unidades(valor):
+    # "centro=/dados/centro.db,norte=/dados/norte.db"
+    unidades = {}
+    for item in valor.split(","):
+        if item.strip():
+            nome, _, caminho = item.partition("=")
+            unidades[nome.strip().lower()] = caminho.strip()
+    return unidades
+
+
+# Unidades (filiais) da biblioteca, cada uma com o proprio arquivo SQLite,
+# pool e migracoes: escritas de uma unidade nao disputam o lock de outra.
+# Sem UNIDADES tudo usa DATABASE_PATH.
+UNIDADES = _ler_unidades(os.getenv("UNIDADES", ""))
+
+_unidade_atual = ContextVar("unidade_atual", default=None)
+
+POOL_TAMANHO = int(os.getenv("DATABASE_POOL_SIZE", "5"))
+POOL_TIMEOUT = float(os.getenv("DATABASE_POOL_TIMEOUT", "10"))
+
+BUSY_TIMEOUT_MS = int(os.getenv("DATABASE_BUSY_TIMEOUT_MS", "5000"))
+CACHE_SIZE_KIB = int(os.getenv("DATABASE_CACHE_SIZE_KIB", "8192"))
+MMAP_SIZE = int(os.getenv("DATABASE_MMAP_SIZE", str(64 * 1024 * 1024)))
+
+# Novas tentativas quando o banco segue travado mesmo depois do busy_timeout.
+TENTATIVAS_ESCRITA = int(os.getenv("DATABASE_WRITE_RETRIES", "5"))
+ESPERA_ESCRITA = float(os.getenv("DATABASE_WRITE_BACKOFF", "0.05"))
+
+
+class ConexaoPool(sqlite3.Connection):
+    # close() devolve a conexao ao pool em vez de fecha-la; dentro de um
+    # request a conexao so e liberada no teardown.
+    _pool = None
+    _emprestada = False
+    _do_request = False
+
+    def close(self):
+        if self._do_request:
+            return
+        if self._pool is None:
+            sqlite3.Connection.close(self)
+        elif self._emprestada:
+            self._pool.devolver(self)
+
+    def fechar_de_verdade(self):
+        self._pool = None
+        self._do_request = False
+        sqlite3.Connection.close(self)
+
+
+def _configurar_conexao(conn):
     conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+    conn.execute(f"PRAGMA cache_size = -{CACHE_SIZE_KIB}")
+    conn.execute(f"PRAGMA mmap_size = {MMAP_SIZE}")
+    instrumentar(conn)
+
+
+class PoolConexoes:
+    def __init__(self, caminho, tamanho=POOL_TAMANHO, timeout=POOL_TIMEOUT):
+        self.caminho = caminho
+        self.tamanho = max(1, tamanho)
+        self.timeout = timeout
+        self.pid = os.getpid()
+        self._livres = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._abertas = 0
+        self._em_uso = 0
+        self._checkouts = 0
+        self._espera_total = 0.0
+        self._espera_max = 0.0
+
+    def _abrir(self):
+        conn = sqlite3.connect(self.caminho, factory=ConexaoPool, check_same_thread=False)
+        _configurar_conexao(conn)
+        conn._pool = self
+        return conn
+
+    def obter(self):
+        inicio = time.perf_counter()
+        conn = None
+        try:
+            conn = self._livres.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                pode_abrir = self._abertas < self.tamanho
+                if pode_abrir:
+                    self._abertas += 1
+            if pode_abrir:
+                try:
+                    conn = self._abrir()
+                except Exception:
+                    with self._lock:
+                        self._abertas -= 1
+                    raise
+            else:
+                try:
+                    conn = self._livres.get(timeout=self.timeout)
+                except queue.Empty:
+                    raise sqlite3.OperationalError("Pool de conexoes esgotado") from None
+
+        conn._emprestada = True
+        espera = time.perf_counter() - inicio
+        with self._lock:
+            self._em_uso += 1
+            self._checkouts += 1
+            self._espera_total += espera
+            self._espera_max = max(self._espera_max, espera)
+        return conn
+
+    def devolver(self, conn):
+        conn._emprestada = False
+        if conn.in_transaction:
+            conn.rollback()
+        with self._lock:
+            self._em_uso -= 1
+        self._livres.put(conn)
+
+    def fechar(self):
+        while True:
+            try:
+                conn = self._livres.get_nowait()
+            except queue.Empty:
+                break
+            conn.fechar_de_verdade()
+            with self._lock:
+                self._abertas -= 1
+
+    def estatisticas(self):
+        with self._lock:
+            checkouts = self._checkouts
+            return {
+                "caminho": self.caminho,
+                "tamanho": self.tamanho,
+                "abertas": self._abertas,
+                "em_uso": self._em_uso,
+                "livres": self._abertas - self._em_uso,
+                "checkouts": checkouts,
+                "espera_total_ms": self._espera_total * 1000,
+                "espera_media_ms": (self._espera_total / checkouts * 1000) if checkouts else 0.0,
+                "espera_max_ms": self._espera_max * 1000,
+            }
+
+
+_pools = {}
+_pools_herdados = []
+_pools_lock = threading.Lock()
+
+
+def unidade_atual():
+    return _unidade_atual.get()
+
+
+def caminho_atual():
+    nome = _unidade_atual.get()
+    return UNIDADES[nome] if nome else DATABASE
+
+
+def selecionar_unidade(nome):
+    # Devolve o token para desfazer a selecao com liberar_unidade().
+    if nome is not None and nome not in UNIDADES:
+        raise KeyError(f"Unidade desconhecida: {nome}")
+    return _unidade_atual.set(nome)
+
+
+def liberar_unidade(token):
+    _unidade_atual.reset(token)
+
+
+@contextmanager
+def usando_unidade(nome):
+    token = selecionar_unidade(nome)
+    try:
+        yield
+    finally:
+        liberar_unidade(token)
+
+
+def obter_pool(caminho=None):
+    caminho = caminho or caminho_atual()
+    with _pools_lock:
+        pool = _pools.get(caminho)
+        # Depois de um fork (gunicorn --preload) as conexoes herdadas nao
+        # podem ser reaproveitadas pelo processo filho. O pool antigo fica
+        # referenciado para que o coletor de lixo nao feche, no filho, os
+        # descritores (e locks POSIX) que ainda pertencem ao processo pai.
+        if pool is None or pool.pid != os.getpid():
+            if pool is not None:
+                _pools_herdados.append(pool)
+            pool = PoolConexoes(caminho)
+            _pools[caminho] = pool
+        return pool
+
+
+def fechar_pools():
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+        _indices_fts.clear()
+    for pool in pools:
+        if pool.pid == os.getpid():
+            pool.fechar()
+
+
+def estatisticas_pool():
+    return obter_pool().estatisticas()
+
+
+def conectar():
+    if not has_app_context():
+        return obter_pool().obter()
+
+    conn = g.get("_conexao_db")
+    if conn is not None and conn._pool is not None and conn._pool.caminho == caminho_atual():
+        return conn
+
+    if conn is not None:
+        liberar_conexao()
+
+    conn = obter_pool().obter()
+    conn._do_request = True
+    g._conexao_db = conn
     return conn
 
-def criar_tabelas():
-    conn = conectar()
-    cursor = conn.cursor()
 
+def conectar_avulsa():
+    # Conexao do pool que nao fica presa ao request: para respostas em
+    # streaming, que continuam lendo depois do teardown. Deve ser devolvida
+    # com close() pelo proprio chamador.
+    return obter_pool().obter()
+
+
+def liberar_conexao(exc=None):
+    conn = g.pop("_conexao_db", None)
+    if conn is None:
+        return
+    conn._do_request = False
+    conn.close()
+
+
+def unidade_do_host(host):
+    # "norte.biblioteca.exemplo" -> "norte"; hosts sem subdominio de unidade
+    # usam DATABASE_PATH.
+    subdominio = host.split(":", 1)[0].split(".", 1)[0].lower()
+    return subdominio if subdominio in UNIDADES else None
+
+
+def _selecionar_unidade_do_request():
+    if UNIDADES:
+        g._unidade_token = selecionar_unidade(unidade_do_host(request.host))
+
+
+def _liberar_unidade_do_request(exc=None):
+    token = g.pop("_unidade_token", None)
+    if token is not None:
+        liberar_unidade(token)
+
+
+def init_app(app):
+    app.before_request(_selecionar_unidade_do_request)
+    app.teardown_request(_liberar_unidade_do_request)
+    app.teardown_appcontext(liberar_conexao)
+
+
+def _banco_ocupado(erro):
+    mensagem = str(erro)
+    return "locked" in mensagem or "busy" in mensagem
+
+
+def escrever(conn, operacao, tentativas=None, espera=None):
+    # Executa operacao(cursor) em BEGIN IMMEDIATE: o lock de escrita e obtido
+    # antes da primeira leitura, entao nao ha upgrade de lock no meio da
+    # transacao nem outro worker alterando a linha entre o teste e o UPDATE.
+    # Se o banco continuar ocupado, repete com espera exponencial e jitter.
+    tentativas = tentativas or TENTATIVAS_ESCRITA
+    espera = ESPERA_ESCRITA if espera is None else espera
+
+    for tentativa in range(tentativas):
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                resultado = operacao(conn.cursor())
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+            return resultado
+        except sqlite3.OperationalError as erro:
+            if not _banco_ocupado(erro) or tentativa == tentativas - 1:
+                raise
+            time.sleep(espera * 2 ** tentativa * random.uniform(0.5, 1.5))
+
+
+_fts5 = None
+
+
+def fts5_disponivel():
+    global _fts5
+    if _fts5 is None:
+        conn = sqlite3.connect(":memory:")
+        try:
+            conn.execute("CREATE VIRTUAL TABLE teste_fts USING fts5(campo)")
+            _fts5 = True
+        except sqlite3.OperationalError:
+            _fts5 = False
+        finally:
+            conn.close()
+    return _fts5
+
+
+_indices_fts = {}
+
+
+def indice_fts(conn, tabela):
+    # A build ter FTS5 nao basta: o banco pode ter sido criado ou restaurado
+    # por uma build sem ele. Guarda, por banco, se a tabela existe nele.
+    if not fts5_disponivel():
+        return False
+    chave = (caminho_atual(), tabela)
+    existe = _indices_fts.get(chave)
+    if existe is None:
+        with varredura_intencional():
+            existe = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (tabela,)
+            ).fetchone() is not None
+        _indices_fts[chave] = existe
+    return existe
+
+
+def _criar_indice_busca(cursor):
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'livros_fts'")
+    if cursor.fetchone():
+        return
+
+    # Indice externo (content='livros'): guarda apenas os tokens; remove_diacritics
+    # faz "acao" encontrar "ação".
+    cursor.execute("""
+        CREATE VIRTUAL TABLE livros_fts USING fts5(
+            titulo,
+            autor,
+            content='livros',
+            content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2',
+            prefix='2 3'
+        )
+    """)
+
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS livros_fts_ai AFTER INSERT ON livros BEGIN
+            INSERT INTO livros_fts (rowid, titulo, autor)
+            VALUES (new.id, new.titulo, new.autor);
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS livros_fts_ad AFTER DELETE ON livros BEGIN
+            INSERT INTO livros_fts (livros_fts, rowid, titulo, autor)
+            VALUES ('delete', old.id, old.titulo, old.autor);
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS livros_fts_au AFTER UPDATE OF titulo, autor ON livros BEGIN
+            INSERT INTO livros_fts (livros_fts, rowid, titulo, autor)
+            VALUES ('delete', old.id, old.titulo, old.autor);
+            INSERT INTO livros_fts (rowid, titulo, autor)
+            VALUES (new.id, new.titulo, new.autor);
+        END
+    """)
+
+    # Bancos existentes ja possuem livros cadastrados antes do indice.
+    cursor.execute("INSERT INTO livros_fts (livros_fts) VALUES ('rebuild')")
+
+
+def _criar_indice_busca_usuarios(cursor):
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'usuarios_fts'")
+    if cursor.fetchone():
+        return
+
+    # Mesmo esquema do indice de livros; o tokenizador separa o email em
+    # partes, entao "maria@" ou "gmail" tambem encontram o usuario.
+    cursor.execute("""
+        CREATE VIRTUAL TABLE usuarios_fts USING fts5(
+            nome,
+            email,
+            content='usuarios',
+            content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2',
+            prefix='2 3'
+        )
+    """)
+
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS usuarios_fts_ai AFTER INSERT ON usuarios BEGIN
+            INSERT INTO usuarios_fts (rowid, nome, email)
+            VALUES (new.id, new.nome, new.email);
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS usuarios_fts_ad AFTER DELETE ON usuarios BEGIN
+            INSERT INTO usuarios_fts (usuarios_fts, rowid, nome, email)
+            VALUES ('delete', old.id, old.nome, old.email);
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS usuarios_fts_au AFTER UPDATE OF nome, email ON usuarios BEGIN
+            INSERT INTO usuarios_fts (usuarios_fts, rowid, nome, email)
+            VALUES ('delete', old.id, old.nome, old.email);
+            INSERT INTO usuarios_fts (rowid, nome, email)
+            VALUES (new.id, new.nome, new.email);
+        END
+    """)
+
+    cursor.execute("INSERT INTO usuarios_fts (usuarios_fts) VALUES ('rebuild')")
+
+
+def _migracao_tabelas_base(cursor):
     # ==============================
     # TABELA USUÁRIOS
     # ==============================
@@ -41,5 +461,502 @@ def criar_tabelas():
         )
     """)
 
-    conn.commit()
+
+def _migracao_busca_fts(cursor):
+    if fts5_disponivel():
+        _criar_indice_busca(cursor)
+
+
+def _migracao_indices(cursor):
+    # Livros emprestados de um usuario (usuario_id = ? AND disponivel = 0).
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_livros_usuario_disponivel
+        ON livros (usuario_id, disponivel)
+    """)
+
+    # Listagem/busca de usuarios ordenada por nome.
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_usuarios_nome
+        ON usuarios (nome COLLATE NOCASE)
+    """)
+
+    # Seletor do emprestimo (tipo = 'usuario' ORDER BY nome) e contagem de
+    # admins; cobre id e nome sem visitar a tabela.
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_usuarios_tipo_nome
+        ON usuarios (tipo, nome COLLATE NOCASE)
+    """)
+
+
+def _migracao_versoes(cursor):
+    # Contadores incrementados por triggers; permitem que cada processo
+    # descubra barato se outro alterou os dados que ele mantem em cache.
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS versoes (
+            nome TEXT PRIMARY KEY,
+            valor INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+    """)
+    cursor.execute("INSERT OR IGNORE INTO versoes (nome, valor) VALUES ('usuarios', 0)")
+
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS usuarios_versao_au AFTER UPDATE OF nome, email, tipo ON usuarios BEGIN
+            UPDATE versoes SET valor = valor + 1 WHERE nome = 'usuarios';
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS usuarios_versao_ad AFTER DELETE ON usuarios BEGIN
+            UPDATE versoes SET valor = valor + 1 WHERE nome = 'usuarios';
+        END
+    """)
+
+
+def _migracao_chave_livros(cursor):
+    # Chave normalizada (titulo|autor|ano sem acentos nem caixa) usada para
+    # deduplicar importacoes em massa. Nao e UNIQUE: o acervo pode ter varios
+    # exemplares do mesmo livro cadastrados pelo formulario.
+    colunas = {linha[1] for linha in cursor.execute("PRAGMA table_info(livros)")}
+    if "chave" not in colunas:
+        cursor.execute("ALTER TABLE livros ADD COLUMN chave TEXT")
+
+    ultimo_id = 0
+    while True:
+        cursor.execute(
+            "SELECT id, titulo, autor, ano FROM livros WHERE id > ? ORDER BY id LIMIT 1000",
+            (ultimo_id,),
+        )
+        linhas = cursor.fetchall()
+        if not linhas:
+            break
+        cursor.executemany(
+            "UPDATE livros SET chave = ? WHERE id = ?",
+            [(chave_livro(titulo, autor, ano), id_livro) for id_livro, titulo, autor, ano in linhas],
+        )
+        ultimo_id = linhas[-1][0]
+
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_livros_chave ON livros (chave)")
+
+
+def _migracao_versao_catalogo(cursor):
+    # Qualquer escrita em livros, inclusive de fora do app, avanca a versao
+    # do catalogo; ETags e caches de leitura derivam dela.
+    cursor.execute("INSERT OR IGNORE INTO versoes (nome, valor) VALUES ('catalogo', 0)")
+    for sufixo, evento in (("ai", "INSERT"), ("au", "UPDATE"), ("ad", "DELETE")):
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS livros_versao_{sufixo} AFTER {evento} ON livros BEGIN
+                UPDATE versoes SET valor = valor + 1 WHERE nome = 'catalogo';
+            END
+        """)
+
+
+def _migracao_emprestimos(cursor):
+    # Historico de emprestimos com datas ISO (ordenaveis e indexaveis). Em
+    # livros continuam disponivel/usuario_id/data_devolucao como estado atual.
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS emprestimos (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            livro_id INTEGER NOT NULL,
+            usuario_id INTEGER NOT NULL,
+            emprestado_em TEXT NOT NULL,
+            devolucao_prevista TEXT NOT NULL,
+            devolvido_em TEXT,
+            FOREIGN KEY (livro_id) REFERENCES livros(id),
+            FOREIGN KEY (usuario_id) REFERENCES usuarios(id)
+        )
+    """)
+
+    # Emprestimos em aberto por data prevista: o relatorio de atrasos e uma
+    # varredura de intervalo neste indice parcial, que so cresce com os
+    # emprestimos ativos, nao com o historico.
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_emprestimos_abertos_devolucao
+        ON emprestimos (devolucao_prevista)
+        WHERE devolvido_em IS NULL
+    """)
+    # No maximo um emprestimo aberto por livro.
+    cursor.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_emprestimos_livro_aberto
+        ON emprestimos (livro_id)
+        WHERE devolvido_em IS NULL
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_emprestimos_usuario
+        ON emprestimos (usuario_id, emprestado_em)
+    """)
+
+    # "dd/mm/aaaa" -> "aaaa-mm-dd"
+    cursor.execute("""
+        UPDATE livros
+        SET data_devolucao = substr(data_devolucao, 7, 4) || '-' || substr(data_devolucao, 4, 2)
+                             || '-' || substr(data_devolucao, 1, 2)
+        WHERE data_devolucao LIKE '__/__/____'
+    """)
+    # Emprestimos ativos de antes da tabela; a data de saida e estimada pelo
+    # prazo padrao.
+    cursor.execute("""
+        INSERT INTO emprestimos (livro_id, usuario_id, emprestado_em, devolucao_prevista)
+        SELECT id, usuario_id,
+               date(COALESCE(data_devolucao, date('now')), '-7 days'),
+               COALESCE(data_devolucao, date('now'))
+        FROM livros
+        WHERE disponivel = 0
+        AND usuario_id IS NOT NULL
+        AND NOT EXISTS (
+            SELECT 1 FROM emprestimos
+            WHERE emprestimos.livro_id = livros.id AND emprestimos.devolvido_em IS NULL
+        )
+    """)
+
+
+def _migracao_busca_usuarios(cursor):
+    if fts5_disponivel():
+        _criar_indice_busca_usuarios(cursor)
+
+
+# Contadores gerais mantidos pelas triggers de estatisticas.
+CONTADORES_ESTATISTICAS = ("livros", "emprestados", "leitores", "leitores_ativos", "emprestimos")
+
+
+def recalcular_estatisticas(cursor):
+    # Refaz as tabelas de resumo a partir de livros, usuarios e emprestimos.
+    # Usada pela migracao e pelo comando rebuild-stats; le as tabelas inteiras.
+    for tabela in ("estatisticas", "estatisticas_autores", "estatisticas_dias",
+                   "estatisticas_leitores", "estatisticas_vencimentos"):
+        cursor.execute(f"DELETE FROM {tabela}")
+
+    cursor.executemany(
+        "INSERT INTO estatisticas (nome, valor) VALUES (?, 0)",
+        [(nome,) for nome in CONTADORES_ESTATISTICAS],
+    )
+    cursor.execute("""
+        UPDATE estatisticas SET valor = CASE nome
+            WHEN 'livros' THEN (SELECT COUNT(*) FROM livros)
+            WHEN 'emprestados' THEN (SELECT COUNT(*) FROM livros WHERE disponivel = 0)
+            WHEN 'leitores' THEN (SELECT COUNT(*) FROM usuarios WHERE tipo = 'usuario')
+            WHEN 'leitores_ativos' THEN (
+                SELECT COUNT(DISTINCT usuario_id) FROM emprestimos WHERE devolvido_em IS NULL
+            )
+            WHEN 'emprestimos' THEN (SELECT COUNT(*) FROM emprestimos)
+        END
+    """)
+
+    cursor.execute("""
+        INSERT INTO estatisticas_autores (autor, livros, emprestimos)
+        -- Emprestimos de um autor = emprestimos dos livros que hoje sao dele.
+        SELECT autor, SUM(livros), SUM(emprestimos) FROM (
+            SELECT autor, COUNT(*) AS livros, 0 AS emprestimos FROM livros GROUP BY autor
+            UNION ALL
+            SELECT livros.autor, 0, COUNT(*) FROM emprestimos
+            JOIN livros ON livros.id = emprestimos.livro_id
+            GROUP BY livros.autor
+        )
+        GROUP BY autor
+    """)
+    cursor.execute("""
+        INSERT INTO estatisticas_dias (dia, emprestimos, devolucoes)
+        SELECT dia, SUM(emprestimos), SUM(devolucoes) FROM (
+            SELECT date(emprestado_em) AS dia, COUNT(*) AS emprestimos, 0 AS devolucoes
+            FROM emprestimos GROUP BY dia
+            UNION ALL
+            SELECT date(devolvido_em), 0, COUNT(*) FROM emprestimos
+            WHERE devolvido_em IS NOT NULL GROUP BY date(devolvido_em)
+        )
+        GROUP BY dia
+    """)
+    cursor.execute("""
+        INSERT INTO estatisticas_leitores (usuario_id, abertos)
+        SELECT usuario_id, COUNT(*) FROM emprestimos
+        WHERE devolvido_em IS NULL
+        GROUP BY usuario_id
+    """)
+    cursor.execute("""
+        INSERT INTO estatisticas_vencimentos (dia, abertos)
+        SELECT devolucao_prevista, COUNT(*) FROM emprestimos
+        WHERE devolvido_em IS NULL
+        GROUP BY devolucao_prevista
+    """)
+
+
+def _migracao_estatisticas(cursor):
+    # Tabelas de resumo do painel de estatisticas, atualizadas por triggers
+    # a cada escrita em livros, usuarios e emprestimos. O painel so le estas
+    # tabelas, nunca as de origem.
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS estatisticas (
+            nome TEXT PRIMARY KEY,
+            valor INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS estatisticas_autores (
+            autor TEXT PRIMARY KEY,
+            livros INTEGER NOT NULL DEFAULT 0,
+            emprestimos INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_estatisticas_autores_emprestimos
+        ON estatisticas_autores (emprestimos)
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS estatisticas_dias (
+            dia TEXT PRIMARY KEY,
+            emprestimos INTEGER NOT NULL DEFAULT 0,
+            devolucoes INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+    """)
+    # Emprestimos em aberto por leitor (para "leitores ativos") e por data
+    # prevista (atrasados = soma dos dias anteriores a hoje).
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS estatisticas_leitores (
+            usuario_id INTEGER PRIMARY KEY,
+            abertos INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS estatisticas_vencimentos (
+            dia TEXT PRIMARY KEY,
+            abertos INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+    """)
+
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS livros_estatisticas_ai AFTER INSERT ON livros BEGIN
+            UPDATE estatisticas SET valor = valor + 1 WHERE nome = 'livros';
+            UPDATE estatisticas SET valor = valor + 1 WHERE nome = 'emprestados' AND new.disponivel = 0;
+            INSERT INTO estatisticas_autores (autor, livros) VALUES (new.autor, 1)
+            ON CONFLICT (autor) DO UPDATE SET livros = livros + 1;
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS livros_estatisticas_ad AFTER DELETE ON livros BEGIN
+            UPDATE estatisticas SET valor = valor - 1 WHERE nome = 'livros';
+            UPDATE estatisticas SET valor = valor - 1 WHERE nome = 'emprestados' AND old.disponivel = 0;
+            UPDATE estatisticas_autores SET livros = livros - 1 WHERE autor = old.autor;
+            DELETE FROM estatisticas_autores WHERE autor = old.autor AND livros = 0 AND emprestimos = 0;
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS livros_estatisticas_disponivel AFTER UPDATE OF disponivel ON livros
+        WHEN (old.disponivel = 0) != (new.disponivel = 0) BEGIN
+            UPDATE estatisticas
+            SET valor = valor + CASE WHEN new.disponivel = 0 THEN 1 ELSE -1 END
+            WHERE nome = 'emprestados';
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS livros_estatisticas_autor AFTER UPDATE OF autor ON livros
+        WHEN old.autor != new.autor BEGIN
+            UPDATE estatisticas_autores SET livros = livros - 1 WHERE autor = old.autor;
+            DELETE FROM estatisticas_autores WHERE autor = old.autor AND livros = 0 AND emprestimos = 0;
+            INSERT INTO estatisticas_autores (autor, livros) VALUES (new.autor, 1)
+            ON CONFLICT (autor) DO UPDATE SET livros = livros + 1;
+        END
+    """)
+
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS usuarios_estatisticas_ai AFTER INSERT ON usuarios
+        WHEN new.tipo = 'usuario' BEGIN
+            UPDATE estatisticas SET valor = valor + 1 WHERE nome = 'leitores';
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS usuarios_estatisticas_ad AFTER DELETE ON usuarios
+        WHEN old.tipo = 'usuario' BEGIN
+            UPDATE estatisticas SET valor = valor - 1 WHERE nome = 'leitores';
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS usuarios_estatisticas_tipo AFTER UPDATE OF tipo ON usuarios
+        WHEN old.tipo != new.tipo BEGIN
+            UPDATE estatisticas
+            SET valor = valor + CASE WHEN new.tipo = 'usuario' THEN 1 ELSE -1 END
+            WHERE nome = 'leitores';
+        END
+    """)
+
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS emprestimos_estatisticas_ai AFTER INSERT ON emprestimos BEGIN
+            UPDATE estatisticas SET valor = valor + 1 WHERE nome = 'emprestimos';
+            INSERT INTO estatisticas_dias (dia, emprestimos) VALUES (date(new.emprestado_em), 1)
+            ON CONFLICT (dia) DO UPDATE SET emprestimos = emprestimos + 1;
+            UPDATE estatisticas_autores SET emprestimos = emprestimos + 1
+            WHERE autor = (SELECT autor FROM livros WHERE id = new.livro_id);
+
+            INSERT INTO estatisticas_leitores (usuario_id, abertos)
+            SELECT new.usuario_id, 1 WHERE new.devolvido_em IS NULL
+            ON CONFLICT (usuario_id) DO UPDATE SET abertos = abertos + 1;
+            UPDATE estatisticas SET valor = valor + 1
+            WHERE nome = 'leitores_ativos' AND new.devolvido_em IS NULL
+            AND (SELECT abertos FROM estatisticas_leitores WHERE usuario_id = new.usuario_id) = 1;
+
+            INSERT INTO estatisticas_vencimentos (dia, abertos)
+            SELECT new.devolucao_prevista, 1 WHERE new.devolvido_em IS NULL
+            ON CONFLICT (dia) DO UPDATE SET abertos = abertos + 1;
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS emprestimos_estatisticas_devolucao AFTER UPDATE OF devolvido_em ON emprestimos
+        WHEN old.devolvido_em IS NULL AND new.devolvido_em IS NOT NULL BEGIN
+            INSERT INTO estatisticas_dias (dia, devolucoes) VALUES (date(new.devolvido_em), 1)
+            ON CONFLICT (dia) DO UPDATE SET devolucoes = devolucoes + 1;
+
+            UPDATE estatisticas_leitores SET abertos = abertos - 1 WHERE usuario_id = old.usuario_id;
+            UPDATE estatisticas SET valor = valor - 1
+            WHERE nome = 'leitores_ativos'
+            AND (SELECT abertos FROM estatisticas_leitores WHERE usuario_id = old.usuario_id) = 0;
+            DELETE FROM estatisticas_leitores WHERE usuario_id = old.usuario_id AND abertos = 0;
+
+            UPDATE estatisticas_vencimentos SET abertos = abertos - 1 WHERE dia = old.devolucao_prevista;
+            DELETE FROM estatisticas_vencimentos WHERE dia = old.devolucao_prevista AND abertos = 0;
+        END
+    """)
+
+    recalcular_estatisticas(cursor)
+
+
+def _migracao_limites(cursor):
+    # Baldes de fichas do limitador de tentativas de login/recuperacao de
+    # senha. Fica no banco para ser compartilhado entre os workers.
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS limites_tentativas (
+            chave TEXT PRIMARY KEY,
+            fichas REAL NOT NULL,
+            atualizado_em REAL NOT NULL
+        ) WITHOUT ROWID
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_limites_tentativas_atualizado
+        ON limites_tentativas (atualizado_em)
+    """)
+
+
+def _migracao_estatisticas_autores(cursor):
+    # O ranking de autores conta os emprestimos dos livros que hoje sao de
+    # cada autor, como o recalculo: mudar o autor leva o historico do livro
+    # junto, e remover o livro tira o historico dele do ranking.
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_emprestimos_livro
+        ON emprestimos (livro_id)
+    """)
+    cursor.execute("DROP TRIGGER IF EXISTS livros_estatisticas_ad")
+    cursor.execute("""
+        CREATE TRIGGER livros_estatisticas_ad AFTER DELETE ON livros BEGIN
+            UPDATE estatisticas SET valor = valor - 1 WHERE nome = 'livros';
+            UPDATE estatisticas SET valor = valor - 1 WHERE nome = 'emprestados' AND old.disponivel = 0;
+            UPDATE estatisticas_autores
+            SET livros = livros - 1,
+                emprestimos = emprestimos - (SELECT COUNT(*) FROM emprestimos WHERE livro_id = old.id)
+            WHERE autor = old.autor;
+            DELETE FROM estatisticas_autores WHERE autor = old.autor AND livros = 0 AND emprestimos = 0;
+        END
+    """)
+    cursor.execute("DROP TRIGGER IF EXISTS livros_estatisticas_autor")
+    cursor.execute("""
+        CREATE TRIGGER livros_estatisticas_autor AFTER UPDATE OF autor ON livros
+        WHEN old.autor != new.autor BEGIN
+            UPDATE estatisticas_autores
+            SET livros = livros - 1,
+                emprestimos = emprestimos - (SELECT COUNT(*) FROM emprestimos WHERE livro_id = old.id)
+            WHERE autor = old.autor;
+            DELETE FROM estatisticas_autores WHERE autor = old.autor AND livros = 0 AND emprestimos = 0;
+            INSERT INTO estatisticas_autores (autor, livros, emprestimos)
+            VALUES (new.autor, 1, (SELECT COUNT(*) FROM emprestimos WHERE livro_id = new.id))
+            ON CONFLICT (autor) DO UPDATE SET
+                livros = livros + 1,
+                emprestimos = emprestimos + excluded.emprestimos;
+        END
+    """)
+    recalcular_estatisticas(cursor)
+
+
+# Migracoes em ordem; o numero de cada uma e gravado em PRAGMA user_version.
+# Novas migracoes entram sempre no final, nunca alterando as ja publicadas.
+MIGRACOES = [
+    (1, _migracao_tabelas_base),
+    (2, _migracao_busca_fts),
+    (3, _migracao_indices),
+    (4, _migracao_versoes),
+    (5, _migracao_chave_livros),
+    (6, _migracao_versao_catalogo),
+    (7, _migracao_emprestimos),
+    (8, _migracao_busca_usuarios),
+    (9, _migracao_estatisticas),
+    (10, _migracao_limites),
+    (11, _migracao_estatisticas_autores),
+]
+VERSAO_SCHEMA = MIGRACOES[-1][0]
+
+
+def versao_schema(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def versao_schema_arquivo(caminho=None):
+    # Conexao avulsa, fora do pool: usada na inicializacao do app, antes de
+    # um possivel fork, sem deixar conexoes abertas para os workers herdarem.
+    caminho = caminho or DATABASE
+    if not os.path.exists(caminho):
+        return 0
+    conn = sqlite3.connect(caminho)
+    try:
+        return versao_schema(conn)
+    finally:
+        conn.close()
+
+
+def ler_versao(nome):
+    conn = conectar()
+    linha = conn.execute("SELECT valor FROM versoes WHERE nome = ?", (nome,)).fetchone()
     conn.close()
+    return linha["valor"] if linha else 0
+
+
+def migrar(conn):
+    aplicadas = []
+    for numero, migracao in MIGRACOES:
+        if numero <= versao_schema(conn):
+            continue
+
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Outro processo pode ter aplicado a migracao enquanto
+            # esperavamos o lock de escrita.
+            if numero > versao_schema(conn):
+                migracao(conn.cursor())
+                conn.execute(f"PRAGMA user_version = {numero}")
+                aplicadas.append(numero)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+    if aplicadas:
+        conn.execute("ANALYZE")
+        conn.commit()
+        _indices_fts.clear()
+    return aplicadas
+
+
+def criar_tabelas():
+    conn = conectar()
+    aplicadas = migrar(conn)
+    conn.close()
+    return aplicadas
+
+
+def criar_tabela_limites():
+    # Com DATABASE_BACKEND diferente de sqlite o banco local guarda so os
+    # baldes do limitador de tentativas; o resto do schema fica no backend.
+    conn = conectar()
+    escrever(conn, _migracao_limites)
+    conn.close()
+
+
+def criar_tabelas_unidades():
+    # Migra o banco de cada unidade; devolve {unidade: migracoes aplicadas}.
+    aplicadas = {}
+    for nome in UNIDADES:
+        with usando_unidade(nome):
+            aplicadas[nome] = criar_tabelas()
+    return aplicadas
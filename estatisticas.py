@@ -0,0 +1,131 @@
+from datetime import date, timedelta
+
+from database import CONTADORES_ESTATISTICAS, conectar, recalcular_estatisticas
+
+DIAS_PAINEL = 30
+LIMITE_AUTORES = 10
+
+# Tabela de resumo -> colunas, com a chave primaria primeiro.
+TABELAS = {
+    "estatisticas": ("nome", "valor"),
+    "estatisticas_autores": ("autor", "livros", "emprestimos"),
+    "estatisticas_dias": ("dia", "emprestimos", "devolucoes"),
+    "estatisticas_leitores": ("usuario_id", "abertos"),
+    "estatisticas_vencimentos": ("dia", "abertos"),
+}
+
+
+def ler_painel(hoje=None, dias=DIAS_PAINEL):
+    # Le apenas as tabelas de resumo, sempre por chave ou indice: o custo nao
+    # cresce com o acervo nem com o historico de emprestimos.
+    hoje = hoje or date.today()
+    inicio = (hoje - timedelta(days=dias - 1)).isoformat()
+
+    conn = conectar()
+    cursor = conn.cursor()
+
+    marcadores = ", ".join("?" for _ in CONTADORES_ESTATISTICAS)
+    cursor.execute(
+        f"SELECT nome, valor FROM estatisticas WHERE nome IN ({marcadores})",
+        CONTADORES_ESTATISTICAS,
+    )
+    contadores = dict.fromkeys(CONTADORES_ESTATISTICAS, 0)
+    contadores.update(cursor.fetchall())
+
+    cursor.execute("""
+        SELECT COALESCE(SUM(abertos), 0)
+        FROM estatisticas_vencimentos
+        WHERE dia < ?
+    """, (hoje.isoformat(),))
+    atrasados = cursor.fetchone()[0]
+
+    cursor.execute("""
+        SELECT autor, livros, emprestimos
+        FROM estatisticas_autores
+        WHERE emprestimos > 0
+        ORDER BY emprestimos DESC
+        LIMIT ?
+    """, (LIMITE_AUTORES,))
+    autores = [
+        {"autor": autor, "livros": livros, "emprestimos": emprestimos}
+        for autor, livros, emprestimos in cursor.fetchall()
+    ]
+
+    cursor.execute("""
+        SELECT dia, emprestimos, devolucoes
+        FROM estatisticas_dias
+        WHERE dia >= ?
+        ORDER BY dia
+    """, (inicio,))
+    por_dia = {dia: (emprestimos, devolucoes) for dia, emprestimos, devolucoes in cursor.fetchall()}
+
+    conn.close()
+
+    return montar_painel(contadores, atrasados, autores, por_dia, hoje, dias)
+
+
+def montar_painel(contadores, atrasados, autores, por_dia, hoje, dias):
+    # Parte comum aos backends: recebe o que foi lido das tabelas de resumo
+    # (por_dia = {dia: (emprestimos, devolucoes)}) e monta o painel.
+    # Dias sem movimento tambem aparecem, com zero.
+    movimento = []
+    for deslocamento in range(dias):
+        dia = (hoje - timedelta(days=dias - 1 - deslocamento)).isoformat()
+        emprestimos, devolucoes = por_dia.get(dia, (0, 0))
+        movimento.append({"dia": dia, "emprestimos": emprestimos, "devolucoes": devolucoes})
+
+    livros = contadores["livros"]
+    return {
+        "livros": livros,
+        "emprestados": contadores["emprestados"],
+        "disponiveis": livros - contadores["emprestados"],
+        "atrasados": atrasados,
+        "leitores": contadores["leitores"],
+        "leitores_ativos": contadores["leitores_ativos"],
+        "emprestimos_total": contadores["emprestimos"],
+        "ocupacao": round(contadores["emprestados"] / livros, 4) if livros else 0.0,
+        "autores": autores,
+        "movimento": movimento,
+    }
+
+
+def capturar(cursor):
+    retrato = {}
+    for tabela, colunas in TABELAS.items():
+        cursor.execute(f"SELECT {', '.join(colunas)} FROM {tabela}")
+        retrato[tabela] = {linha[0]: tuple(linha[1:]) for linha in cursor.fetchall()}
+    return retrato
+
+
+def divergencias(antes, depois):
+    encontradas = []
+    for tabela in TABELAS:
+        atual, correto = antes[tabela], depois[tabela]
+        for chave in sorted(atual.keys() | correto.keys(), key=str):
+            if atual.get(chave) != correto.get(chave):
+                encontradas.append((tabela, chave, atual.get(chave), correto.get(chave)))
+    return encontradas
+
+
+def reconstruir(verificar=False):
+    # Recalcula os resumos do zero e devolve as divergencias encontradas como
+    # (tabela, chave, valor_mantido, valor_recalculado). Com verificar=True
+    # so compara: a transacao e desfeita no fim.
+    conn = conectar()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            cursor = conn.cursor()
+            antes = capturar(cursor)
+            recalcular_estatisticas(cursor)
+            encontradas = divergencias(antes, capturar(cursor))
+        except BaseException:
+            conn.rollback()
+            raise
+        if verificar:
+            conn.rollback()
+        else:
+            conn.commit()
+        return encontradas
+    finally:
+        conn.close()
@@ -0,0 +1,74 @@
+import csv
+import io
+import json
+import zlib
+
+from repositorio import ler_em_lotes
+
+LOTE_EXPORTACAO = 1000
+FORMATOS = ("csv", "jsonl")
+
+_CONSULTA_BASE = """
+    SELECT livros.id, livros.titulo, livros.autor, livros.ano, livros.disponivel,
+           livros.usuario_id, usuarios.nome AS usuario_nome, livros.data_devolucao
+    FROM livros
+    LEFT JOIN usuarios ON usuarios.id = livros.usuario_id
+"""
+
+CONSULTAS = {
+    "livros": _CONSULTA_BASE + " ORDER BY livros.id",
+    "emprestimos": _CONSULTA_BASE + " WHERE livros.disponivel = 0 ORDER BY livros.id",
+}
+
+
+def _lotes(tipo):
+    # Colunas e depois blocos de linhas, lidos sob demanda pelo backend
+    # (cursor do SQLite ou cursor no servidor do PostgreSQL).
+    return ler_em_lotes(CONSULTAS[tipo], LOTE_EXPORTACAO)
+
+
+def gerar_csv(colunas, lotes):
+    buffer = io.StringIO()
+    escritor = csv.writer(buffer)
+
+    escritor.writerow(colunas)
+    for linhas in lotes:
+        escritor.writerows(linhas)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def gerar_jsonl(colunas, lotes):
+    for linhas in lotes:
+        yield "".join(json.dumps(dict(zip(colunas, linha)), ensure_ascii=False) + "\n" for linha in linhas)
+
+
+def _codificar(blocos):
+    for bloco in blocos:
+        yield bloco.encode("utf-8")
+
+
+def gerar(tipo, formato):
+    if tipo not in CONSULTAS:
+        raise ValueError(f"Exportacao desconhecida: {tipo!r}")
+
+    # A consulta comeca aqui, e nao no primeiro chunk: a resposta so e lida
+    # depois do teardown do request, quando a unidade do host ja foi
+    # liberada e a conexao seria aberta no banco principal.
+    lotes = _lotes(tipo)
+    colunas = next(lotes)
+    gerador = gerar_jsonl if formato == "jsonl" else gerar_csv
+    return _codificar(gerador(colunas, lotes))
+
+
+def comprimir(blocos):
+    # wbits=31 produz o formato gzip, bloco a bloco.
+    compressor = zlib.compressobj(wbits=31)
+    for bloco in blocos:
+        comprimido = compressor.compress(bloco)
+        if comprimido:
+            yield comprimido
+    yield compressor.flush()
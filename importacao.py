@@ -0,0 +1,113 @@
+import csv
+import json
+import time
+from datetime import datetime
+from itertools import islice
+
+from models import chave_livro
+from repositorio import inserir_livros_novos
+
+LOTE_IMPORTACAO = 1000
+LIMITE_ERROS = 100
+TAMANHO_MAX_CAMPO = 500
+
+FORMATOS = ("csv", "jsonl")
+
+
+def formato_por_nome(nome_arquivo):
+    nome = (nome_arquivo or "").lower()
+    if nome.endswith((".jsonl", ".ndjson", ".json")):
+        return "jsonl"
+    return "csv"
+
+
+def ler_csv(arquivo):
+    # DictReader le uma linha por vez; a linha 1 e o cabecalho.
+    for numero, dados in enumerate(csv.DictReader(arquivo), start=2):
+        yield numero, dados
+
+
+def ler_jsonl(arquivo):
+    for numero, linha in enumerate(arquivo, start=1):
+        if not linha.strip():
+            continue
+        try:
+            dados = json.loads(linha)
+        except json.JSONDecodeError as erro:
+            yield numero, ValueError(f"JSON invalido: {erro.msg}")
+            continue
+        if not isinstance(dados, dict):
+            yield numero, ValueError("Cada linha deve ser um objeto JSON")
+            continue
+        yield numero, dados
+
+
+def ler_linhas(arquivo, formato):
+    if formato == "jsonl":
+        return ler_jsonl(arquivo)
+    return ler_csv(arquivo)
+
+
+def validar_linha(dados):
+    if isinstance(dados, Exception):
+        raise dados
+
+    titulo = str(dados.get("titulo") or "").strip()
+    autor = str(dados.get("autor") or "").strip()
+    if not titulo:
+        raise ValueError("titulo obrigatorio")
+    if not autor:
+        raise ValueError("autor obrigatorio")
+    if len(titulo) > TAMANHO_MAX_CAMPO or len(autor) > TAMANHO_MAX_CAMPO:
+        raise ValueError(f"titulo e autor devem ter ate {TAMANHO_MAX_CAMPO} caracteres")
+
+    try:
+        ano = int(str(dados.get("ano", "")).strip())
+    except ValueError:
+        raise ValueError("ano deve ser um numero inteiro") from None
+    if not 0 < ano <= datetime.now().year + 1:
+        raise ValueError("ano fora do intervalo permitido")
+
+    return titulo, autor, ano
+
+
+def importar_livros(linhas, lote=LOTE_IMPORTACAO, progresso=None):
+    resultado = {
+        "lidas": 0,
+        "inseridas": 0,
+        "duplicadas": 0,
+        "invalidas": 0,
+        "erros": [],
+    }
+    inicio = time.perf_counter()
+
+    # Uma transacao por lote; livros ja cadastrados (mesma chave) sao
+    # ignorados pelo backend.
+    linhas = iter(linhas)
+    while True:
+        bloco = list(islice(linhas, lote))
+        if not bloco:
+            break
+
+        validas = []
+        for numero, dados in bloco:
+            try:
+                titulo, autor, ano = validar_linha(dados)
+            except ValueError as erro:
+                resultado["invalidas"] += 1
+                if len(resultado["erros"]) < LIMITE_ERROS:
+                    resultado["erros"].append((numero, str(erro)))
+                continue
+            validas.append((titulo, autor, ano, chave_livro(titulo, autor, ano)))
+
+        inseridas = inserir_livros_novos(validas) if validas else 0
+        resultado["lidas"] += len(bloco)
+        resultado["inseridas"] += inseridas
+        resultado["duplicadas"] += len(validas) - inseridas
+        if progresso:
+            progresso(resultado)
+
+    duracao = time.perf_counter() - inicio
+    resultado["duracao"] = duracao
+    resultado["linhas_por_segundo"] = resultado["lidas"] / duracao if duracao else 0.0
+    return resultado
@@ -0,0 +1,81 @@
+import math
+import os
+import random
+import time
+
+from database import conectar, escrever
+from metricas import medir
+
+# Balde de fichas por IP e por email, compartilhado entre login e
+# recuperacao de senha: cada chave comeca com TENTATIVAS fichas e recupera
+# TENTATIVAS a cada JANELA segundos. 0 tentativas desliga aquela chave.
+ATIVO = os.getenv("LIMITE_TENTATIVAS", "1") != "0"
+TENTATIVAS_IP = int(os.getenv("LIMITE_IP_TENTATIVAS", "20"))
+JANELA_IP = float(os.getenv("LIMITE_IP_JANELA", "60"))
+TENTATIVAS_EMAIL = int(os.getenv("LIMITE_EMAIL_TENTATIVAS", "5"))
+JANELA_EMAIL = float(os.getenv("LIMITE_EMAIL_JANELA", "300"))
+
+# Fracao das chamadas que tambem apaga baldes parados ha mais de
+# 2 janelas (ja cheios de novo).
+CHANCE_LIMPEZA = 0.01
+
+
+class LimiteExcedido(RuntimeError):
+    def __init__(self, espera):
+        super().__init__(f"Muitas tentativas; tente novamente em {espera}s.")
+        self.espera = espera
+
+
+# Recarrega o balde pelo tempo decorrido e consome uma ficha. Tentativas
+# negadas tambem consomem, com piso de -1: quem insiste acima do limite so
+# volta a passar depois de uma pausa.
+_CONSUMIR = """
+    INSERT INTO limites_tentativas (chave, fichas, atualizado_em)
+    VALUES (:chave, :capacidade - 1, :agora)
+    ON CONFLICT (chave) DO UPDATE SET
+        fichas = MAX(MIN(:capacidade, fichas + (excluded.atualizado_em - atualizado_em) * :taxa) - 1, -1),
+        atualizado_em = excluded.atualizado_em
+    RETURNING fichas
+"""
+
+
+def _baldes(ip, email):
+    if TENTATIVAS_IP > 0 and ip:
+        yield f"ip:{ip}", TENTATIVAS_IP, JANELA_IP
+    if TENTATIVAS_EMAIL > 0 and email:
+        yield f"email:{email}", TENTATIVAS_EMAIL, JANELA_EMAIL
+
+
+def verificar_tentativa(ip, email, agora=None):
+    # Chamada antes de qualquer consulta de usuario ou hash de senha; levanta
+    # LimiteExcedido com a espera sugerida (segundos) quando algum balde
+    # esta vazio.
+    baldes = list(_baldes(ip, email)) if ATIVO else []
+    if not baldes:
+        return
+    agora = time.time() if agora is None else agora
+
+    def operacao(cursor):
+        espera = 0
+        for chave, capacidade, janela in baldes:
+            taxa = capacidade / janela
+            cursor.execute(_CONSUMIR, {"chave": chave, "capacidade": capacidade, "agora": agora, "taxa": taxa})
+            fichas = cursor.fetchone()[0]
+            if fichas < 0:
+                espera = max(espera, math.ceil((1 - fichas) / taxa))
+        if random.random() < CHANCE_LIMPEZA:
+            cursor.execute(
+                "DELETE FROM limites_tentativas WHERE atualizado_em < ?",
+                (agora - 2 * max(JANELA_IP, JANELA_EMAIL),),
+            )
+        return espera
+
+    with medir("limite"):
+        conn = conectar()
+        try:
+            espera = escrever(conn, operacao)
+        finally:
+            conn.close()
+
+    if espera:
+        raise LimiteExcedido(espera)
@@ -0,0 +1,486 @@
+import atexit
+import glob
+import ipaddress
+import json
+import logging
+import os
+import re
+import secrets
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from types import MethodType
+
+from flask import Blueprint, Response, abort, g, has_request_context, request
+from flask.signals import before_render_template, template_rendered
+
+# Desligado por padrao: sem METRICAS=1 nenhum hook e registrado e as conexoes
+# ficam sem instrumentacao.
+ATIVO = os.getenv("METRICAS", "0") == "1"
+# Com varios workers, cada processo grava seus acumulados em
+# METRICAS_DIR/<pid>.json e o /metrics soma todos os arquivos. O diretorio
+# deve ser limpo a cada deploy (os contadores sao acumulados desde entao).
+DIRETORIO = os.getenv("METRICAS_DIR")
+# Sem METRICAS_TOKEN, o /metrics so responde a clientes locais (loopback).
+TOKEN = os.getenv("METRICAS_TOKEN")
+INTERVALO_GRAVACAO = float(os.getenv("METRICAS_INTERVALO", "1"))
+
+# Log de consultas lentas: instrucoes acima de CONSULTA_LENTA_MS vao para o
+# logger "biblioteca.consultas" com o plano de execucao.
+LENTA_MS = float(os.environ["CONSULTA_LENTA_MS"]) if os.getenv("CONSULTA_LENTA_MS") else None
+# Modo estrito (desenvolvimento/testes): falha o request que fizer varredura
+# de tabela sem indice ou mais de CONSULTAS_MAX_POR_REQUEST instrucoes.
+ESTRITO = os.getenv("CONSULTAS_ESTRITAS", "0") == "1"
+MAX_CONSULTAS = int(os.getenv("CONSULTAS_MAX_POR_REQUEST", "20"))
+
+log_consultas = logging.getLogger("biblioteca.consultas")
+
+FAIXAS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PARCIAIS = ("sql", "render", "hash", "limite")
+
+metricas_bp = Blueprint("metricas", __name__)
+
+
+class ConsultaProibida(AssertionError):
+    pass
+
+
+def _instrumentado():
+    return ATIVO or ESTRITO or LENTA_MS is not None
+
+
+class Registro:
+    # Acumulados do processo, por rota (endpoint do Flask).
+    def __init__(self):
+        self.rotas = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _nova_rota():
+        return {
+            "faixas": [0] * (len(FAIXAS) + 1),
+            "soma": 0.0,
+            "requests": 0,
+            "consultas": 0,
+            "sql": 0.0,
+            "render": 0.0,
+            "hash": 0.0,
+            "limite": 0.0,
+        }
+
+    def observar(self, rota, duracao, parciais):
+        posicao = next((i for i, limite in enumerate(FAIXAS) if duracao <= limite), len(FAIXAS))
+        with self._lock:
+            dados = self.rotas.get(rota)
+            if dados is None:
+                dados = self.rotas[rota] = self._nova_rota()
+            dados["faixas"][posicao] += 1
+            dados["soma"] += duracao
+            dados["requests"] += 1
+            dados["consultas"] += parciais["consultas"]
+            for nome in PARCIAIS:
+                dados[nome] += parciais[nome]
+
+    def exportar(self):
+        with self._lock:
+            return json.loads(json.dumps(self.rotas))
+
+    def limpar(self):
+        with self._lock:
+            self.rotas.clear()
+
+
+registro = Registro()
+
+
+def _parciais():
+    if not has_request_context():
+        return None
+    return g.get("_metricas")
+
+
+@contextmanager
+def medir(nome):
+    # Soma o tempo do bloco na parcial "nome" do request atual.
+    parciais = _parciais() if _instrumentado() else None
+    if parciais is None:
+        yield
+        return
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        parciais[nome] += time.perf_counter() - inicio
+
+
+@contextmanager
+def varredura_intencional():
+    # Leituras que precisam da tabela inteira (exportacoes) ficam fora da
+    # checagem de varredura do modo estrito.
+    if _parciais() is None:
+        yield
+        return
+    g._varredura_intencional = True
+    try:
+        yield
+    finally:
+        g._varredura_intencional = False
+
+
+def _somar_sql(inicio):
+    parciais = _parciais()
+    if parciais is not None:
+        parciais["sql"] += time.perf_counter() - inicio
+
+
+def _contar_consulta(sql):
+    # Callback de trace do sqlite3: uma chamada por instrucao executada. As
+    # instrucoes internas de triggers chegam como comentario ("-- TRIGGER")
+    # ou, conforme a versao, repetindo o SQL expandido da instrucao que as
+    # disparou; os EXPLAIN sao os do proprio log de consultas.
+    parciais = _parciais()
+    if parciais is None or sql.startswith(("--", "EXPLAIN")):
+        return
+    if sql != g.get("_ultima_consulta"):
+        parciais["consultas"] += 1
+        g._ultima_consulta = sql
+
+
+_ESPACOS = re.compile(r"\s+")
+_LITERAIS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_VARREDURA = re.compile(r"^SCAN (?:TABLE )?(\w+)$")
+_COM_PLANO = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH")
+
+_planos = {}
+
+
+def normalizar_sql(sql):
+    return _ESPACOS.sub(" ", _LITERAIS.sub("?", sql)).strip()
+
+
+def _formato(parametros):
+    if isinstance(parametros, dict):
+        return "{" + ", ".join(f"{nome}: {type(valor).__name__}" for nome, valor in parametros.items()) + "}"
+    return "(" + ", ".join(type(valor).__name__ for valor in parametros) + ")"
+
+
+def plano(conn, sql, parametros=()):
+    # EXPLAIN QUERY PLAN pela execute original da conexao (sem passar pela
+    # instrumentacao), guardado por SQL normalizado.
+    normalizado = normalizar_sql(sql)
+    if normalizado in _planos:
+        return _planos[normalizado]
+    if not normalizado.upper().startswith(_COM_PLANO):
+        return []
+    try:
+        linhas = sqlite3.Connection.execute(conn, f"EXPLAIN QUERY PLAN {sql}", parametros).fetchall()
+    except sqlite3.Error:
+        return []
+    _planos[normalizado] = detalhes = [linha[3] for linha in linhas]
+    return detalhes
+
+
+def varreduras(detalhes):
+    # Tabelas lidas por inteiro, sem indice ("SCAN livros"). Percorrer um
+    # indice em ordem ("SCAN usuarios USING INDEX ...") nao conta.
+    return [encontrada.group(1) for detalhe in detalhes if (encontrada := _VARREDURA.match(detalhe))]
+
+
+def _rota():
+    return request.endpoint or request.path if has_request_context() else "-"
+
+
+def _verificar_estrito(conn, sql, parametros):
+    if not ESTRITO or _parciais() is None or g.get("_varredura_intencional"):
+        return
+    tabelas = varreduras(plano(conn, sql, parametros))
+    if tabelas:
+        raise ConsultaProibida(
+            f"Varredura sem indice em {', '.join(tabelas)} na rota {_rota()}: {normalizar_sql(sql)}"
+        )
+
+
+def _registrar_lenta(conn, sql, parametros, decorrido, quantidade):
+    detalhes = plano(conn, sql, parametros)
+    tabelas = varreduras(detalhes)
+    formato = _formato(parametros)
+    if quantidade is not None:
+        formato = f"{quantidade} x {formato}"
+    log_consultas.warning(
+        "Consulta lenta (%.1f ms) em %s: %s | parametros %s | plano: %s%s",
+        decorrido * 1000,
+        _rota(),
+        normalizar_sql(sql),
+        formato,
+        "; ".join(detalhes) or "-",
+        f" | VARREDURA: {', '.join(tabelas)}" if tabelas else "",
+    )
+
+
+class CursorMedido(sqlite3.Cursor):
+    # O tempo de uma instrucao inclui os passos feitos ao buscar as linhas;
+    # ela entra no log de lentas assim que o acumulado passa do limite.
+    _sql = None
+
+    def _iniciar(self, sql, parametros, quantidade=None):
+        self._encerrar()
+        self._sql = sql
+        self._parametros = parametros
+        self._quantidade = quantidade
+        self._decorrido = 0.0
+        self._registrada = False
+
+    def _medir(self, inicio):
+        decorrido = time.perf_counter() - inicio
+        _somar_sql(inicio)
+        if self._sql is not None:
+            self._decorrido += decorrido
+            if LENTA_MS is not None and not self._registrada and self._decorrido * 1000 >= LENTA_MS:
+                self._registrada = True
+                _registrar_lenta(self.connection, self._sql, self._parametros, self._decorrido, self._quantidade)
+
+    def _encerrar(self):
+        self._sql = None
+
+    def execute(self, sql, parametros=()):
+        _verificar_estrito(self.connection, sql, parametros)
+        self._iniciar(sql, parametros)
+        inicio = time.perf_counter()
+        try:
+            return super().execute(sql, parametros)
+        finally:
+            self._medir(inicio)
+
+    def executemany(self, sql, parametros):
+        parametros = list(parametros)
+        primeiro = parametros[0] if parametros else ()
+        _verificar_estrito(self.connection, sql, primeiro)
+        self._iniciar(sql, primeiro, len(parametros))
+        inicio = time.perf_counter()
+        try:
+            return super().executemany(sql, parametros)
+        finally:
+            self._medir(inicio)
+
+    def fetchone(self):
+        inicio = time.perf_counter()
+        try:
+            linha = super().fetchone()
+        finally:
+            self._medir(inicio)
+        if linha is None:
+            self._encerrar()
+        return linha
+
+    def fetchmany(self, *args):
+        inicio = time.perf_counter()
+        try:
+            linhas = super().fetchmany(*args)
+        finally:
+            self._medir(inicio)
+        if not linhas:
+            self._encerrar()
+        return linhas
+
+    def fetchall(self):
+        inicio = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            self._medir(inicio)
+            self._encerrar()
+
+    def __next__(self):
+        inicio = time.perf_counter()
+        try:
+            return super().__next__()
+        except StopIteration:
+            self._encerrar()
+            raise
+        finally:
+            self._medir(inicio)
+
+
+def _cursor(conn, factory=CursorMedido):
+    return sqlite3.Connection.cursor(conn, factory)
+
+
+def _execute(conn, sql, parametros=()):
+    return conn.cursor().execute(sql, parametros)
+
+
+def _executemany(conn, sql, parametros):
+    return conn.cursor().executemany(sql, parametros)
+
+
+def instrumentar(conn):
+    # Chamado para cada conexao nova do pool. Troca cursor/execute apenas
+    # nesta instancia, entao com metricas, log de lentas e modo estrito
+    # desligados nada muda.
+    if not _instrumentado():
+        return
+    conn.set_trace_callback(_contar_consulta)
+    conn.cursor = MethodType(_cursor, conn)
+    conn.execute = MethodType(_execute, conn)
+    conn.executemany = MethodType(_executemany, conn)
+
+
+def _iniciar_request():
+    g._metricas = {"inicio": time.perf_counter(), "consultas": 0, "sql": 0.0, "render": 0.0, "hash": 0.0, "limite": 0.0}
+
+
+def _inicio_render(remetente, **extra):
+    parciais = _parciais()
+    if parciais is not None:
+        parciais["render_inicio"] = time.perf_counter()
+
+
+def _fim_render(remetente, **extra):
+    parciais = _parciais()
+    if parciais is not None and "render_inicio" in parciais:
+        parciais["render"] += time.perf_counter() - parciais.pop("render_inicio")
+
+
+def _finalizar_request(resposta):
+    parciais = g.pop("_metricas", None)
+    if parciais is None or request.endpoint == "metricas.metrics":
+        return resposta
+
+    if ESTRITO and parciais["consultas"] > MAX_CONSULTAS:
+        raise ConsultaProibida(
+            f"{parciais['consultas']} instrucoes SQL na rota {_rota()} (maximo {MAX_CONSULTAS})."
+        )
+    if not ATIVO:
+        return resposta
+
+    duracao = time.perf_counter() - parciais["inicio"]
+    resposta.headers["Server-Timing"] = ", ".join([
+        f'sql;dur={parciais["sql"] * 1000:.2f};desc="{parciais["consultas"]} consultas"',
+        f"render;dur={parciais['render'] * 1000:.2f}",
+        f"hash;dur={parciais['hash'] * 1000:.2f}",
+        f"limite;dur={parciais['limite'] * 1000:.2f}",
+        f"total;dur={duracao * 1000:.2f}",
+    ])
+    registro.observar(request.endpoint or "desconhecida", duracao, parciais)
+    _gravar_periodicamente()
+    return resposta
+
+
+_ultima_gravacao = 0.0
+
+
+def _arquivo_do_processo():
+    return os.path.join(DIRETORIO, f"{os.getpid()}.json")
+
+
+def gravar():
+    if not DIRETORIO:
+        return
+    os.makedirs(DIRETORIO, exist_ok=True)
+    destino = _arquivo_do_processo()
+    temporario = f"{destino}.tmp"
+    with open(temporario, "w", encoding="utf-8") as saida:
+        json.dump(registro.exportar(), saida)
+    os.replace(temporario, destino)
+
+
+def _gravar_periodicamente():
+    global _ultima_gravacao
+    agora = time.monotonic()
+    if DIRETORIO and agora - _ultima_gravacao >= INTERVALO_GRAVACAO:
+        _ultima_gravacao = agora
+        gravar()
+
+
+def _somar(destino, origem):
+    for rota, dados in origem.items():
+        atual = destino.setdefault(rota, Registro._nova_rota())
+        atual["faixas"] = [a + b for a, b in zip(atual["faixas"], dados["faixas"])]
+        for chave in ("soma", "requests", "consultas", *PARCIAIS):
+            atual[chave] += dados[chave]
+
+
+def coletar():
+    # Acumulados de todos os workers: os arquivos dos outros processos e o
+    # estado em memoria deste (mais recente que o proprio arquivo).
+    total = {}
+    if DIRETORIO:
+        proprio = _arquivo_do_processo()
+        for caminho in glob.glob(os.path.join(DIRETORIO, "*.json")):
+            if caminho == proprio:
+                continue
+            try:
+                with open(caminho, encoding="utf-8") as entrada:
+                    _somar(total, json.load(entrada))
+            except (OSError, ValueError):
+                continue
+    _somar(total, registro.exportar())
+    return total
+
+
+def _rotulo(rota):
+    return rota.replace("\\", "\\\\").replace('"', '\\"')
+
+
+def formatar_prometheus(rotas):
+    linhas = [
+        "# HELP biblioteca_request_duration_seconds Latencia dos requests por rota.",
+        "# TYPE biblioteca_request_duration_seconds histogram",
+    ]
+    for rota, dados in sorted(rotas.items()):
+        rotulo = _rotulo(rota)
+        acumulado = 0
+        for limite, quantidade in zip((*FAIXAS, "+Inf"), dados["faixas"]):
+            acumulado += quantidade
+            linhas.append(f'biblioteca_request_duration_seconds_bucket{{rota="{rotulo}",le="{limite}"}} {acumulado}')
+        linhas.append(f'biblioteca_request_duration_seconds_sum{{rota="{rotulo}"}} {dados["soma"]:.6f}')
+        linhas.append(f'biblioteca_request_duration_seconds_count{{rota="{rotulo}"}} {dados["requests"]}')
+
+    contadores = (
+        ("biblioteca_sql_queries_total", "consultas", "Instrucoes SQL executadas."),
+        ("biblioteca_sql_seconds_total", "sql", "Tempo gasto no SQLite."),
+        ("biblioteca_render_seconds_total", "render", "Tempo gasto renderizando templates."),
+        ("biblioteca_hash_seconds_total", "hash", "Tempo gasto com hash de senhas."),
+        ("biblioteca_limite_seconds_total", "limite", "Tempo gasto no limitador de tentativas."),
+    )
+    for nome, chave, ajuda in contadores:
+        linhas.append(f"# HELP {nome} {ajuda}")
+        linhas.append(f"# TYPE {nome} counter")
+        for rota, dados in sorted(rotas.items()):
+            valor = dados[chave]
+            valor = f"{valor:.6f}" if isinstance(valor, float) else valor
+            linhas.append(f'{nome}{{rota="{_rotulo(rota)}"}} {valor}')
+    return "\n".join(linhas) + "\n"
+
+
+def _cliente_local():
+    try:
+        return ipaddress.ip_address(request.remote_addr or "").is_loopback
+    except ValueError:
+        return False
+
+
+@metricas_bp.route("/metrics")
+def metrics():
+    if not ATIVO:
+        abort(404)
+    if TOKEN:
+        if not secrets.compare_digest(request.headers.get("Authorization", ""), f"Bearer {TOKEN}"):
+            abort(401)
+    elif not _cliente_local():
+        abort(403)
+    return Response(formatar_prometheus(coletar()), mimetype="text/plain; version=0.0.4")
+
+
+def init_app(app):
+    app.register_blueprint(metricas_bp)
+    if not _instrumentado():
+        return
+
+    app.before_request(_iniciar_request)
+    app.after_request(_finalizar_request)
+    before_render_template.connect(_inicio_render, app)
+    template_rendered.connect(_fim_render, app)
+    if DIRETORIO:
+        atexit.register(gravar)
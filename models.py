@@ -1,6 +1,56 @@
+import unicodedata
+
+
 class Livro:
-    def __init__(self, titulo, autor, ano, disponivel=True):
+    __slots__ = ("id", "titulo", "autor", "ano", "disponivel", "usuario_id", "data_devolucao")
+
+    def __init__(self, titulo, autor, ano, disponivel=True, id=None, usuario_id=None, data_devolucao=None):
+        self.id = id
         self.titulo = titulo
         self.autor = autor
         self.ano = ano
-        self.disponivel = disponivel
\ No newline at end of file
+        self.disponivel = disponivel
+        self.usuario_id = usuario_id
+        self.data_devolucao = data_devolucao
+
+    def __repr__(self):
+        return f"Livro(id={self.id!r}, titulo={self.titulo!r})"
+
+    def como_dict(self):
+        return {campo: getattr(self, campo) for campo in self.__slots__}
+
+
+# Resultados das operacoes de escrita, iguais em todos os backends.
+OK = "ok"
+CONFLITO = "conflito"
+NAO_ENCONTRADO = "nao_encontrado"
+SEM_ALTERACAO = "sem_alteracao"
+ULTIMO_ADMIN = "ultimo_admin"
+
+
+class EmailDuplicado(ValueError):
+    pass
+
+
+# Colunas lidas para montar um Livro; evita SELECT * para que colunas
+# internas (como a chave de deduplicacao) nao cheguem ao modelo.
+CAMPOS_LIVRO = ", ".join(Livro.__slots__)
+
+
+def _normalizar(texto):
+    decomposto = unicodedata.normalize("NFKD", texto)
+    sem_acentos = "".join(c for c in decomposto if not unicodedata.combining(c))
+    return " ".join(sem_acentos.casefold().split())
+
+
+def chave_livro(titulo, autor, ano):
+    # "Dom  Casmurro", "dom casmurro" e "Dom Casmurro " geram a mesma chave.
+    return f"{_normalizar(titulo)}|{_normalizar(autor)}|{int(ano)}"
+
+
+def livro_factory(cursor, linha):
+    # row_factory de cursor: monta o Livro direto da tupla do SQLite, sem
+    # passar por sqlite3.Row nem dict intermediario. As consultas leem
+    # sempre CAMPOS_LIVRO, entao a posicao de cada coluna e fixa.
+    id, titulo, autor, ano, disponivel, usuario_id, data_devolucao = linha
+    return Livro(titulo, autor, ano, disponivel, id, usuario_id, data_devolucao)
@@ -0,0 +1,78 @@
+import importlib
+import os
+
+# Armazenamento de livros, usuarios e emprestimos escolhido por
+# DATABASE_BACKEND. Cada backend e um modulo com as mesmas funcoes
+# (OPERACOES) e constantes; rotas, comandos, importacao e exportacao
+# importam daqui e nao sabem qual banco esta por tras.
+BACKENDS = {
+    "sqlite": "services",
+    "postgres": "services_postgres",
+}
+BACKEND = os.getenv("DATABASE_BACKEND", "sqlite")
+
+OPERACOES = (
+    # schema e versoes dos caches
+    "criar_tabelas",
+    "ler_versao",
+    # livros
+    "adicionar_livro",
+    "atualizar_livro",
+    "remover_livro",
+    "buscar_por_id",
+    "buscar_por_ids",
+    "buscar_por_titulo",
+    "buscar_nas_unidades",
+    "listar_livros_pagina",
+    "listar_livros_do_usuario",
+    "inserir_livros_novos",
+    "ler_em_lotes",
+    # emprestimos
+    "emprestar_livro",
+    "devolver_livro",
+    "emprestar_lote",
+    "devolver_lote",
+    "listar_atrasados",
+    # usuarios
+    "buscar_usuario",
+    "buscar_usuario_por_email",
+    "total_usuarios",
+    "criar_usuario",
+    "atualizar_senha",
+    "alterar_tipo_usuario",
+    "listar_usuarios_pagina",
+    "contar_usuarios",
+    "sugerir_usuarios",
+    # painel de estatisticas, lido das tabelas de resumo
+    "ler_painel",
+    "reconstruir_estatisticas",
+)
+
+CONSTANTES = (
+    "LIMITE_BUSCA",
+    "LIMITE_SUGESTOES",
+    "MAX_LOTE_CIRCULACAO",
+    "POR_PAGINA",
+    "PRAZO_EMPRESTIMO_DIAS",
+    "USUARIOS_POR_PAGINA",
+    "VERSAO_SCHEMA",
+)
+
+
+def carregar(nome):
+    if nome not in BACKENDS:
+        raise RuntimeError(f"DATABASE_BACKEND desconhecido: {nome!r} (use {', '.join(BACKENDS)}).")
+    modulo = importlib.import_module(BACKENDS[nome])
+    faltando = [nome_operacao for nome_operacao in OPERACOES + CONSTANTES if not hasattr(modulo, nome_operacao)]
+    if faltando:
+        raise RuntimeError(f"Backend {nome} sem: {', '.join(faltando)}.")
+    return modulo
+
+
+backend = carregar(BACKEND)
+
+
+def __getattr__(nome):
+    if nome in OPERACOES or nome in CONSTANTES:
+        return getattr(backend, nome)
+    raise AttributeError(f"module {__name__!r} has no attribute {nome!r}")
@@ -0,0 +1,124 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as TempoEsgotado
+
+from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS, check_password_hash, generate_password_hash
+
+from metricas import medir
+
+# Metodo no formato do Werkzeug: "scrypt", "scrypt:N:r:p", "pbkdf2",
+# "pbkdf2:sha256:iteracoes".
+SENHA_METODO = os.getenv("SENHA_METODO", "scrypt")
+# 0 calcula o hash no proprio processo do request.
+SENHA_WORKERS = int(os.getenv("SENHA_WORKERS", str(min(2, os.cpu_count() or 1))))
+SENHA_FILA_MAX = int(os.getenv("SENHA_FILA_MAX", "8"))
+SENHA_TIMEOUT = float(os.getenv("SENHA_TIMEOUT", "10"))
+
+PREFIXOS_HASH = ("pbkdf2:", "scrypt:")
+
+
+class HashOcupado(RuntimeError):
+    pass
+
+
+def normalizar_metodo(metodo):
+    # Mesmos padroes de werkzeug.security._hash_internal, para comparar o
+    # metodo configurado com o gravado no inicio de cada hash.
+    nome, *args = metodo.split(":")
+    if nome == "scrypt":
+        n, r, p = args if args else (2**15, 8, 1)
+        return f"scrypt:{int(n)}:{int(r)}:{int(p)}"
+    if nome == "pbkdf2":
+        hash_nome = args[0] if args else "sha256"
+        iteracoes = int(args[1]) if len(args) > 1 else DEFAULT_PBKDF2_ITERATIONS
+        return f"pbkdf2:{hash_nome}:{iteracoes}"
+    raise ValueError(f"Metodo de hash invalido: {metodo!r}")
+
+
+METODO_NORMALIZADO = normalizar_metodo(SENHA_METODO)
+
+
+def eh_hash(senha_armazenada):
+    return senha_armazenada.startswith(PREFIXOS_HASH)
+
+
+def precisa_atualizar(senha_armazenada):
+    return senha_armazenada.split("$", 1)[0] != METODO_NORMALIZADO
+
+
+def _gerar(senha, metodo):
+    return generate_password_hash(senha, method=metodo)
+
+
+def _verificar(senha_armazenada, senha):
+    return check_password_hash(senha_armazenada, senha)
+
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+_vagas = threading.BoundedSemaphore(max(1, SENHA_FILA_MAX))
+
+
+def _obter_executor():
+    global _executor, _executor_pid
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            # spawn: nao herda locks nem conexoes abertas do worker.
+            _executor = ProcessPoolExecutor(
+                max_workers=SENHA_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+            _executor_pid = os.getpid()
+        return _executor
+
+
+def _executar(funcao, *args):
+    with medir("hash"):
+        if SENHA_WORKERS <= 0:
+            return funcao(*args)
+
+        # Rejeita de imediato quando ja ha SENHA_FILA_MAX hashes em andamento,
+        # em vez de deixar os requests enfileirarem atras de trabalho de CPU.
+        vagas = _vagas
+        if not vagas.acquire(blocking=False):
+            raise HashOcupado("Fila de hash de senhas cheia")
+        try:
+            futuro = _obter_executor().submit(funcao, *args)
+        except BaseException:
+            vagas.release()
+            raise
+        # A vaga so volta quando o hash termina de fato: um request que
+        # desistiu por timeout nao libera o lugar de um calculo ainda em
+        # andamento no pool.
+        futuro.add_done_callback(lambda _: vagas.release())
+        try:
+            return futuro.result(timeout=SENHA_TIMEOUT)
+        except TempoEsgotado:
+            futuro.cancel()
+            raise HashOcupado("Hash de senha excedeu SENHA_TIMEOUT") from None
+
+
+def gerar_hash(senha):
+    return _executar(_gerar, senha, SENHA_METODO)
+
+
+def verificar_hash(senha_armazenada, senha):
+    return _executar(_verificar, senha_armazenada, senha)
+
+
+def mapear_hashes(senhas):
+    # Usado em lote (migracao de senhas legadas): distribui entre os
+    # processos sem o limite de fila dos requests.
+    if SENHA_WORKERS <= 0:
+        return [_gerar(senha, SENHA_METODO) for senha in senhas]
+    return list(_obter_executor().map(_gerar, senhas, [SENHA_METODO] * len(senhas)))
+
+
+def encerrar():
+    global _executor
+    with _executor_lock:
+        if _executor is not None and _executor_pid == os.getpid():
+            _executor.shutdown(wait=True)
+        _executor = None
@@ -1,4 +1,53 @@
-from database import conectar
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from itertools import zip_longest
+
+import sqlite3
+
+from database import (
+    UNIDADES,
+    VERSAO_SCHEMA,
+    conectar,
+    conectar_avulsa,
+    criar_tabelas,
+    escrever,
+    indice_fts,
+    ler_versao,
+    usando_unidade,
+)
+from models import (
+    CAMPOS_LIVRO,
+    CONFLITO,
+    NAO_ENCONTRADO,
+    OK,
+    SEM_ALTERACAO,
+    ULTIMO_ADMIN,
+    EmailDuplicado,
+    Livro,
+    chave_livro,
+    livro_factory,
+)
+from estatisticas import ler_painel, reconstruir as reconstruir_estatisticas
+from metricas import varredura_intencional
+
+LIMITE_BUSCA = 50
+POR_PAGINA = 25
+USUARIOS_POR_PAGINA = 25
+LIMITE_SUGESTOES = 10
+LOTE_IDS = 500
+PRAZO_EMPRESTIMO_DIAS = 7
+MAX_LOTE_CIRCULACAO = 100
+
+_CAMPOS_LIVRO_JOIN = ", ".join(f"livros.{campo}" for campo in Livro.__slots__)
+
+
+def _cursor_livros(conn):
+    cursor = conn.cursor()
+    cursor.row_factory = livro_factory
+    return cursor
 
 
 def adicionar_livro(livro):
@@ -6,57 +55,178 @@ def adicionar_livro(livro):
     cursor = conn.cursor()
 
     cursor.execute("""
-        INSERT INTO livros (titulo, autor, ano, disponivel)
-        VALUES (?, ?, ?, ?)
-    """, (livro.titulo, livro.autor, livro.ano, int(livro.disponivel)))
+        INSERT INTO livros (titulo, autor, ano, disponivel, chave)
+        VALUES (?, ?, ?, ?, ?)
+    """, (livro.titulo, livro.autor, livro.ano, int(livro.disponivel), chave_livro(livro.titulo, livro.autor, livro.ano)))
 
     conn.commit()
     conn.close()
 
 
-def listar_livros():
+def listar_livros_pagina(apos=None, antes=None, limite=POR_PAGINA):
+    # Paginacao por chave (seek) sobre o id: cada pagina custa uma busca na
+    # chave primaria, independente do tamanho do acervo.
     conn = conectar()
-    cursor = conn.cursor()
-
-    cursor.execute("SELECT * FROM livros")
-    colunas = [col[0] for col in cursor.description]
-    dados = cursor.fetchall()
+    cursor = _cursor_livros(conn)
+
+    if antes is not None:
+        cursor.execute(
+            f"SELECT {CAMPOS_LIVRO} FROM livros WHERE id < ? ORDER BY id DESC LIMIT ?",
+            (antes, limite + 1),
+        )
+    else:
+        cursor.execute(
+            f"SELECT {CAMPOS_LIVRO} FROM livros WHERE id > ? ORDER BY id LIMIT ?",
+            (apos or 0, limite + 1),
+        )
+
+    livros = cursor.fetchall()
+    tem_mais = len(livros) > limite
+    livros = livros[:limite]
+
+    if antes is not None:
+        livros.reverse()
+        tem_anterior = tem_mais
+        tem_proxima = conn.execute("SELECT 1 FROM livros WHERE id >= ? LIMIT 1", (antes,)).fetchone() is not None
+    else:
+        tem_proxima = tem_mais
+        tem_anterior = conn.execute("SELECT 1 FROM livros WHERE id <= ? LIMIT 1", (apos or 0,)).fetchone() is not None
 
     conn.close()
 
-    return [dict(zip(colunas, linha)) for linha in dados]
+    return {
+        "livros": livros,
+        "anterior": livros[0].id if livros and tem_anterior else None,
+        "proximo": livros[-1].id if livros and tem_proxima else None,
+    }
 
 
-def buscar_por_titulo(titulo):
+def listar_livros_do_usuario(usuario_id):
     conn = conectar()
-    cursor = conn.cursor()
+    cursor = _cursor_livros(conn)
 
-    cursor.execute("""
-        SELECT * FROM livros
-        WHERE titulo LIKE ?
-    """, (f"%{titulo}%",))
+    cursor.execute(f"""
+        SELECT {CAMPOS_LIVRO} FROM livros
+        WHERE usuario_id = ?
+        AND disponivel = 0
+    """, (usuario_id,))
+    livros = cursor.fetchall()
+
+    conn.close()
 
-    colunas = [col[0] for col in cursor.description]
-    dados = cursor.fetchall()
+    return livros
+
+
+def _consulta_fts(termo):
+    # Cada palavra vira um prefixo entre aspas: "dom" "casm" -> dom* AND casm*
+    palavras = re.findall(r"\w+", termo)
+    return " ".join(f'"{palavra}"*' for palavra in palavras)
+
+
+def buscar_por_titulo(titulo, limite=LIMITE_BUSCA):
+    conn = conectar()
+    cursor = _cursor_livros(conn)
+
+    if indice_fts(conn, "livros_fts"):
+        consulta = _consulta_fts(titulo)
+        if not consulta:
+            conn.close()
+            return []
+
+        cursor.execute(f"""
+            SELECT {_CAMPOS_LIVRO_JOIN} FROM livros_fts
+            JOIN livros ON livros.id = livros_fts.rowid
+            WHERE livros_fts MATCH ?
+            ORDER BY bm25(livros_fts, 10.0, 1.0)
+            LIMIT ?
+        """, (consulta, limite))
+    else:
+        cursor.execute(f"""
+            SELECT {CAMPOS_LIVRO} FROM livros
+            WHERE titulo LIKE ? OR autor LIKE ?
+            ORDER BY titulo
+            LIMIT ?
+        """, (f"%{titulo}%", f"%{titulo}%", limite))
+
+    livros = cursor.fetchall()
 
     conn.close()
 
-    return [dict(zip(colunas, linha)) for linha in dados]
+    return livros
+
+
+_executor_unidades = None
+_executor_chave = None
+_executor_lock = threading.Lock()
+
+
+def _obter_executor_unidades():
+    # Uma thread por unidade; recriado depois de um fork (gunicorn --preload).
+    global _executor_unidades, _executor_chave
+    chave = (os.getpid(), len(UNIDADES))
+    with _executor_lock:
+        if _executor_unidades is None or _executor_chave != chave:
+            _executor_unidades = ThreadPoolExecutor(max_workers=len(UNIDADES), thread_name_prefix="busca-unidades")
+            _executor_chave = chave
+        return _executor_unidades
+
+
+def _buscar_na_unidade(nome, termo, limite):
+    with usando_unidade(nome):
+        return buscar_por_titulo(termo, limite)
+
+
+def buscar_nas_unidades(termo, limite=LIMITE_BUSCA):
+    # Busca somente leitura em todas as unidades em paralelo, cada uma no
+    # proprio pool (o sqlite3 libera o GIL durante a consulta). Os resultados
+    # sao intercalados pela posicao no ranking de cada unidade e devolvidos
+    # como (unidade, livro).
+    if not UNIDADES:
+        return [(None, livro) for livro in buscar_por_titulo(termo, limite)]
+
+    nomes = list(UNIDADES)
+    executor = _obter_executor_unidades()
+    futuros = [executor.submit(_buscar_na_unidade, nome, termo, limite) for nome in nomes]
+    resultados = [futuro.result() for futuro in futuros]
+
+    mesclados = []
+    for linha in zip_longest(*resultados):
+        mesclados.extend((nome, livro) for nome, livro in zip(nomes, linha) if livro is not None)
+    return mesclados[:limite]
 
 
 def buscar_por_id(id):
     conn = conectar()
-    cursor = conn.cursor()
+    cursor = _cursor_livros(conn)
 
-    cursor.execute("SELECT * FROM livros WHERE id = ?", (id,))
-    colunas = [col[0] for col in cursor.description]
-    dado = cursor.fetchone()
+    cursor.execute(f"SELECT {CAMPOS_LIVRO} FROM livros WHERE id = ?", (id,))
+    livro = cursor.fetchone()
 
     conn.close()
 
-    if dado:
-        return dict(zip(colunas, dado))
-    return None
+    return livro
+
+
+def buscar_por_ids(ids):
+    # Devolve os livros na ordem dos ids pedidos, ignorando os inexistentes.
+    ids = list(dict.fromkeys(int(id) for id in ids))
+    if not ids:
+        return []
+
+    conn = conectar()
+    cursor = _cursor_livros(conn)
+
+    encontrados = {}
+    for inicio in range(0, len(ids), LOTE_IDS):
+        lote = ids[inicio:inicio + LOTE_IDS]
+        marcadores = ", ".join("?" for _ in lote)
+        cursor.execute(f"SELECT {CAMPOS_LIVRO} FROM livros WHERE id IN ({marcadores})", lote)
+        for livro in cursor:
+            encontrados[livro.id] = livro
+
+    conn.close()
+
+    return [encontrados[id] for id in ids if id in encontrados]
 
 
 def atualizar_livro(id, novo_titulo, novo_autor, novo_ano):
@@ -65,50 +235,453 @@ def atualizar_livro(id, novo_titulo, novo_autor, novo_ano):
 
     cursor.execute("""
         UPDATE livros
-        SET titulo = ?, autor = ?, ano = ?
+        SET titulo = ?, autor = ?, ano = ?, chave = ?
         WHERE id = ?
-    """, (novo_titulo, novo_autor, novo_ano, id))
+    """, (novo_titulo, novo_autor, novo_ano, chave_livro(novo_titulo, novo_autor, novo_ano), id))
 
     conn.commit()
     conn.close()
 
 
 def remover_livro(id):
+    # Livro com emprestimo em aberto nao e removido: o emprestimo ficaria
+    # aberto para sempre, fora do relatorio de atrasados mas contado nas
+    # estatisticas. A devolucao tem que ser registrada antes.
+    def operacao(cursor):
+        cursor.execute("""
+            DELETE FROM livros
+            WHERE id = ?
+            AND NOT EXISTS (
+                SELECT 1 FROM emprestimos
+                WHERE livro_id = ? AND devolvido_em IS NULL
+            )
+        """, (id, id))
+        if cursor.rowcount == 1:
+            return OK
+        return _resultado_sem_alteracao(cursor, id)
+
     conn = conectar()
-    cursor = conn.cursor()
+    try:
+        return escrever(conn, operacao)
+    finally:
+        conn.close()
 
-    cursor.execute("DELETE FROM livros WHERE id = ?", (id,))
 
+def inserir_livros_novos(lote):
+    # lote: [(titulo, autor, ano, chave)]. INSERT ... WHERE NOT EXISTS
+    # consulta o indice da chave; linhas repetidas dentro do proprio lote
+    # tambem sao barradas, pois cada insercao ja e visivel para a seguinte na
+    # mesma transacao. Devolve quantos livros foram inseridos.
+    conn = conectar()
+    cursor = conn.cursor()
+    cursor.executemany(
+        """
+        INSERT INTO livros (titulo, autor, ano, disponivel, chave)
+        SELECT ?, ?, ?, 1, ?
+        WHERE NOT EXISTS (SELECT 1 FROM livros WHERE chave = ?)
+        """,
+        [(titulo, autor, ano, chave, chave) for titulo, autor, ano, chave in lote],
+    )
     conn.commit()
+    inseridos = cursor.rowcount
     conn.close()
+    return inseridos
+
+
+def ler_em_lotes(consulta, tamanho):
+    # Gera os nomes das colunas e depois listas de ate "tamanho" tuplas. O
+    # cursor do SQLite ja e lido sob demanda; fetchmany limita quantas linhas
+    # ficam em memoria. Em WAL a leitura usa um snapshot e nao impede
+    # emprestimos e devolucoes de gravarem enquanto o arquivo e gerado.
+    conn = conectar_avulsa()
+    try:
+        cursor = conn.cursor()
+        cursor.row_factory = None
+        with varredura_intencional():
+            cursor.execute(consulta)
+        yield [coluna[0] for coluna in cursor.description]
+        while True:
+            linhas = cursor.fetchmany(tamanho)
+            if not linhas:
+                break
+            yield linhas
+    finally:
+        conn.close()
+
 
- #regra de negocio 
+def _resultado_sem_alteracao(cursor, id_livro):
+    # O UPDATE condicional nao pegou a linha: ou o livro nao existe ou ja
+    # estava no estado pedido.
+    cursor.execute("SELECT 1 FROM livros WHERE id = ?", (id_livro,))
+    return CONFLITO if cursor.fetchone() else NAO_ENCONTRADO
+
+
+def emprestar_livro(id_livro, usuario_id, dias=PRAZO_EMPRESTIMO_DIAS):
+    agora = datetime.now()
+    devolucao_prevista = (agora + timedelta(days=dias)).date().isoformat()
+
+    def operacao(cursor):
+        # Compare-and-set: so empresta se ainda estiver disponivel.
+        cursor.execute("""
+            UPDATE livros
+            SET disponivel = 0,
+                usuario_id = ?,
+                data_devolucao = ?
+            WHERE id = ?
+            AND disponivel = 1
+        """, (usuario_id, devolucao_prevista, id_livro))
+        if cursor.rowcount != 1:
+            return _resultado_sem_alteracao(cursor, id_livro)
+
+        cursor.execute("""
+            INSERT INTO emprestimos (livro_id, usuario_id, emprestado_em, devolucao_prevista)
+            VALUES (?, ?, ?, ?)
+        """, (id_livro, usuario_id, agora.isoformat(sep=" ", timespec="seconds"), devolucao_prevista))
+        return OK
 
-def alterar_disponibilidade(id, status):
     conn = conectar()
-    cursor = conn.cursor()
+    try:
+        return escrever(conn, operacao)
+    finally:
+        conn.close()
+
+
+def devolver_livro(id_livro):
+    agora = datetime.now().isoformat(sep=" ", timespec="seconds")
+
+    def operacao(cursor):
+        cursor.execute("""
+            UPDATE livros
+            SET disponivel = 1,
+                usuario_id = NULL,
+                data_devolucao = NULL
+            WHERE id = ?
+            AND disponivel = 0
+        """, (id_livro,))
+        if cursor.rowcount != 1:
+            return _resultado_sem_alteracao(cursor, id_livro)
+
+        cursor.execute("""
+            UPDATE emprestimos
+            SET devolvido_em = ?
+            WHERE livro_id = ?
+            AND devolvido_em IS NULL
+        """, (agora, id_livro))
+        return OK
+
+    conn = conectar()
+    try:
+        return escrever(conn, operacao)
+    finally:
+        conn.close()
 
-    # Verifica estado atual
-    cursor.execute("SELECT disponivel FROM livros WHERE id = ?", (id,))
-    resultado = cursor.fetchone()
 
-    if not resultado:
+def _classificar_lote(cursor, ids, disponivel):
+    # Roda ja com o lock de escrita: o estado lido aqui nao muda ate o
+    # commit. Um id repetido no lote so vale na primeira vez.
+    estados = {}
+    unicos = list(dict.fromkeys(ids))
+    for inicio in range(0, len(unicos), LOTE_IDS):
+        parte = unicos[inicio:inicio + LOTE_IDS]
+        marcadores = ", ".join("?" for _ in parte)
+        cursor.execute(f"SELECT id, disponivel FROM livros WHERE id IN ({marcadores})", parte)
+        estados.update((linha[0], linha[1]) for linha in cursor.fetchall())
+
+    resultados = []
+    aceitos = []
+    for id_livro in ids:
+        if id_livro not in estados:
+            resultados.append((id_livro, NAO_ENCONTRADO))
+        elif estados[id_livro] != disponivel:
+            resultados.append((id_livro, CONFLITO))
+        else:
+            resultados.append((id_livro, OK))
+            aceitos.append(id_livro)
+            estados[id_livro] = 1 - disponivel
+    return resultados, aceitos
+
+
+def emprestar_lote(ids, usuario_id, dias=PRAZO_EMPRESTIMO_DIAS):
+    # Uma transacao (e um fsync) para a pilha inteira de livros; devolve o
+    # resultado de cada id, na ordem pedida.
+    ids = [int(id_livro) for id_livro in ids]
+    agora = datetime.now()
+    emprestado_em = agora.isoformat(sep=" ", timespec="seconds")
+    devolucao_prevista = (agora + timedelta(days=dias)).date().isoformat()
+
+    def operacao(cursor):
+        resultados, aceitos = _classificar_lote(cursor, ids, 1)
+        cursor.executemany("""
+            UPDATE livros
+            SET disponivel = 0,
+                usuario_id = ?,
+                data_devolucao = ?
+            WHERE id = ?
+            AND disponivel = 1
+        """, [(usuario_id, devolucao_prevista, id_livro) for id_livro in aceitos])
+        cursor.executemany("""
+            INSERT INTO emprestimos (livro_id, usuario_id, emprestado_em, devolucao_prevista)
+            VALUES (?, ?, ?, ?)
+        """, [(id_livro, usuario_id, emprestado_em, devolucao_prevista) for id_livro in aceitos])
+        return resultados
+
+    if not ids:
+        return []
+    conn = conectar()
+    try:
+        return escrever(conn, operacao)
+    finally:
         conn.close()
-        return False, "Livro não encontrado"
 
-    estado_atual = resultado[0]
 
-    if estado_atual == int(status):
+def devolver_lote(ids):
+    ids = [int(id_livro) for id_livro in ids]
+    agora = datetime.now().isoformat(sep=" ", timespec="seconds")
+
+    def operacao(cursor):
+        resultados, aceitos = _classificar_lote(cursor, ids, 0)
+        cursor.executemany("""
+            UPDATE livros
+            SET disponivel = 1,
+                usuario_id = NULL,
+                data_devolucao = NULL
+            WHERE id = ?
+            AND disponivel = 0
+        """, [(id_livro,) for id_livro in aceitos])
+        cursor.executemany("""
+            UPDATE emprestimos
+            SET devolvido_em = ?
+            WHERE livro_id = ?
+            AND devolvido_em IS NULL
+        """, [(agora, id_livro) for id_livro in aceitos])
+        return resultados
+
+    if not ids:
+        return []
+    conn = conectar()
+    try:
+        return escrever(conn, operacao)
+    finally:
         conn.close()
-        return False, "Operação inválida"
+
+
+def listar_atrasados(hoje=None, apos=None, limite=POR_PAGINA):
+    # Keyset sobre (devolucao_prevista, id) no indice parcial de emprestimos
+    # abertos; "apos" e a tupla do ultimo item da pagina anterior.
+    hoje = (hoje or date.today()).isoformat()
+    ultima_data, ultimo_id = apos or ("", 0)
+
+    conn = conectar()
+    cursor = conn.cursor()
 
     cursor.execute("""
-        UPDATE livros
-        SET disponivel = ?
-        WHERE id = ?
-    """, (int(status), id))
+        SELECT emprestimos.id, emprestimos.livro_id, livros.titulo,
+               emprestimos.usuario_id, usuarios.nome AS usuario_nome,
+               emprestimos.emprestado_em, emprestimos.devolucao_prevista
+        FROM emprestimos
+        JOIN livros ON livros.id = emprestimos.livro_id
+        JOIN usuarios ON usuarios.id = emprestimos.usuario_id
+        WHERE emprestimos.devolvido_em IS NULL
+        AND emprestimos.devolucao_prevista < ?
+        AND (emprestimos.devolucao_prevista, emprestimos.id) > (?, ?)
+        ORDER BY emprestimos.devolucao_prevista, emprestimos.id
+        LIMIT ?
+    """, (hoje, ultima_data, ultimo_id, limite + 1))
+    atrasados = [dict(linha) for linha in cursor.fetchall()]
+
+    conn.close()
+
+    proximo = None
+    if len(atrasados) > limite:
+        atrasados = atrasados[:limite]
+        proximo = (atrasados[-1]["devolucao_prevista"], atrasados[-1]["id"])
+    return {"atrasados": atrasados, "proximo": proximo}
+
+
+def _filtro_usuarios(conn, termo):
+    # Devolve (juncao, condicoes, parametros) da busca de usuarios. Com
+    # usuarios_fts, cada palavra vale como prefixo em nome ou email; sem ele,
+    # o termo e um prefixo do nome ou do email, buscado por intervalo nos
+    # indices.
+    if not termo:
+        return "", [], []
+
+    if indice_fts(conn, "usuarios_fts"):
+        consulta = _consulta_fts(termo)
+        if not consulta:
+            return "", [], []
+        return (
+            "JOIN usuarios_fts ON usuarios_fts.rowid = usuarios.id",
+            ["usuarios_fts MATCH ?"],
+            [consulta],
+        )
+
+    email = termo.lower()
+    return (
+        "",
+        ["""((usuarios.nome COLLATE NOCASE >= ? AND usuarios.nome COLLATE NOCASE < ?)
+            OR (usuarios.email >= ? AND usuarios.email < ?))"""],
+        [termo, termo + "\U0010ffff", email, email + "\U0010ffff"],
+    )
+
+
+def listar_usuarios_pagina(termo="", apos=None, antes=None, limite=USUARIOS_POR_PAGINA):
+    # Seek sobre (nome, id) no indice idx_usuarios_nome; "apos" e "antes" sao
+    # tuplas (nome, id) do ultimo/primeiro usuario da pagina vizinha.
+    conn = conectar()
+    juncao, condicoes, parametros = _filtro_usuarios(conn, termo)
+    ordem = "ASC"
+
+    # A comparacao por row value nao usa o indice com COLLATE; a forma
+    # expandida vira uma busca por intervalo.
+    if antes is not None:
+        condicoes += [
+            "usuarios.nome COLLATE NOCASE <= ?",
+            "(usuarios.nome COLLATE NOCASE < ? OR usuarios.id < ?)",
+        ]
+        parametros += [antes[0], antes[0], antes[1]]
+        ordem = "DESC"
+    elif apos is not None:
+        condicoes += [
+            "usuarios.nome COLLATE NOCASE >= ?",
+            "(usuarios.nome COLLATE NOCASE > ? OR usuarios.id > ?)",
+        ]
+        parametros += [apos[0], apos[0], apos[1]]
+
+    where = f"WHERE {' AND '.join(condicoes)}" if condicoes else ""
+
+    cursor = conn.cursor()
+
+    cursor.execute(f"""
+        SELECT usuarios.id, usuarios.nome, usuarios.email, usuarios.tipo
+        FROM usuarios
+        {juncao}
+        {where}
+        ORDER BY usuarios.nome COLLATE NOCASE {ordem}, usuarios.id {ordem}
+        LIMIT ?
+    """, [*parametros, limite + 1])
+    usuarios = cursor.fetchall()
+
+    conn.close()
+
+    tem_mais = len(usuarios) > limite
+    usuarios = usuarios[:limite]
+    if antes is not None:
+        usuarios.reverse()
+        tem_anterior, tem_proxima = tem_mais, True
+    else:
+        tem_anterior, tem_proxima = apos is not None, tem_mais
+
+    return {
+        "usuarios": usuarios,
+        "anterior": (usuarios[0]["nome"], usuarios[0]["id"]) if usuarios and tem_anterior else None,
+        "proximo": (usuarios[-1]["nome"], usuarios[-1]["id"]) if usuarios and tem_proxima else None,
+    }
+
+
+def contar_usuarios(termo=""):
+    conn = conectar()
+    juncao, condicoes, parametros = _filtro_usuarios(conn, termo)
+    where = f"WHERE {' AND '.join(condicoes)}" if condicoes else ""
+
+    total = conn.execute(f"SELECT COUNT(*) FROM usuarios {juncao} {where}", parametros).fetchone()[0]
+    conn.close()
+    return total
+
+
+def sugerir_usuarios(termo, limite=LIMITE_SUGESTOES):
+    # Typeahead do emprestimo: poucos leitores (tipo 'usuario') cujo nome ou
+    # email comeca com o termo, sem nunca percorrer a tabela toda.
+    conn = conectar()
+    juncao, condicoes, parametros = _filtro_usuarios(conn, termo)
+    if not condicoes:
+        conn.close()
+        return []
+
+    cursor = conn.cursor()
 
+    cursor.execute(f"""
+        SELECT usuarios.id, usuarios.nome, usuarios.email
+        FROM usuarios
+        {juncao}
+        WHERE {' AND '.join(condicoes)}
+        AND usuarios.tipo = 'usuario'
+        ORDER BY usuarios.nome COLLATE NOCASE, usuarios.id
+        LIMIT ?
+    """, [*parametros, limite])
+    sugestoes = [dict(linha) for linha in cursor.fetchall()]
+
+    conn.close()
+    return sugestoes
+
+
+def buscar_usuario(id_usuario):
+    conn = conectar()
+    usuario = conn.execute(
+        "SELECT id, nome, email, senha, tipo FROM usuarios WHERE id = ?", (id_usuario,)
+    ).fetchone()
+    conn.close()
+    return usuario
+
+
+def buscar_usuario_por_email(email):
+    conn = conectar()
+    usuario = conn.execute(
+        "SELECT id, nome, email, senha, tipo FROM usuarios WHERE email = ?", (email,)
+    ).fetchone()
+    conn.close()
+    return usuario
+
+
+def total_usuarios():
+    conn = conectar()
+    total = conn.execute("SELECT COUNT(*) FROM usuarios").fetchone()[0]
+    conn.close()
+    return total
+
+
+def criar_usuario(nome, email, senha_hash, tipo="usuario"):
+    conn = conectar()
+    try:
+        cursor = conn.execute(
+            "INSERT INTO usuarios (nome, email, senha, tipo) VALUES (?, ?, ?, ?)",
+            (nome, email, senha_hash, tipo),
+        )
+        conn.commit()
+    except sqlite3.IntegrityError:
+        conn.rollback()
+        raise EmailDuplicado(email) from None
+    finally:
+        conn.close()
+    return cursor.lastrowid
+
+
+def atualizar_senha(id_usuario, senha_hash):
+    conn = conectar()
+    conn.execute("UPDATE usuarios SET senha = ? WHERE id = ?", (senha_hash, id_usuario))
     conn.commit()
     conn.close()
 
-    return True, "Atualizado com sucesso"
\ No newline at end of file
+
+def alterar_tipo_usuario(id_usuario, novo_tipo):
+    # Com o lock de escrita desde a leitura: dois admins rebaixando um ao
+    # outro ao mesmo tempo nao deixam o sistema sem administrador.
+    def operacao(cursor):
+        cursor.execute("SELECT tipo FROM usuarios WHERE id = ?", (id_usuario,))
+        linha = cursor.fetchone()
+        if linha is None:
+            return NAO_ENCONTRADO
+        if linha[0] == novo_tipo:
+            return SEM_ALTERACAO
+        if linha[0] == "admin":
+            cursor.execute("SELECT COUNT(*) FROM usuarios WHERE tipo = 'admin'")
+            if cursor.fetchone()[0] <= 1:
+                return ULTIMO_ADMIN
+        cursor.execute("UPDATE usuarios SET tipo = ? WHERE id = ?", (novo_tipo, id_usuario))
+        return OK
+
+    conn = conectar()
+    try:
+        return escrever(conn, operacao)
+    finally:
+        conn.close()
@@ -0,0 +1,978 @@
+import os
+import random
+import re
+import threading
+import time
+from datetime import date, datetime, timedelta
+
+from psycopg import Rollback, errors
+from psycopg.rows import class_row, dict_row, tuple_row
+from psycopg_pool import ConnectionPool
+
+from database import CONTADORES_ESTATISTICAS, ESPERA_ESCRITA, POOL_TAMANHO, POOL_TIMEOUT, TENTATIVAS_ESCRITA
+from estatisticas import DIAS_PAINEL, LIMITE_AUTORES, TABELAS, capturar, divergencias, montar_painel
+from models import (
+    CAMPOS_LIVRO,
+    CONFLITO,
+    NAO_ENCONTRADO,
+    OK,
+    SEM_ALTERACAO,
+    ULTIMO_ADMIN,
+    EmailDuplicado,
+    Livro,
+    chave_livro,
+)
+from services import (
+    LIMITE_BUSCA,
+    LIMITE_SUGESTOES,
+    MAX_LOTE_CIRCULACAO,
+    POR_PAGINA,
+    PRAZO_EMPRESTIMO_DIAS,
+    USUARIOS_POR_PAGINA,
+)
+
+# Backend PostgreSQL (DATABASE_BACKEND=postgres): mesmas funcoes e resultados
+# de services.py, com varios escritores ao mesmo tempo. Emprestimos e
+# devolucoes continuam sendo UPDATEs condicionais; em READ COMMITTED o
+# segundo escritor espera o lock da linha e reavalia o WHERE, entao so um
+# leva o livro.
+DATABASE_URL = os.getenv("DATABASE_URL", "postgresql:///biblioteca")
+POOL_MINIMO = int(os.getenv("DATABASE_POOL_MIN", "1"))
+
+# Chave do pg_advisory_xact_lock que serializa migracoes e importacoes.
+TRAVA_MIGRACOES = 7_420_001
+TRAVA_IMPORTACAO = 7_420_002
+
+_pool = None
+_pools_herdados = []
+_pool_lock = threading.Lock()
+
+
+def obter_pool():
+    global _pool
+    with _pool_lock:
+        # Como no pool do SQLite: depois de um fork as conexoes do pai nao
+        # podem ser usadas nem fechadas pelo filho.
+        if _pool is None or _pool.pid != os.getpid():
+            if _pool is not None:
+                _pools_herdados.append(_pool)
+            _pool = ConnectionPool(
+                DATABASE_URL,
+                min_size=POOL_MINIMO,
+                max_size=max(POOL_MINIMO, POOL_TAMANHO),
+                timeout=POOL_TIMEOUT,
+                kwargs={"row_factory": dict_row},
+                name="biblioteca",
+                open=True,
+            )
+            _pool.pid = os.getpid()
+        return _pool
+
+
+def fechar_pool():
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None and pool.pid == os.getpid():
+        pool.close()
+
+
+def _cursor_livros(conn):
+    return conn.cursor(row_factory=class_row(Livro))
+
+
+def _escrever(operacao):
+    # Equivalente ao database.escrever: operacao(cursor) em uma transacao,
+    # repetida com espera exponencial se o servidor a abortar por deadlock.
+    for tentativa in range(TENTATIVAS_ESCRITA):
+        try:
+            with obter_pool().connection() as conn:
+                with conn.transaction():
+                    return operacao(conn.cursor())
+        except (errors.DeadlockDetected, errors.SerializationFailure):
+            if tentativa == TENTATIVAS_ESCRITA - 1:
+                raise
+            time.sleep(ESPERA_ESCRITA * 2 ** tentativa * random.uniform(0.5, 1.5))
+
+
+# ==============================
+# SCHEMA
+# ==============================
+
+def _migracao_inicial(cursor):
+    # Mesmas tabelas e indices do SQLite. Sem chaves estrangeiras, como la
+    # (o SQLite nao as aplica): o historico de emprestimos sobrevive a
+    # remocao do livro. As colunas "busca" substituem os indices FTS5.
+    cursor.execute("""
+        CREATE TABLE usuarios (
+            id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+            nome TEXT NOT NULL,
+            email TEXT NOT NULL UNIQUE,
+            senha TEXT NOT NULL,
+            tipo TEXT NOT NULL CHECK (tipo IN ('admin', 'usuario')),
+            busca TSVECTOR GENERATED ALWAYS AS (
+                to_tsvector('simple', nome || ' ' || translate(email, '@.', '  '))
+            ) STORED
+        )
+    """)
+    cursor.execute('CREATE INDEX idx_usuarios_nome ON usuarios ((lower(nome) COLLATE "C"), id)')
+    cursor.execute('CREATE INDEX idx_usuarios_tipo_nome ON usuarios (tipo, (lower(nome) COLLATE "C"), id)')
+    cursor.execute("CREATE INDEX idx_usuarios_busca ON usuarios USING GIN (busca)")
+
+    cursor.execute("""
+        CREATE TABLE livros (
+            id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+            titulo TEXT NOT NULL,
+            autor TEXT NOT NULL,
+            ano INTEGER NOT NULL,
+            disponivel INTEGER NOT NULL DEFAULT 1,
+            usuario_id BIGINT,
+            data_devolucao TEXT,
+            chave TEXT,
+            busca TSVECTOR GENERATED ALWAYS AS (
+                setweight(to_tsvector('simple', titulo), 'A') || setweight(to_tsvector('simple', autor), 'B')
+            ) STORED
+        )
+    """)
+    cursor.execute("CREATE INDEX idx_livros_usuario_disponivel ON livros (usuario_id, disponivel)")
+    cursor.execute("CREATE INDEX idx_livros_chave ON livros (chave)")
+    cursor.execute("CREATE INDEX idx_livros_busca ON livros USING GIN (busca)")
+
+    cursor.execute("""
+        CREATE TABLE emprestimos (
+            id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+            livro_id BIGINT NOT NULL,
+            usuario_id BIGINT NOT NULL,
+            emprestado_em TEXT NOT NULL,
+            devolucao_prevista TEXT NOT NULL,
+            devolvido_em TEXT
+        )
+    """)
+    cursor.execute("""
+        CREATE INDEX idx_emprestimos_abertos_devolucao
+        ON emprestimos (devolucao_prevista, id)
+        WHERE devolvido_em IS NULL
+    """)
+    cursor.execute("""
+        CREATE UNIQUE INDEX idx_emprestimos_livro_aberto
+        ON emprestimos (livro_id)
+        WHERE devolvido_em IS NULL
+    """)
+    cursor.execute("CREATE INDEX idx_emprestimos_usuario ON emprestimos (usuario_id, emprestado_em)")
+
+    # Contadores dos caches e ETags. A trigger e adiada para o commit: a
+    # linha de versoes fica travada so durante o commit, e nao pela
+    # transacao inteira, entao escritores simultaneos nao fazem fila nela.
+    cursor.execute("""
+        CREATE TABLE versoes (
+            nome TEXT PRIMARY KEY,
+            valor BIGINT NOT NULL DEFAULT 0
+        )
+    """)
+    cursor.execute("INSERT INTO versoes (nome) VALUES ('usuarios'), ('catalogo')")
+    cursor.execute("""
+        CREATE FUNCTION avancar_versao() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            UPDATE versoes SET valor = valor + 1 WHERE nome = TG_ARGV[0];
+            RETURN NULL;
+        END
+        $$
+    """)
+    cursor.execute("""
+        CREATE CONSTRAINT TRIGGER livros_versao
+        AFTER INSERT OR UPDATE OR DELETE ON livros
+        DEFERRABLE INITIALLY DEFERRED
+        FOR EACH ROW EXECUTE FUNCTION avancar_versao('catalogo')
+    """)
+    cursor.execute("""
+        CREATE CONSTRAINT TRIGGER usuarios_versao
+        AFTER UPDATE OF nome, email, tipo OR DELETE ON usuarios
+        DEFERRABLE INITIALLY DEFERRED
+        FOR EACH ROW EXECUTE FUNCTION avancar_versao('usuarios')
+    """)
+
+
+def _trigger(cursor, nome, evento, corpo, quando=None):
+    # Trigger de linha (AFTER) cujo corpo PL/pgSQL fica numa funcao de mesmo
+    # nome, como os blocos BEGIN ... END das triggers do SQLite.
+    cursor.execute(f"""
+        CREATE FUNCTION {nome}() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            {corpo}
+            RETURN NULL;
+        END
+        $$
+    """)
+    condicao = f"WHEN ({quando})" if quando else ""
+    cursor.execute(f"CREATE TRIGGER {nome} AFTER {evento} FOR EACH ROW {condicao} EXECUTE FUNCTION {nome}()")
+
+
+def recalcular_estatisticas(cursor):
+    # Refaz as tabelas de resumo a partir de livros, usuarios e emprestimos,
+    # como database.recalcular_estatisticas; le as tabelas inteiras.
+    for tabela in TABELAS:
+        cursor.execute(f"DELETE FROM {tabela}")
+
+    cursor.execute("""
+        INSERT INTO estatisticas (nome, valor) VALUES
+            ('livros', (SELECT COUNT(*) FROM livros)),
+            ('emprestados', (SELECT COUNT(*) FROM livros WHERE disponivel = 0)),
+            ('leitores', (SELECT COUNT(*) FROM usuarios WHERE tipo = 'usuario')),
+            ('leitores_ativos', (
+                SELECT COUNT(DISTINCT usuario_id) FROM emprestimos WHERE devolvido_em IS NULL
+            )),
+            ('emprestimos', (SELECT COUNT(*) FROM emprestimos))
+    """)
+    cursor.execute("""
+        INSERT INTO estatisticas_autores (autor, livros, emprestimos)
+        -- Emprestimos de um autor = emprestimos dos livros que hoje sao dele.
+        SELECT autor, SUM(livros), SUM(emprestimos) FROM (
+            SELECT autor, COUNT(*) AS livros, 0 AS emprestimos FROM livros GROUP BY autor
+            UNION ALL
+            SELECT livros.autor, 0, COUNT(*) FROM emprestimos
+            JOIN livros ON livros.id = emprestimos.livro_id
+            GROUP BY livros.autor
+        ) AS parciais
+        GROUP BY autor
+    """)
+    cursor.execute("""
+        INSERT INTO estatisticas_dias (dia, emprestimos, devolucoes)
+        SELECT dia, SUM(emprestimos), SUM(devolucoes) FROM (
+            SELECT left(emprestado_em, 10) AS dia, COUNT(*) AS emprestimos, 0 AS devolucoes
+            FROM emprestimos GROUP BY 1
+            UNION ALL
+            SELECT left(devolvido_em, 10), 0, COUNT(*) FROM emprestimos
+            WHERE devolvido_em IS NOT NULL GROUP BY 1
+        ) AS parciais
+        GROUP BY dia
+    """)
+    cursor.execute("""
+        INSERT INTO estatisticas_leitores (usuario_id, abertos)
+        SELECT usuario_id, COUNT(*) FROM emprestimos
+        WHERE devolvido_em IS NULL
+        GROUP BY usuario_id
+    """)
+    cursor.execute("""
+        INSERT INTO estatisticas_vencimentos (dia, abertos)
+        SELECT devolucao_prevista, COUNT(*) FROM emprestimos
+        WHERE devolvido_em IS NULL
+        GROUP BY devolucao_prevista
+    """)
+
+
+def _migracao_estatisticas(cursor):
+    # Tabelas de resumo do painel, as mesmas do SQLite e com as mesmas
+    # regras (database._migracao_estatisticas e _migracao_estatisticas_autores).
+    # As triggers sao imediatas, e nao adiadas como a de versoes: as
+    # subconsultas dependem da ordem das escritas dentro da transacao.
+    cursor.execute("""
+        CREATE TABLE estatisticas (
+            nome TEXT PRIMARY KEY,
+            valor BIGINT NOT NULL DEFAULT 0
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE estatisticas_autores (
+            autor TEXT PRIMARY KEY,
+            livros BIGINT NOT NULL DEFAULT 0,
+            emprestimos BIGINT NOT NULL DEFAULT 0
+        )
+    """)
+    cursor.execute("CREATE INDEX idx_estatisticas_autores_emprestimos ON estatisticas_autores (emprestimos)")
+    cursor.execute("""
+        CREATE TABLE estatisticas_dias (
+            dia TEXT PRIMARY KEY,
+            emprestimos BIGINT NOT NULL DEFAULT 0,
+            devolucoes BIGINT NOT NULL DEFAULT 0
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE estatisticas_leitores (
+            usuario_id BIGINT PRIMARY KEY,
+            abertos BIGINT NOT NULL DEFAULT 0
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE estatisticas_vencimentos (
+            dia TEXT PRIMARY KEY,
+            abertos BIGINT NOT NULL DEFAULT 0
+        )
+    """)
+    cursor.execute("CREATE INDEX idx_emprestimos_livro ON emprestimos (livro_id)")
+
+    _trigger(cursor, "livros_estatisticas_ai", "INSERT ON livros", """
+            UPDATE estatisticas SET valor = valor + 1 WHERE nome = 'livros';
+            UPDATE estatisticas SET valor = valor + 1 WHERE nome = 'emprestados' AND new.disponivel = 0;
+            INSERT INTO estatisticas_autores (autor, livros) VALUES (new.autor, 1)
+            ON CONFLICT (autor) DO UPDATE SET livros = estatisticas_autores.livros + 1;
+    """)
+    _trigger(cursor, "livros_estatisticas_ad", "DELETE ON livros", """
+            UPDATE estatisticas SET valor = valor - 1 WHERE nome = 'livros';
+            UPDATE estatisticas SET valor = valor - 1 WHERE nome = 'emprestados' AND old.disponivel = 0;
+            UPDATE estatisticas_autores
+            SET livros = livros - 1,
+                emprestimos = emprestimos - (SELECT COUNT(*) FROM emprestimos WHERE livro_id = old.id)
+            WHERE autor = old.autor;
+            DELETE FROM estatisticas_autores WHERE autor = old.autor AND livros = 0 AND emprestimos = 0;
+    """)
+    _trigger(cursor, "livros_estatisticas_disponivel", "UPDATE OF disponivel ON livros", """
+            UPDATE estatisticas
+            SET valor = valor + CASE WHEN new.disponivel = 0 THEN 1 ELSE -1 END
+            WHERE nome = 'emprestados';
+    """, quando="(old.disponivel = 0) <> (new.disponivel = 0)")
+    _trigger(cursor, "livros_estatisticas_autor", "UPDATE OF autor ON livros", """
+            UPDATE estatisticas_autores
+            SET livros = livros - 1,
+                emprestimos = emprestimos - (SELECT COUNT(*) FROM emprestimos WHERE livro_id = old.id)
+            WHERE autor = old.autor;
+            DELETE FROM estatisticas_autores WHERE autor = old.autor AND livros = 0 AND emprestimos = 0;
+            INSERT INTO estatisticas_autores (autor, livros, emprestimos)
+            VALUES (new.autor, 1, (SELECT COUNT(*) FROM emprestimos WHERE livro_id = new.id))
+            ON CONFLICT (autor) DO UPDATE SET
+                livros = estatisticas_autores.livros + 1,
+                emprestimos = estatisticas_autores.emprestimos + excluded.emprestimos;
+    """, quando="old.autor <> new.autor")
+
+    _trigger(cursor, "usuarios_estatisticas_ai", "INSERT ON usuarios", """
+            UPDATE estatisticas SET valor = valor + 1 WHERE nome = 'leitores';
+    """, quando="new.tipo = 'usuario'")
+    _trigger(cursor, "usuarios_estatisticas_ad", "DELETE ON usuarios", """
+            UPDATE estatisticas SET valor = valor - 1 WHERE nome = 'leitores';
+    """, quando="old.tipo = 'usuario'")
+    _trigger(cursor, "usuarios_estatisticas_tipo", "UPDATE OF tipo ON usuarios", """
+            UPDATE estatisticas
+            SET valor = valor + CASE WHEN new.tipo = 'usuario' THEN 1 ELSE -1 END
+            WHERE nome = 'leitores';
+    """, quando="old.tipo <> new.tipo")
+
+    _trigger(cursor, "emprestimos_estatisticas_ai", "INSERT ON emprestimos", """
+            UPDATE estatisticas SET valor = valor + 1 WHERE nome = 'emprestimos';
+            INSERT INTO estatisticas_dias (dia, emprestimos) VALUES (left(new.emprestado_em, 10), 1)
+            ON CONFLICT (dia) DO UPDATE SET emprestimos = estatisticas_dias.emprestimos + 1;
+            UPDATE estatisticas_autores SET emprestimos = emprestimos + 1
+            WHERE autor = (SELECT autor FROM livros WHERE id = new.livro_id);
+
+            IF new.devolvido_em IS NULL THEN
+                INSERT INTO estatisticas_leitores (usuario_id, abertos) VALUES (new.usuario_id, 1)
+                ON CONFLICT (usuario_id) DO UPDATE SET abertos = estatisticas_leitores.abertos + 1;
+                UPDATE estatisticas SET valor = valor + 1
+                WHERE nome = 'leitores_ativos'
+                AND (SELECT abertos FROM estatisticas_leitores WHERE usuario_id = new.usuario_id) = 1;
+
+                INSERT INTO estatisticas_vencimentos (dia, abertos) VALUES (new.devolucao_prevista, 1)
+                ON CONFLICT (dia) DO UPDATE SET abertos = estatisticas_vencimentos.abertos + 1;
+            END IF;
+    """)
+    _trigger(cursor, "emprestimos_estatisticas_devolucao", "UPDATE OF devolvido_em ON emprestimos", """
+            INSERT INTO estatisticas_dias (dia, devolucoes) VALUES (left(new.devolvido_em, 10), 1)
+            ON CONFLICT (dia) DO UPDATE SET devolucoes = estatisticas_dias.devolucoes + 1;
+
+            UPDATE estatisticas_leitores SET abertos = abertos - 1 WHERE usuario_id = old.usuario_id;
+            UPDATE estatisticas SET valor = valor - 1
+            WHERE nome = 'leitores_ativos'
+            AND (SELECT abertos FROM estatisticas_leitores WHERE usuario_id = old.usuario_id) = 0;
+            DELETE FROM estatisticas_leitores WHERE usuario_id = old.usuario_id AND abertos = 0;
+
+            UPDATE estatisticas_vencimentos SET abertos = abertos - 1 WHERE dia = old.devolucao_prevista;
+            DELETE FROM estatisticas_vencimentos WHERE dia = old.devolucao_prevista AND abertos = 0;
+    """, quando="old.devolvido_em IS NULL AND new.devolvido_em IS NOT NULL")
+
+    recalcular_estatisticas(cursor)
+
+
+def _migracao_busca_sem_acentos(cursor):
+    # Como o remove_diacritics do FTS5: "acao" encontra "ação". unaccent()
+    # nao e IMMUTABLE (depende do dicionario padrao), entao as colunas
+    # geradas e as consultas usam sem_acentos(), com o dicionario fixo.
+    cursor.execute("CREATE EXTENSION IF NOT EXISTS unaccent")
+    cursor.execute("""
+        CREATE FUNCTION sem_acentos(TEXT) RETURNS TEXT
+        LANGUAGE sql IMMUTABLE STRICT PARALLEL SAFE
+        AS $$ SELECT public.unaccent('public.unaccent'::regdictionary, $1) $$
+    """)
+
+    # Coluna gerada nao muda de expressao: sai e volta (com o indice).
+    cursor.execute("ALTER TABLE livros DROP COLUMN busca")
+    cursor.execute("""
+        ALTER TABLE livros ADD COLUMN busca TSVECTOR GENERATED ALWAYS AS (
+            setweight(to_tsvector('simple', sem_acentos(titulo)), 'A')
+            || setweight(to_tsvector('simple', sem_acentos(autor)), 'B')
+        ) STORED
+    """)
+    cursor.execute("CREATE INDEX idx_livros_busca ON livros USING GIN (busca)")
+
+    cursor.execute("ALTER TABLE usuarios DROP COLUMN busca")
+    cursor.execute("""
+        ALTER TABLE usuarios ADD COLUMN busca TSVECTOR GENERATED ALWAYS AS (
+            to_tsvector('simple', sem_acentos(nome || ' ' || translate(email, '@.', '  ')))
+        ) STORED
+    """)
+    cursor.execute("CREATE INDEX idx_usuarios_busca ON usuarios USING GIN (busca)")
+
+
+# Migracoes em ordem; novas migracoes sempre no final.
+MIGRACOES = [
+    (1, _migracao_inicial),
+    (2, _migracao_estatisticas),
+    (3, _migracao_busca_sem_acentos),
+]
+VERSAO_SCHEMA = MIGRACOES[-1][0]
+
+
+def criar_tabelas():
+    aplicadas = []
+    with obter_pool().connection() as conn:
+        with conn.transaction():
+            # DDL no PostgreSQL e transacional: tudo ou nada, um processo
+            # por vez.
+            conn.execute("SELECT pg_advisory_xact_lock(%s)", (TRAVA_MIGRACOES,))
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS schema_migracoes (
+                    numero INTEGER PRIMARY KEY,
+                    aplicada_em TIMESTAMPTZ NOT NULL DEFAULT now()
+                )
+            """)
+            feitas = {linha["numero"] for linha in conn.execute("SELECT numero FROM schema_migracoes")}
+            for numero, migracao in MIGRACOES:
+                if numero in feitas:
+                    continue
+                migracao(conn.cursor())
+                conn.execute("INSERT INTO schema_migracoes (numero) VALUES (%s)", (numero,))
+                aplicadas.append(numero)
+        if aplicadas:
+            conn.execute("ANALYZE")
+    return aplicadas
+
+
+def ler_versao(nome):
+    with obter_pool().connection() as conn:
+        linha = conn.execute("SELECT valor FROM versoes WHERE nome = %s", (nome,)).fetchone()
+    return linha["valor"] if linha else 0
+
+
+# ==============================
+# LIVROS
+# ==============================
+
+def adicionar_livro(livro):
+    with obter_pool().connection() as conn:
+        conn.execute("""
+            INSERT INTO livros (titulo, autor, ano, disponivel, chave)
+            VALUES (%s, %s, %s, %s, %s)
+        """, (livro.titulo, livro.autor, livro.ano, int(livro.disponivel), chave_livro(livro.titulo, livro.autor, livro.ano)))
+
+
+def atualizar_livro(id, novo_titulo, novo_autor, novo_ano):
+    with obter_pool().connection() as conn:
+        conn.execute("""
+            UPDATE livros
+            SET titulo = %s, autor = %s, ano = %s, chave = %s
+            WHERE id = %s
+        """, (novo_titulo, novo_autor, novo_ano, chave_livro(novo_titulo, novo_autor, novo_ano), id))
+
+
+def remover_livro(id):
+    # Como no SQLite: livro com emprestimo em aberto nao e removido.
+    def operacao(cursor):
+        cursor.execute("""
+            DELETE FROM livros
+            WHERE id = %s
+            AND NOT EXISTS (
+                SELECT 1 FROM emprestimos
+                WHERE livro_id = %s AND devolvido_em IS NULL
+            )
+        """, (id, id))
+        if cursor.rowcount == 1:
+            return OK
+        return _resultado_sem_alteracao(cursor, id)
+
+    return _escrever(operacao)
+
+
+def buscar_por_id(id):
+    with obter_pool().connection() as conn:
+        return _cursor_livros(conn).execute(f"SELECT {CAMPOS_LIVRO} FROM livros WHERE id = %s", (id,)).fetchone()
+
+
+def buscar_por_ids(ids):
+    # Devolve os livros na ordem dos ids pedidos, ignorando os inexistentes.
+    ids = list(dict.fromkeys(int(id) for id in ids))
+    if not ids:
+        return []
+
+    with obter_pool().connection() as conn:
+        cursor = _cursor_livros(conn).execute(f"SELECT {CAMPOS_LIVRO} FROM livros WHERE id = ANY(%s)", (ids,))
+        encontrados = {livro.id: livro for livro in cursor}
+    return [encontrados[id] for id in ids if id in encontrados]
+
+
+def _consulta_tsquery(termo):
+    # Cada palavra vira um prefixo: "dom casm" -> dom:* & casm:*
+    return " & ".join(f"{palavra}:*" for palavra in re.findall(r"\w+", termo))
+
+
+def buscar_por_titulo(titulo, limite=LIMITE_BUSCA):
+    consulta = _consulta_tsquery(titulo)
+    if not consulta:
+        return []
+
+    # Peso A no titulo e B no autor, como o bm25(10, 1) do SQLite.
+    with obter_pool().connection() as conn:
+        return _cursor_livros(conn).execute(f"""
+            SELECT {CAMPOS_LIVRO} FROM livros
+            WHERE busca @@ to_tsquery('simple', sem_acentos(%(consulta)s))
+            ORDER BY ts_rank(busca, to_tsquery('simple', sem_acentos(%(consulta)s))) DESC, id
+            LIMIT %(limite)s
+        """, {"consulta": consulta, "limite": limite}).fetchall()
+
+
+def buscar_nas_unidades(termo, limite=LIMITE_BUSCA):
+    # As unidades (UNIDADES) existem so com o SQLite, e o create_app recusa
+    # a combinacao com este backend: aqui o acervo e um banco so.
+    return [(None, livro) for livro in buscar_por_titulo(termo, limite)]
+
+
+def listar_livros_pagina(apos=None, antes=None, limite=POR_PAGINA):
+    with obter_pool().connection() as conn:
+        cursor = _cursor_livros(conn)
+        if antes is not None:
+            livros = cursor.execute(
+                f"SELECT {CAMPOS_LIVRO} FROM livros WHERE id < %s ORDER BY id DESC LIMIT %s",
+                (antes, limite + 1),
+            ).fetchall()
+        else:
+            livros = cursor.execute(
+                f"SELECT {CAMPOS_LIVRO} FROM livros WHERE id > %s ORDER BY id LIMIT %s",
+                (apos or 0, limite + 1),
+            ).fetchall()
+
+        tem_mais = len(livros) > limite
+        livros = livros[:limite]
+
+        if antes is not None:
+            livros.reverse()
+            tem_anterior = tem_mais
+            tem_proxima = conn.execute("SELECT 1 FROM livros WHERE id >= %s LIMIT 1", (antes,)).fetchone() is not None
+        else:
+            tem_proxima = tem_mais
+            tem_anterior = conn.execute("SELECT 1 FROM livros WHERE id <= %s LIMIT 1", (apos or 0,)).fetchone() is not None
+
+    return {
+        "livros": livros,
+        "anterior": livros[0].id if livros and tem_anterior else None,
+        "proximo": livros[-1].id if livros and tem_proxima else None,
+    }
+
+
+def listar_livros_do_usuario(usuario_id):
+    with obter_pool().connection() as conn:
+        return _cursor_livros(conn).execute(f"""
+            SELECT {CAMPOS_LIVRO} FROM livros
+            WHERE usuario_id = %s
+            AND disponivel = 0
+        """, (usuario_id,)).fetchall()
+
+
+def inserir_livros_novos(lote):
+    # lote: [(titulo, autor, ano, chave)] em um unico INSERT. DISTINCT ON
+    # fica com a primeira ocorrencia de cada chave dentro do lote, e a trava
+    # impede que duas importacoes simultaneas insiram a mesma chave.
+    titulos, autores, anos, chaves = (list(coluna) for coluna in zip(*lote))
+    with obter_pool().connection() as conn:
+        with conn.transaction():
+            conn.execute("SELECT pg_advisory_xact_lock(%s)", (TRAVA_IMPORTACAO,))
+            cursor = conn.execute("""
+                INSERT INTO livros (titulo, autor, ano, disponivel, chave)
+                SELECT titulo, autor, ano, 1, chave FROM (
+                    SELECT DISTINCT ON (novos.chave) novos.*
+                    FROM unnest(%s::text[], %s::text[], %s::int[], %s::text[])
+                        WITH ORDINALITY AS novos (titulo, autor, ano, chave, ordem)
+                    WHERE NOT EXISTS (SELECT 1 FROM livros WHERE livros.chave = novos.chave)
+                    ORDER BY novos.chave, novos.ordem
+                ) AS unicos
+                ORDER BY ordem
+            """, (titulos, autores, anos, chaves))
+            return cursor.rowcount
+
+
+def ler_em_lotes(consulta, tamanho):
+    # Cursor no servidor (DECLARE ... CURSOR): o PostgreSQL entrega "tamanho"
+    # linhas por ida e volta, sem materializar o resultado no worker.
+    pool = obter_pool()
+    conn = pool.getconn()
+    try:
+        with conn.transaction():
+            with conn.cursor(name="ler_em_lotes", row_factory=tuple_row) as cursor:
+                cursor.itersize = tamanho
+                cursor.execute(consulta)
+                yield [coluna.name for coluna in cursor.description]
+                while True:
+                    linhas = cursor.fetchmany(tamanho)
+                    if not linhas:
+                        break
+                    yield linhas
+    finally:
+        pool.putconn(conn)
+
+
+# ==============================
+# EMPRESTIMOS
+# ==============================
+
+def _resultado_sem_alteracao(cursor, id_livro):
+    cursor.execute("SELECT 1 FROM livros WHERE id = %s", (id_livro,))
+    return CONFLITO if cursor.fetchone() else NAO_ENCONTRADO
+
+
+def emprestar_livro(id_livro, usuario_id, dias=PRAZO_EMPRESTIMO_DIAS):
+    agora = datetime.now()
+    devolucao_prevista = (agora + timedelta(days=dias)).date().isoformat()
+
+    def operacao(cursor):
+        cursor.execute("""
+            UPDATE livros
+            SET disponivel = 0,
+                usuario_id = %s,
+                data_devolucao = %s
+            WHERE id = %s
+            AND disponivel = 1
+        """, (usuario_id, devolucao_prevista, id_livro))
+        if cursor.rowcount != 1:
+            return _resultado_sem_alteracao(cursor, id_livro)
+
+        cursor.execute("""
+            INSERT INTO emprestimos (livro_id, usuario_id, emprestado_em, devolucao_prevista)
+            VALUES (%s, %s, %s, %s)
+        """, (id_livro, usuario_id, agora.isoformat(sep=" ", timespec="seconds"), devolucao_prevista))
+        return OK
+
+    return _escrever(operacao)
+
+
+def devolver_livro(id_livro):
+    agora = datetime.now().isoformat(sep=" ", timespec="seconds")
+
+    def operacao(cursor):
+        cursor.execute("""
+            UPDATE livros
+            SET disponivel = 1,
+                usuario_id = NULL,
+                data_devolucao = NULL
+            WHERE id = %s
+            AND disponivel = 0
+        """, (id_livro,))
+        if cursor.rowcount != 1:
+            return _resultado_sem_alteracao(cursor, id_livro)
+
+        cursor.execute("""
+            UPDATE emprestimos
+            SET devolvido_em = %s
+            WHERE livro_id = %s
+            AND devolvido_em IS NULL
+        """, (agora, id_livro))
+        return OK
+
+    return _escrever(operacao)
+
+
+def _classificar_lote(cursor, ids, disponivel):
+    # FOR UPDATE trava as linhas do lote ate o commit, sempre em ordem de id
+    # para que dois lotes concorrentes nao entrem em deadlock.
+    cursor.execute(
+        "SELECT id, disponivel FROM livros WHERE id = ANY(%s) ORDER BY id FOR UPDATE",
+        (list(set(ids)),),
+    )
+    estados = {linha["id"]: linha["disponivel"] for linha in cursor.fetchall()}
+
+    resultados = []
+    aceitos = []
+    for id_livro in ids:
+        if id_livro not in estados:
+            resultados.append((id_livro, NAO_ENCONTRADO))
+        elif estados[id_livro] != disponivel:
+            resultados.append((id_livro, CONFLITO))
+        else:
+            resultados.append((id_livro, OK))
+            aceitos.append(id_livro)
+            estados[id_livro] = 1 - disponivel
+    return resultados, aceitos
+
+
+def emprestar_lote(ids, usuario_id, dias=PRAZO_EMPRESTIMO_DIAS):
+    ids = [int(id_livro) for id_livro in ids]
+    agora = datetime.now()
+    emprestado_em = agora.isoformat(sep=" ", timespec="seconds")
+    devolucao_prevista = (agora + timedelta(days=dias)).date().isoformat()
+
+    def operacao(cursor):
+        resultados, aceitos = _classificar_lote(cursor, ids, 1)
+        if aceitos:
+            cursor.execute("""
+                UPDATE livros
+                SET disponivel = 0,
+                    usuario_id = %s,
+                    data_devolucao = %s
+                WHERE id = ANY(%s)
+                AND disponivel = 1
+            """, (usuario_id, devolucao_prevista, aceitos))
+            cursor.executemany("""
+                INSERT INTO emprestimos (livro_id, usuario_id, emprestado_em, devolucao_prevista)
+                VALUES (%s, %s, %s, %s)
+            """, [(id_livro, usuario_id, emprestado_em, devolucao_prevista) for id_livro in aceitos])
+        return resultados
+
+    if not ids:
+        return []
+    return _escrever(operacao)
+
+
+def devolver_lote(ids):
+    ids = [int(id_livro) for id_livro in ids]
+    agora = datetime.now().isoformat(sep=" ", timespec="seconds")
+
+    def operacao(cursor):
+        resultados, aceitos = _classificar_lote(cursor, ids, 0)
+        if aceitos:
+            cursor.execute("""
+                UPDATE livros
+                SET disponivel = 1,
+                    usuario_id = NULL,
+                    data_devolucao = NULL
+                WHERE id = ANY(%s)
+                AND disponivel = 0
+            """, (aceitos,))
+            cursor.execute("""
+                UPDATE emprestimos
+                SET devolvido_em = %s
+                WHERE livro_id = ANY(%s)
+                AND devolvido_em IS NULL
+            """, (agora, aceitos))
+        return resultados
+
+    if not ids:
+        return []
+    return _escrever(operacao)
+
+
+def listar_atrasados(hoje=None, apos=None, limite=POR_PAGINA):
+    hoje = (hoje or date.today()).isoformat()
+    ultima_data, ultimo_id = apos or ("", 0)
+
+    with obter_pool().connection() as conn:
+        atrasados = conn.execute("""
+            SELECT emprestimos.id, emprestimos.livro_id, livros.titulo,
+                   emprestimos.usuario_id, usuarios.nome AS usuario_nome,
+                   emprestimos.emprestado_em, emprestimos.devolucao_prevista
+            FROM emprestimos
+            JOIN livros ON livros.id = emprestimos.livro_id
+            JOIN usuarios ON usuarios.id = emprestimos.usuario_id
+            WHERE emprestimos.devolvido_em IS NULL
+            AND emprestimos.devolucao_prevista < %s
+            AND (emprestimos.devolucao_prevista, emprestimos.id) > (%s, %s)
+            ORDER BY emprestimos.devolucao_prevista, emprestimos.id
+            LIMIT %s
+        """, (hoje, ultima_data, ultimo_id, limite + 1)).fetchall()
+
+    proximo = None
+    if len(atrasados) > limite:
+        atrasados = atrasados[:limite]
+        proximo = (atrasados[-1]["devolucao_prevista"], atrasados[-1]["id"])
+    return {"atrasados": atrasados, "proximo": proximo}
+
+
+# ==============================
+# USUARIOS
+# ==============================
+
+def buscar_usuario(id_usuario):
+    with obter_pool().connection() as conn:
+        return conn.execute(
+            "SELECT id, nome, email, senha, tipo FROM usuarios WHERE id = %s", (id_usuario,)
+        ).fetchone()
+
+
+def buscar_usuario_por_email(email):
+    with obter_pool().connection() as conn:
+        return conn.execute(
+            "SELECT id, nome, email, senha, tipo FROM usuarios WHERE email = %s", (email,)
+        ).fetchone()
+
+
+def total_usuarios():
+    with obter_pool().connection() as conn:
+        return conn.execute("SELECT COUNT(*) AS total FROM usuarios").fetchone()["total"]
+
+
+def criar_usuario(nome, email, senha_hash, tipo="usuario"):
+    try:
+        with obter_pool().connection() as conn:
+            linha = conn.execute(
+                "INSERT INTO usuarios (nome, email, senha, tipo) VALUES (%s, %s, %s, %s) RETURNING id",
+                (nome, email, senha_hash, tipo),
+            ).fetchone()
+    except errors.UniqueViolation:
+        raise EmailDuplicado(email) from None
+    return linha["id"]
+
+
+def atualizar_senha(id_usuario, senha_hash):
+    with obter_pool().connection() as conn:
+        conn.execute("UPDATE usuarios SET senha = %s WHERE id = %s", (senha_hash, id_usuario))
+
+
+def alterar_tipo_usuario(id_usuario, novo_tipo):
+    def operacao(cursor):
+        cursor.execute("SELECT tipo FROM usuarios WHERE id = %s FOR UPDATE", (id_usuario,))
+        linha = cursor.fetchone()
+        if linha is None:
+            return NAO_ENCONTRADO
+        if linha["tipo"] == novo_tipo:
+            return SEM_ALTERACAO
+        if linha["tipo"] == "admin":
+            # Trava todos os admins: dois rebaixamentos simultaneos nao
+            # deixam o sistema sem administrador.
+            cursor.execute("SELECT COUNT(*) AS total FROM (SELECT 1 FROM usuarios WHERE tipo = 'admin' FOR UPDATE) AS admins")
+            if cursor.fetchone()["total"] <= 1:
+                return ULTIMO_ADMIN
+        cursor.execute("UPDATE usuarios SET tipo = %s WHERE id = %s", (novo_tipo, id_usuario))
+        return OK
+
+    return _escrever(operacao)
+
+
+_NOME_ORDEM = 'lower(usuarios.nome) COLLATE "C"'
+
+
+def _filtro_usuarios(termo):
+    # Cada palavra vale como prefixo em nome ou email (coluna "busca"), sem
+    # diferenciar acentos.
+    consulta = _consulta_tsquery(termo) if termo else ""
+    if not consulta:
+        return [], []
+    return ["usuarios.busca @@ to_tsquery('simple', sem_acentos(%s))"], [consulta]
+
+
+def listar_usuarios_pagina(termo="", apos=None, antes=None, limite=USUARIOS_POR_PAGINA):
+    condicoes, parametros = _filtro_usuarios(termo)
+    ordem = "ASC"
+
+    if antes is not None:
+        condicoes.append(f'({_NOME_ORDEM}, usuarios.id) < (lower(%s) COLLATE "C", %s)')
+        parametros += [antes[0], antes[1]]
+        ordem = "DESC"
+    elif apos is not None:
+        condicoes.append(f'({_NOME_ORDEM}, usuarios.id) > (lower(%s) COLLATE "C", %s)')
+        parametros += [apos[0], apos[1]]
+
+    where = f"WHERE {' AND '.join(condicoes)}" if condicoes else ""
+
+    with obter_pool().connection() as conn:
+        usuarios = conn.execute(f"""
+            SELECT usuarios.id, usuarios.nome, usuarios.email, usuarios.tipo
+            FROM usuarios
+            {where}
+            ORDER BY {_NOME_ORDEM} {ordem}, usuarios.id {ordem}
+            LIMIT %s
+        """, [*parametros, limite + 1]).fetchall()
+
+    tem_mais = len(usuarios) > limite
+    usuarios = usuarios[:limite]
+    if antes is not None:
+        usuarios.reverse()
+        tem_anterior, tem_proxima = tem_mais, True
+    else:
+        tem_anterior, tem_proxima = apos is not None, tem_mais
+
+    return {
+        "usuarios": usuarios,
+        "anterior": (usuarios[0]["nome"], usuarios[0]["id"]) if usuarios and tem_anterior else None,
+        "proximo": (usuarios[-1]["nome"], usuarios[-1]["id"]) if usuarios and tem_proxima else None,
+    }
+
+
+def contar_usuarios(termo=""):
+    condicoes, parametros = _filtro_usuarios(termo)
+    where = f"WHERE {' AND '.join(condicoes)}" if condicoes else ""
+
+    with obter_pool().connection() as conn:
+        return conn.execute(f"SELECT COUNT(*) AS total FROM usuarios {where}", parametros).fetchone()["total"]
+
+
+def sugerir_usuarios(termo, limite=LIMITE_SUGESTOES):
+    condicoes, parametros = _filtro_usuarios(termo)
+    if not condicoes:
+        return []
+
+    with obter_pool().connection() as conn:
+        return conn.execute(f"""
+            SELECT usuarios.id, usuarios.nome, usuarios.email
+            FROM usuarios
+            WHERE {' AND '.join(condicoes)}
+            AND usuarios.tipo = 'usuario'
+            ORDER BY {_NOME_ORDEM}, usuarios.id
+            LIMIT %s
+        """, [*parametros, limite]).fetchall()
+
+
+# ==============================
+# ESTATISTICAS
+# ==============================
+
+def ler_painel(hoje=None, dias=DIAS_PAINEL):
+    # Como estatisticas.ler_painel: so as tabelas de resumo, por chave ou
+    # indice.
+    hoje = hoje or date.today()
+    inicio = (hoje - timedelta(days=dias - 1)).isoformat()
+
+    with obter_pool().connection() as conn:
+        cursor = conn.cursor(row_factory=tuple_row)
+
+        contadores = dict.fromkeys(CONTADORES_ESTATISTICAS, 0)
+        contadores.update(cursor.execute(
+            "SELECT nome, valor FROM estatisticas WHERE nome = ANY(%s)",
+            (list(CONTADORES_ESTATISTICAS),),
+        ).fetchall())
+
+        atrasados = cursor.execute("""
+            SELECT COALESCE(SUM(abertos), 0)::BIGINT
+            FROM estatisticas_vencimentos
+            WHERE dia < %s
+        """, (hoje.isoformat(),)).fetchone()[0]
+
+        autores = [
+            {"autor": autor, "livros": livros, "emprestimos": emprestimos}
+            for autor, livros, emprestimos in cursor.execute("""
+                SELECT autor, livros, emprestimos
+                FROM estatisticas_autores
+                WHERE emprestimos > 0
+                ORDER BY emprestimos DESC
+                LIMIT %s
+            """, (LIMITE_AUTORES,)).fetchall()
+        ]
+
+        por_dia = {
+            dia: (emprestimos, devolucoes)
+            for dia, emprestimos, devolucoes in cursor.execute("""
+                SELECT dia, emprestimos, devolucoes
+                FROM estatisticas_dias
+                WHERE dia >= %s
+                ORDER BY dia
+            """, (inicio,)).fetchall()
+        }
+
+    return montar_painel(contadores, atrasados, autores, por_dia, hoje, dias)
+
+
+def reconstruir_estatisticas(verificar=False):
+    # Como estatisticas.reconstruir. O LOCK em modo SHARE segura as escritas
+    # nas tabelas de origem (as leituras continuam) ate o fim da transacao.
+    with obter_pool().connection() as conn:
+        with conn.transaction():
+            conn.execute("LOCK TABLE livros, usuarios, emprestimos IN SHARE MODE")
+            cursor = conn.cursor(row_factory=tuple_row)
+            antes = capturar(cursor)
+            recalcular_estatisticas(cursor)
+            encontradas = divergencias(antes, capturar(cursor))
+            if verificar:
+                raise Rollback()
+    return encontradas
@@ -1,14 +1,49 @@
+import gzip
 import importlib
+import io
+import json
+import multiprocessing
 import os
 import re
+import shutil
+import sqlite3
+import subprocess
+import sys
 import tempfile
+import threading
+import time
 import unittest
+from datetime import date
 from unittest.mock import patch
 
 from flask import get_flashed_messages
 from werkzeug.security import generate_password_hash
 
+import api
+import backup
+import benchmark
+import comandos
 import database
+import estatisticas
+import importacao
+import limites
+import metricas
+import senhas
+import services
+from models import Livro
+
+
+def _emprestar_em_paralelo(caminho, usuario_id, barreira, resultados):
+    # Roda em threads e em processos (spawn) disputando o mesmo livro.
+    database.DATABASE = caminho
+    barreira.wait()
+    resultados.put(services.emprestar_livro(1, usuario_id))
+
+
+def _tentar_login_em_outro_processo(caminho, ip, vezes):
+    database.DATABASE = caminho
+    for _ in range(vezes):
+        limites.verificar_tentativa(ip, None)
 
 
 class BibliotecaAppTests(unittest.TestCase):
@@ -19,6 +54,11 @@ class BibliotecaAppTests(unittest.TestCase):
 
         database.DATABASE = cls._db_path
 
+        # Modo estrito em toda a suite: um request que varre uma tabela sem
+        # indice ou executa SQL demais falha o teste.
+        cls._estrito = patch.object(metricas, "ESTRITO", True)
+        cls._estrito.start()
+
         import app as app_module
 
         cls.app_module = importlib.reload(app_module)
@@ -27,13 +67,19 @@ class BibliotecaAppTests(unittest.TestCase):
 
     @classmethod
     def tearDownClass(cls):
+        cls._estrito.stop()
+        database.fechar_pools()
         cls._tmpdir.cleanup()
 
     def setUp(self):
+        database.fechar_pools()
         if os.path.exists(self._db_path):
             os.remove(self._db_path)
 
         database.DATABASE = self._db_path
+        self.app_module.usuarios_cache.limpar()
+        self.app_module.acervo_cache.limpar()
+        self.app_module.usuarios_contagem_cache.limpar()
         self.app_module.criar_tabelas()
         self._seed_data()
         self.client = self.app.test_client()
@@ -63,7 +109,14 @@ class BibliotecaAppTests(unittest.TestCase):
             INSERT INTO livros (id, titulo, autor, ano, disponivel, usuario_id, data_devolucao)
             VALUES (?, ?, ?, ?, ?, ?, ?)
             """,
-            (2, "Flask Pratico", "Autor B", 2023, 0, 2, "25/02/2026"),
+            (2, "Flask Pratico", "Autor B", 2023, 0, 2, "2026-02-25"),
+        )
+        cursor.execute(
+            """
+            INSERT INTO emprestimos (livro_id, usuario_id, emprestado_em, devolucao_prevista)
+            VALUES (?, ?, ?, ?)
+            """,
+            (2, 2, "2026-02-18 10:00:00", "2026-02-25"),
         )
 
         conn.commit()
@@ -77,6 +130,10 @@ class BibliotecaAppTests(unittest.TestCase):
         self.assertIsNotNone(match)
         return match.group(1)
 
+    def _csrf_from_cliente(self, cliente, url):
+        html = cliente.get(url).data.decode("utf-8")
+        return re.search(r'name="csrf_token" value="([^"]+)"', html).group(1)
+
     def _login(self, email, senha):
         token = self._csrf_from("/login")
         return self.client.post(
@@ -149,6 +206,23 @@ class BibliotecaAppTests(unittest.TestCase):
         conn.close()
         self.assertEqual(total, 0)
 
+    def test_livro_emprestado_nao_pode_ser_removido(self):
+        self._login("admin@local.test", "admin123")
+        token = self._csrf_from("/")
+
+        response = self.client.post("/remover/2", data={"csrf_token": token}, follow_redirects=True)
+        self.assertIn(b"registre a devolucao antes de remover", response.data)
+        self.assertIsNotNone(services.buscar_por_id(2))
+
+        # O emprestimo segue aberto e visivel no relatorio e no painel.
+        self.assertEqual(len(services.listar_atrasados(hoje=date(2026, 10, 17))["atrasados"]), 1)
+        painel = estatisticas.ler_painel(hoje=date(2026, 10, 17))
+        self.assertEqual((painel["atrasados"], painel["leitores_ativos"]), (1, 1))
+
+        self.assertEqual(services.devolver_livro(2), services.OK)
+        self.assertEqual(services.remover_livro(2), services.OK)
+        self.assertEqual(services.remover_livro(2), services.NAO_ENCONTRADO)
+
     def test_admin_can_emprestar_livro_with_csrf(self):
         self._login("admin@local.test", "admin123")
         token = self._csrf_from("/emprestar/1")
@@ -169,7 +243,16 @@ class BibliotecaAppTests(unittest.TestCase):
 
         self.assertEqual(livro["disponivel"], 0)
         self.assertEqual(livro["usuario_id"], 2)
-        self.assertIsNotNone(livro["data_devolucao"])
+        self.assertRegex(livro["data_devolucao"], r"^\d{4}-\d{2}-\d{2}$")
+
+        conn = database.conectar()
+        emprestimo = conn.execute(
+            "SELECT usuario_id, devolucao_prevista, devolvido_em FROM emprestimos WHERE livro_id = 1"
+        ).fetchone()
+        conn.close()
+        self.assertEqual(emprestimo["usuario_id"], 2)
+        self.assertEqual(emprestimo["devolucao_prevista"], livro["data_devolucao"])
+        self.assertIsNone(emprestimo["devolvido_em"])
 
     def test_admin_can_devolver_livro_with_csrf(self):
         self._login("admin@local.test", "admin123")
@@ -193,6 +276,12 @@ class BibliotecaAppTests(unittest.TestCase):
         self.assertIsNone(livro["usuario_id"])
         self.assertIsNone(livro["data_devolucao"])
 
+        conn = database.conectar()
+        historico = conn.execute("SELECT devolvido_em FROM emprestimos WHERE livro_id = 2").fetchall()
+        conn.close()
+        self.assertEqual(len(historico), 1)
+        self.assertIsNotNone(historico[0]["devolvido_em"])
+
     def test_nao_permite_remover_ultimo_admin(self):
         class DummyAdmin:
             id = 999
@@ -206,6 +295,1053 @@ class BibliotecaAppTests(unittest.TestCase):
         self.assertEqual(response.status_code, 302)
         self.assertTrue(any("ultimo administrador" in mensagem for mensagem in mensagens))
 
+    def test_conexao_reaproveitada_no_request(self):
+        with self.app.test_request_context("/"):
+            primeira = database.conectar()
+            primeira.close()
+            segunda = database.conectar()
+            self.assertIs(primeira, segunda)
+            self.assertEqual(segunda.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+
+        estatisticas = database.estatisticas_pool()
+        self.assertEqual(estatisticas["em_uso"], 0)
+        self.assertGreaterEqual(estatisticas["checkouts"], 1)
+        self.assertIn("espera_max_ms", estatisticas)
+
+    def test_pool_devolve_conexao_sem_transacao_pendente(self):
+        conn = database.conectar()
+        conn.execute("UPDATE livros SET titulo = 'Rascunho' WHERE id = 1")
+        conn.close()
+
+        conn = database.conectar()
+        titulo = conn.execute("SELECT titulo FROM livros WHERE id = 1").fetchone()["titulo"]
+        conn.close()
+        self.assertEqual(titulo, "Python Limpo")
+
+    def test_busca_fts_por_prefixo_e_sem_acento(self):
+        services.adicionar_livro(Livro("Introdução à Computação", "José Araújo", 2020))
+
+        titulos = [livro.titulo for livro in services.buscar_por_titulo("introducao comp")]
+        self.assertEqual(titulos, ["Introdução à Computação"])
+        self.assertEqual([livro.id for livro in services.buscar_por_titulo("arauj")], [3])
+
+    def test_busca_fts_acompanha_edicao_e_remocao(self):
+        services.atualizar_livro(1, "Go Idiomatico", "Autor A", 2024)
+        self.assertEqual(services.buscar_por_titulo("python"), [])
+        self.assertEqual([livro.id for livro in services.buscar_por_titulo("idioma")], [1])
+
+        services.remover_livro(1)
+        self.assertEqual(services.buscar_por_titulo("idioma"), [])
+
+    def test_busca_usa_like_sem_fts5(self):
+        with patch.object(services, "indice_fts", return_value=False):
+            livros = services.buscar_por_titulo("Prat")
+        self.assertEqual([livro.id for livro in livros], [2])
+
+    def test_busca_sem_tabela_fts_no_banco_usa_like(self):
+        # Banco criado por uma build sem FTS5, aberto por uma que tem.
+        self.assertEqual([livro.id for livro in services.buscar_por_titulo("Prat")], [2])
+        conn = database.conectar()
+        conn.execute("DROP TABLE livros_fts")
+        conn.execute("DROP TABLE usuarios_fts")
+        conn.commit()
+        conn.close()
+        database.fechar_pools()
+
+        self.assertEqual([livro.id for livro in services.buscar_por_titulo("Prat")], [2])
+        self.assertEqual(services.contar_usuarios("user@"), 1)
+
+    def test_admin_busca_no_index(self):
+        self._login("admin@local.test", "admin123")
+        response = self.client.get("/?busca=flask")
+        self.assertIn(b"Flask Pratico", response.data)
+        self.assertNotIn(b"Python Limpo", response.data)
+
+    def test_listagem_paginada_por_chave(self):
+        for numero in range(3, 8):
+            services.adicionar_livro(Livro(f"Livro {numero}", "Autor C", 2000))
+
+        primeira = services.listar_livros_pagina(limite=3)
+        self.assertEqual([livro.id for livro in primeira["livros"]], [1, 2, 3])
+        self.assertIsNone(primeira["anterior"])
+        self.assertEqual(primeira["proximo"], 3)
+
+        segunda = services.listar_livros_pagina(apos=primeira["proximo"], limite=3)
+        self.assertEqual([livro.id for livro in segunda["livros"]], [4, 5, 6])
+        self.assertEqual(segunda["anterior"], 4)
+
+        ultima = services.listar_livros_pagina(apos=segunda["proximo"], limite=3)
+        self.assertEqual([livro.id for livro in ultima["livros"]], [7])
+        self.assertIsNone(ultima["proximo"])
+
+        voltando = services.listar_livros_pagina(antes=segunda["anterior"], limite=3)
+        self.assertEqual([livro.id for livro in voltando["livros"]], [1, 2, 3])
+        self.assertIsNone(voltando["anterior"])
+        self.assertEqual(voltando["proximo"], 3)
+
+    def test_index_exibe_controles_de_pagina(self):
+        self._login("admin@local.test", "admin123")
+        response = self.client.get("/?apos=1")
+        self.assertIn(b"Flask Pratico", response.data)
+        self.assertNotIn(b"Python Limpo", response.data)
+        self.assertIn(b"?antes=2", response.data)
+
+    def test_busca_por_ids_em_lote_preserva_ordem(self):
+        livros = services.buscar_por_ids([2, 99, 1, 2])
+        self.assertEqual([livro.id for livro in livros], [2, 1])
+        self.assertIsInstance(livros[0], Livro)
+        self.assertEqual(livros[0].data_devolucao, "2026-02-25")
+        self.assertFalse(hasattr(livros[0], "__dict__"))
+
+    def test_editar_busca_livro_pela_chave(self):
+        self._login("admin@local.test", "admin123")
+        with patch.object(self.app_module, "buscar_por_id", wraps=services.buscar_por_id) as buscar:
+            response = self.client.get("/editar/2")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'value="Flask Pratico"', response.data)
+        buscar.assert_called_once_with(2)
+
+    def test_migracoes_registram_versao_e_criam_indices(self):
+        conn = database.conectar()
+        self.assertEqual(database.versao_schema(conn), database.VERSAO_SCHEMA)
+        plano = conn.execute(
+            "EXPLAIN QUERY PLAN SELECT id, nome FROM usuarios WHERE tipo = 'usuario' ORDER BY nome COLLATE NOCASE"
+        ).fetchall()
+        conn.close()
+
+        self.assertIn("COVERING INDEX idx_usuarios_tipo_nome", plano[0]["detail"])
+        self.assertEqual(database.criar_tabelas(), [])
+
+    def test_migracoes_atualizam_banco_legado(self):
+        caminho = os.path.join(self._tmpdir.name, "legado.db")
+        legado = sqlite3.connect(caminho)
+        legado.executescript(
+            """
+            CREATE TABLE usuarios (id INTEGER PRIMARY KEY AUTOINCREMENT, nome TEXT NOT NULL,
+                email TEXT NOT NULL UNIQUE, senha TEXT NOT NULL, tipo TEXT NOT NULL);
+            CREATE TABLE livros (id INTEGER PRIMARY KEY AUTOINCREMENT, titulo TEXT NOT NULL,
+                autor TEXT NOT NULL, ano INTEGER NOT NULL, disponivel INTEGER NOT NULL DEFAULT 1,
+                usuario_id INTEGER, data_devolucao TEXT);
+            INSERT INTO usuarios (nome, email, senha, tipo) VALUES ('Leitor', 'leitor@local.test', 'x', 'usuario');
+            INSERT INTO livros (titulo, autor, ano) VALUES ('Memorias Postumas', 'Machado', 1881);
+            INSERT INTO livros (titulo, autor, ano, disponivel, usuario_id, data_devolucao)
+            VALUES ('Quincas Borba', 'Machado', 1891, 0, 1, '10/03/2026');
+            """
+        )
+        legado.close()
+
+        with patch.object(database, "DATABASE", caminho):
+            self.assertEqual(database.criar_tabelas(), [numero for numero, _ in database.MIGRACOES])
+            self.assertEqual([livro.titulo for livro in services.buscar_por_titulo("memor")], ["Memorias Postumas"])
+
+            conn = database.conectar()
+            indices = {linha["name"] for linha in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+            emprestimo = conn.execute("SELECT livro_id, usuario_id, devolucao_prevista FROM emprestimos").fetchone()
+            data = conn.execute("SELECT data_devolucao FROM livros WHERE id = 2").fetchone()["data_devolucao"]
+            conn.close()
+        self.assertIn("idx_livros_usuario_disponivel", indices)
+        self.assertEqual(data, "2026-03-10")
+        self.assertEqual(tuple(emprestimo), (2, 1, "2026-03-10"))
+
+    def test_load_user_usa_cache(self):
+        self._login("admin@local.test", "admin123")
+        self.client.get("/")
+        hits_antes = self.app_module.usuarios_cache.estatisticas()["hits"]
+
+        self.client.get("/")
+        self.assertGreater(self.app_module.usuarios_cache.estatisticas()["hits"], hits_antes)
+
+    def test_cache_de_usuario_ve_alteracao_de_outro_worker(self):
+        self._login("user@local.test", "user123")
+        response = self.client.get("/usuarios", follow_redirects=True)
+        self.assertIn(b"Acesso restrito ao administrador", response.data)
+
+        # Simula outro processo promovendo o usuario direto no banco.
+        outro_worker = sqlite3.connect(self._db_path)
+        outro_worker.execute("UPDATE usuarios SET tipo = 'admin' WHERE id = 2")
+        outro_worker.commit()
+        outro_worker.close()
+
+        # Dentro do intervalo o worker nao volta ao banco.
+        response = self.client.get("/usuarios", follow_redirects=True)
+        self.assertIn(b"Acesso restrito ao administrador", response.data)
+
+        with patch.object(self.app_module, "USUARIO_CACHE_VERSAO_INTERVALO", 0):
+            response = self.client.get("/usuarios")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b"user@local.test", response.data)
+
+    def test_versao_do_cache_de_usuario_nao_e_lida_a_cada_request(self):
+        self._login("user@local.test", "user123")
+        with patch.object(self.app_module, "ler_versao", wraps=self.app_module.ler_versao) as ler_versao:
+            for _ in range(3):
+                self.client.get("/")
+        self.assertEqual(ler_versao.call_count, 0)
+
+    def test_alterar_tipo_invalida_cache_do_usuario(self):
+        self.app_module.usuarios_cache.de(None).guardar("2", self.app_module.Usuario(2, "Usuario", "user@local.test", "usuario"))
+        self._login("admin@local.test", "admin123")
+        token = self._csrf_from("/usuarios")
+
+        with patch.object(self.app_module, "USUARIO_CACHE_VERSAO", False):
+            self.client.post("/usuarios/2/tipo", data={"tipo": "admin", "csrf_token": token})
+        self.assertIsNone(self.app_module.usuarios_cache.de(None).obter("2"))
+
+    def test_login_regrava_hash_com_custo_antigo(self):
+        conn = database.conectar()
+        conn.execute(
+            "UPDATE usuarios SET senha = ? WHERE id = 2",
+            (generate_password_hash("user123", method="pbkdf2:sha256:1000"),),
+        )
+        conn.commit()
+        conn.close()
+
+        response = self._login("user@local.test", "user123")
+        self.assertIn(b"Login realizado com sucesso", response.data)
+
+        conn = database.conectar()
+        senha = conn.execute("SELECT senha FROM usuarios WHERE id = 2").fetchone()["senha"]
+        conn.close()
+        self.assertTrue(senha.startswith(senhas.METODO_NORMALIZADO + "$"))
+        self.assertFalse(senhas.precisa_atualizar(senha))
+
+    def test_hash_lento_vira_503_e_segura_a_vaga_ate_terminar(self):
+        vagas = threading.BoundedSemaphore(1)
+        with patch.object(senhas, "SENHA_WORKERS", 1), patch.object(senhas, "_vagas", vagas):
+            # Sobe o pool antes de encurtar o timeout.
+            senhas._executar(time.sleep, 0)
+
+            with patch.object(senhas, "SENHA_TIMEOUT", 0.05):
+                with self.assertRaises(senhas.HashOcupado):
+                    senhas._executar(time.sleep, 1)
+                # O calculo que estourou o tempo ainda ocupa a unica vaga.
+                self.assertFalse(vagas.acquire(blocking=False))
+
+                token = self._csrf_from("/login")
+                response = self.client.post(
+                    "/login",
+                    data={"email": "admin@local.test", "senha": "admin123", "csrf_token": token},
+                )
+                self.assertEqual(response.status_code, 503)
+                self.assertEqual(response.headers["Retry-After"], "1")
+
+        self.assertTrue(vagas.acquire(timeout=10))
+
+    def test_login_rejeita_rapido_com_fila_de_hash_cheia(self):
+        token = self._csrf_from("/login")
+        vagas = threading.BoundedSemaphore(1)
+        vagas.acquire()
+
+        with patch.object(senhas, "SENHA_WORKERS", 1), patch.object(senhas, "_vagas", vagas):
+            response = self.client.post(
+                "/login",
+                data={"email": "admin@local.test", "senha": "admin123", "csrf_token": token},
+            )
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers["Retry-After"], "1")
+
+    def test_normaliza_metodo_de_hash(self):
+        self.assertEqual(senhas.normalizar_metodo("scrypt"), "scrypt:32768:8:1")
+        self.assertEqual(senhas.normalizar_metodo("pbkdf2:sha256:1000"), "pbkdf2:sha256:1000")
+        with self.assertRaises(ValueError):
+            senhas.normalizar_metodo("md5")
+
+    def test_create_app_nao_escreve_no_banco(self):
+        caminho = os.path.join(self._tmpdir.name, "inexistente.db")
+        with patch.object(database, "DATABASE", caminho):
+            app = self.app_module.create_app({"TESTING": True})
+        self.assertIn("biblioteca", app.blueprints)
+        self.assertFalse(os.path.exists(caminho))
+
+    def test_create_app_recusa_unidades_fora_do_sqlite(self):
+        with patch.object(self.app_module, "BACKEND", "postgres"), \
+                patch.object(self.app_module, "UNIDADES", {"norte": "norte.db"}):
+            with self.assertRaisesRegex(RuntimeError, "UNIDADES exige DATABASE_BACKEND=sqlite"):
+                self.app_module.create_app({"TESTING": True})
+
+    def test_banco_local_de_outro_backend_tem_so_o_limitador(self):
+        caminho = os.path.join(self._tmpdir.name, "local.db")
+        with patch.object(database, "DATABASE", caminho):
+            database.criar_tabela_limites()
+            database.criar_tabela_limites()
+            conn = database.conectar()
+            tabelas = [linha[0] for linha in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+            conn.close()
+            database.fechar_pools()
+        self.assertEqual(tabelas, ["limites_tentativas"])
+
+    def test_comando_init_db_cria_schema_e_admin_padrao(self):
+        caminho = os.path.join(self._tmpdir.name, "novo.db")
+        runner = self.app.test_cli_runner()
+        with patch.object(database, "DATABASE", caminho), patch.object(senhas, "SENHA_WORKERS", 0):
+            resultado = runner.invoke(args=["init-db"])
+            self.assertEqual(resultado.exit_code, 0, resultado.output)
+            self.assertIn("admin@admin.com", resultado.output)
+
+            resultado = runner.invoke(args=["init-db"])
+            self.assertIn(f"versao {database.VERSAO_SCHEMA}", resultado.output)
+            self.assertEqual(database.versao_schema_arquivo(), database.VERSAO_SCHEMA)
+
+    def test_comando_migrate_passwords_converte_senhas_legadas(self):
+        conn = database.conectar()
+        conn.executemany(
+            "INSERT INTO usuarios (nome, email, senha, tipo) VALUES (?, ?, ?, 'usuario')",
+            [(f"Legado {n}", f"legado{n}@local.test", f"senha{n}") for n in range(5)],
+        )
+        conn.commit()
+        conn.close()
+
+        with patch.object(senhas, "SENHA_WORKERS", 0):
+            resultado = self.app.test_cli_runner().invoke(args=["migrate-passwords", "--lote", "2"])
+        self.assertEqual(resultado.exit_code, 0, resultado.output)
+        self.assertIn("5 senhas migradas", resultado.output)
+
+        conn = database.conectar()
+        senha = conn.execute("SELECT senha FROM usuarios WHERE email = 'legado3@local.test'").fetchone()["senha"]
+        conn.close()
+        self.assertTrue(senhas.eh_hash(senha))
+        self.assertTrue(senhas.verificar_hash(senha, "senha3"))
+
+    def test_comando_create_admin(self):
+        with patch.object(senhas, "SENHA_WORKERS", 0):
+            resultado = self.app.test_cli_runner().invoke(
+                args=["create-admin", "--nome", "Nova", "--email", "Nova@Local.test", "--senha", "segredo"]
+            )
+            self.assertEqual(resultado.exit_code, 0, resultado.output)
+            response = self._login("nova@local.test", "segredo")
+        self.assertIn(b"Login realizado com sucesso", response.data)
+
+    def test_importacao_csv_valida_e_deduplica(self):
+        services.adicionar_livro(Livro("Dom Casmurro", "Machado de Assis", 1899))
+        conteudo = (
+            "titulo,autor,ano\n"
+            "dom  casmurro,MACHADO DE ASSIS,1899\n"
+            "Iracema,José de Alencar,1865\n"
+            "Iracema,Jose de Alencar,1865\n"
+            ",Sem Titulo,2000\n"
+            "O Cortiço,Aluísio Azevedo,abc\n"
+        )
+
+        resultado = importacao.importar_livros(importacao.ler_linhas(io.StringIO(conteudo), "csv"), lote=2)
+
+        self.assertEqual(resultado["lidas"], 5)
+        self.assertEqual(resultado["inseridas"], 1)
+        self.assertEqual(resultado["duplicadas"], 2)
+        self.assertEqual(resultado["erros"], [(5, "titulo obrigatorio"), (6, "ano deve ser um numero inteiro")])
+        self.assertEqual([livro.titulo for livro in services.buscar_por_titulo("iracema")], ["Iracema"])
+
+    def test_comando_import_books_jsonl(self):
+        caminho = os.path.join(self._tmpdir.name, "livros.jsonl")
+        with open(caminho, "w", encoding="utf-8") as arquivo:
+            arquivo.write('{"titulo": "Vidas Secas", "autor": "Graciliano Ramos", "ano": 1938}\n')
+            arquivo.write("nao e json\n")
+
+        resultado = self.app.test_cli_runner().invoke(args=["import-books", caminho])
+        self.assertEqual(resultado.exit_code, 0, resultado.output)
+        self.assertIn("1 inseridas", resultado.output)
+        self.assertIn("Linha 2: JSON invalido", resultado.output)
+
+    def test_admin_importa_csv_pelo_upload(self):
+        self._login("admin@local.test", "admin123")
+        token = self._csrf_from("/importar")
+
+        response = self.client.post(
+            "/importar",
+            data={
+                "csrf_token": token,
+                "arquivo": (io.BytesIO("titulo,autor,ano\nSão Bernardo,Graciliano Ramos,1934\n".encode()), "livros.csv"),
+            },
+            content_type="multipart/form-data",
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b"1 livros adicionados", response.data)
+        self.assertEqual(len(services.buscar_por_titulo("sao bernardo")), 1)
+
+    def test_exporta_acervo_em_csv_com_nome_do_usuario(self):
+        self._login("admin@local.test", "admin123")
+        response = self.client.get("/exportar/livros.csv")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.is_streamed)
+        self.assertIn('filename="livros.csv"', response.headers["Content-Disposition"])
+
+        linhas = response.data.decode("utf-8").splitlines()
+        self.assertEqual(linhas[0], "id,titulo,autor,ano,disponivel,usuario_id,usuario_nome,data_devolucao")
+        self.assertEqual(linhas[2], "2,Flask Pratico,Autor B,2023,0,2,Usuario,2026-02-25")
+        self.assertEqual(len(linhas), 3)
+
+    def test_exporta_emprestimos_em_jsonl_com_gzip(self):
+        self._login("admin@local.test", "admin123")
+        response = self.client.get("/exportar/emprestimos.jsonl?gzip=1")
+        self.assertEqual(response.mimetype, "application/gzip")
+
+        linhas = gzip.decompress(response.data).decode("utf-8").splitlines()
+        self.assertEqual([json.loads(linha)["titulo"] for linha in linhas], ["Flask Pratico"])
+        self.assertEqual(database.estatisticas_pool()["em_uso"], 0)
+
+    def test_comando_export(self):
+        caminho = os.path.join(self._tmpdir.name, "livros.csv.gz")
+        resultado = self.app.test_cli_runner().invoke(args=["export", "livros", "--gzip", "--saida", caminho])
+        self.assertEqual(resultado.exit_code, 0, resultado.output)
+        with gzip.open(caminho, "rt", encoding="utf-8") as arquivo:
+            self.assertEqual(len(arquivo.read().splitlines()), 3)
+
+    def test_api_lista_livros_com_cursor_e_campos(self):
+        self._login("admin@local.test", "admin123")
+        response = self.client.get("/api/v1/livros?limite=1&campos=id,titulo")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json, {"dados": [{"id": 1, "titulo": "Python Limpo"}], "proximo": 1})
+
+        response = self.client.get("/api/v1/livros?limite=1&apos=1&campos=id,usuario_id")
+        self.assertEqual(response.json, {"dados": [{"id": 2, "usuario_id": 2}], "proximo": None})
+
+    def test_api_restringe_campos_e_exige_login(self):
+        self.assertEqual(self.client.get("/api/v1/livros").status_code, 401)
+
+        self._login("user@local.test", "user123")
+        response = self.client.get("/api/v1/livros?campos=usuario_id")
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("usuario_id", response.json["erro"])
+
+        response = self.client.get("/api/v1/meus-livros")
+        self.assertEqual(response.json["dados"][0]["data_devolucao"], "2026-02-25")
+        self.assertEqual(self.client.get("/api/v1/livros/99").status_code, 404)
+
+    def test_api_etag_responde_304_sem_consultar_livros(self):
+        self._login("admin@local.test", "admin123")
+        response = self.client.get("/api/v1/livros")
+        etag = response.headers["ETag"]
+
+        with patch.object(api, "listar_livros_pagina") as listar:
+            response = self.client.get("/api/v1/livros", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 304)
+        listar.assert_not_called()
+
+        services.atualizar_livro(1, "Python Limpo 2", "Autor A", 2024)
+        response = self.client.get("/api/v1/livros", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers["ETag"], etag)
+
+    def test_tabela_do_acervo_vem_do_cache_ate_o_catalogo_mudar(self):
+        self._login("admin@local.test", "admin123")
+        self.client.get("/")
+        hits = self.app_module.acervo_cache.estatisticas()["hits"]
+
+        with patch.object(self.app_module, "listar_livros_pagina") as listar:
+            response = self.client.get("/")
+        listar.assert_not_called()
+        self.assertIn(b"Python Limpo", response.data)
+        self.assertEqual(self.app_module.acervo_cache.estatisticas()["hits"], hits + 1)
+
+        services.adicionar_livro(Livro("Livro Novo", "Autor C", 2025))
+        response = self.client.get("/")
+        self.assertIn(b"Livro Novo", response.data)
+
+    def test_fragmento_em_cache_usa_token_csrf_da_sessao(self):
+        self._login("admin@local.test", "admin123")
+        self.client.get("/")
+
+        self.client = self.app.test_client()
+        self._login("admin@local.test", "admin123")
+        html = self.client.get("/").data.decode("utf-8")
+        with self.client.session_transaction() as sessao:
+            token = sessao["csrf_token"]
+
+        self.assertGreater(self.app_module.acervo_cache.estatisticas()["hits"], 0)
+        self.assertEqual(set(re.findall(r'name="csrf_token" value="([^"]+)"', html)), {token})
+
+    def test_relatorio_de_atrasados_usa_indice_e_pagina(self):
+        services.adicionar_livro(Livro("Livro Novo", "Autor C", 2025))
+        services.emprestar_livro(3, 2, dias=-30)
+        services.emprestar_livro(1, 2, dias=30)
+
+        pagina = services.listar_atrasados(hoje=date(2026, 10, 17), limite=1)
+        self.assertEqual([item["livro_id"] for item in pagina["atrasados"]], [2])
+        pagina = services.listar_atrasados(hoje=date(2026, 10, 17), apos=pagina["proximo"], limite=1)
+        self.assertEqual([item["titulo"] for item in pagina["atrasados"]], ["Livro Novo"])
+        self.assertIsNone(pagina["proximo"])
+
+        conn = database.conectar()
+        plano = conn.execute(
+            """
+            EXPLAIN QUERY PLAN SELECT id FROM emprestimos
+            WHERE devolvido_em IS NULL AND devolucao_prevista < ? AND (devolucao_prevista, id) > (?, ?)
+            ORDER BY devolucao_prevista, id
+            """,
+            ("2026-10-17", "", 0),
+        ).fetchall()
+        conn.close()
+        self.assertIn("idx_emprestimos_abertos_devolucao", plano[0]["detail"])
+
+    def test_pagina_e_api_de_atrasados_so_para_admin(self):
+        self._login("user@local.test", "user123")
+        self.assertEqual(self.client.get("/api/v1/atrasados").status_code, 403)
+
+        self._login("admin@local.test", "admin123")
+        response = self.client.get("/atrasados")
+        self.assertIn(b"Flask Pratico", response.data)
+        self.assertIn(b"25/02/2026", response.data)
+
+        response = self.client.get("/api/v1/atrasados")
+        self.assertEqual(response.json["dados"][0]["devolucao_prevista"], "2026-02-25")
+        self.assertIsNone(response.json["proximo"])
+
+    def test_estatisticas_acompanham_escritas_sem_divergir(self):
+        painel = estatisticas.ler_painel(hoje=date(2026, 10, 17))
+        self.assertEqual((painel["livros"], painel["emprestados"], painel["atrasados"]), (2, 1, 1))
+        self.assertEqual((painel["leitores"], painel["leitores_ativos"]), (1, 1))
+
+        services.adicionar_livro(Livro("Livro Novo", "Autor B", 2025))
+        self.assertEqual(services.emprestar_livro(1, 2), services.OK)
+        services.devolver_lote([2])
+        services.remover_livro(3)
+
+        painel = estatisticas.ler_painel()
+        self.assertEqual((painel["livros"], painel["emprestados"], painel["atrasados"]), (2, 1, 0))
+        self.assertEqual(painel["leitores_ativos"], 1)
+        self.assertEqual(painel["emprestimos_total"], 2)
+        self.assertEqual(
+            {autor["autor"]: (autor["livros"], autor["emprestimos"]) for autor in painel["autores"]},
+            {"Autor A": (1, 1), "Autor B": (1, 1)},
+        )
+        self.assertEqual(painel["movimento"][-1]["emprestimos"], 1)
+        self.assertEqual(painel["movimento"][-1]["devolucoes"], 1)
+        self.assertEqual(estatisticas.reconstruir(verificar=True), [])
+
+        # Os emprestimos contam para o autor atual do livro: mudar o autor de
+        # um livro emprestado leva o historico junto, e remover um livro
+        # devolvido tira os emprestimos dele do ranking.
+        services.atualizar_livro(1, "Python Limpo", "Autor C", 2024)
+        services.remover_livro(2)
+
+        painel = estatisticas.ler_painel()
+        self.assertEqual(
+            {autor["autor"]: (autor["livros"], autor["emprestimos"]) for autor in painel["autores"]},
+            {"Autor C": (1, 1)},
+        )
+        self.assertEqual(painel["emprestimos_total"], 2)
+        self.assertEqual(estatisticas.reconstruir(verificar=True), [])
+
+    def test_rebuild_stats_corrige_divergencias(self):
+        conn = database.conectar()
+        conn.execute("UPDATE estatisticas SET valor = 99 WHERE nome = 'livros'")
+        conn.commit()
+        conn.close()
+
+        resultado = self.app.test_cli_runner().invoke(args=["rebuild-stats", "--verificar"])
+        self.assertEqual(resultado.exit_code, 1)
+        self.assertIn("estatisticas[livros]: (99,) -> (2,)", resultado.output)
+        self.assertEqual(estatisticas.ler_painel()["livros"], 99)
+
+        resultado = self.app.test_cli_runner().invoke(args=["rebuild-stats"])
+        self.assertEqual(resultado.exit_code, 0)
+        self.assertEqual(estatisticas.ler_painel()["livros"], 2)
+        self.assertEqual(estatisticas.reconstruir(verificar=True), [])
+
+    def test_backup_online_verifica_e_restaura(self):
+        diretorio = os.path.join(self._tmpdir.name, "backups")
+        self.addCleanup(shutil.rmtree, diretorio, True)
+
+        # Escritas de outra conexao durante a copia nao a reiniciam nem entram
+        # nela: o backup e o retrato do inicio.
+        parar = threading.Event()
+
+        def escrever_sem_parar():
+            conn = sqlite3.connect(self._db_path, timeout=5)
+            while not parar.is_set():
+                conn.execute("INSERT INTO livros (titulo, autor, ano) VALUES ('Concorrente', 'X', 2000)")
+                conn.commit()
+            conn.close()
+
+        escritor = threading.Thread(target=escrever_sem_parar)
+        escritor.start()
+        try:
+            resultado = backup.fazer_backup("principal", self._db_path, diretorio=diretorio, paginas=1, pausa=0.001)
+        finally:
+            parar.set()
+            escritor.join()
+
+        self.assertTrue(resultado["arquivo"].endswith(".db.gz"))
+        self.assertGreater(resultado["passos"], 1)
+        self.assertEqual(resultado["esperas_lock"], 0)
+        resumo = backup.verificar(resultado["arquivo"])
+        self.assertEqual(resumo["sha256"], resultado["sha256"])
+        self.assertEqual(resumo["versao"], database.VERSAO_SCHEMA)
+        self.assertGreaterEqual(resumo["livros"], 2)
+
+        versao_catalogo = database.ler_versao("catalogo")
+        self.app_module.adicionar_livro(Livro("Depois do backup", "Autor C", 2025))
+        backup.restaurar(backup.listar_backups("principal", diretorio)[0], self._db_path)
+
+        self.assertEqual(services.buscar_por_titulo("depois"), [])
+        self.assertEqual(services.buscar_por_id(1).titulo, "Python Limpo")
+        self.assertGreater(database.ler_versao("catalogo"), versao_catalogo + 1)
+
+    def test_backup_rotacao_e_verificacao_pelo_cli(self):
+        diretorio = os.path.join(self._tmpdir.name, "backups")
+        self.addCleanup(shutil.rmtree, diretorio, True)
+        runner = self.app.test_cli_runner()
+
+        for _ in range(3):
+            resultado = runner.invoke(args=["backup", "--diretorio", diretorio, "--manter", "2"])
+            self.assertEqual(resultado.exit_code, 0, resultado.output)
+        self.assertIn("MB/s", resultado.output)
+        self.assertIn("removido", resultado.output)
+
+        arquivos = backup.listar_backups("principal", diretorio)
+        self.assertEqual(len(arquivos), 2)
+        self.assertEqual(len([nome for nome in os.listdir(diretorio) if nome.endswith(".sha256")]), 2)
+        with open(os.path.join(diretorio, backup.RELATORIO), encoding="utf-8") as entrada:
+            self.assertEqual(json.load(entrada)["backups"][0]["arquivo"], arquivos[0])
+
+        resultado = runner.invoke(args=["backup-verify", *arquivos])
+        self.assertEqual(resultado.exit_code, 0, resultado.output)
+        self.assertIn("sha256 ok", resultado.output)
+
+        with open(arquivos[0], "r+b") as arquivo:
+            arquivo.seek(40)
+            arquivo.write(b"corrompido")
+        resultado = runner.invoke(args=["backup-verify", arquivos[0]])
+        self.assertEqual(resultado.exit_code, 1)
+        self.assertIn("sha256 nao confere", resultado.output)
+
+        os.remove(f"{arquivos[0]}.sha256")
+        with self.assertRaises(backup.BackupInvalido):
+            backup.verificar(arquivos[0])
+
+        resultado = runner.invoke(args=["backup-restore", arquivos[1], "--sim"])
+        self.assertEqual(resultado.exit_code, 0, resultado.output)
+        self.assertIn("2 livros, 2 usuarios", resultado.output)
+
+    def test_painel_e_api_de_estatisticas_so_para_admin(self):
+        self._login("user@local.test", "user123")
+        self.assertEqual(self.client.get("/api/v1/estatisticas").status_code, 403)
+
+        self._login("admin@local.test", "admin123")
+        response = self.client.get("/estatisticas")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b"Autor B", response.data)
+
+        response = self.client.get("/api/v1/estatisticas")
+        self.assertEqual(response.json["livros"], 2)
+        self.assertEqual(response.json["ocupacao"], 0.5)
+        self.assertEqual(len(response.json["movimento"]), estatisticas.DIAS_PAINEL)
+
+    def test_login_acima_do_limite_e_recusado_antes_do_hash(self):
+        with patch.object(limites, "TENTATIVAS_EMAIL", 3), \
+                patch.object(self.app_module, "verificar_hash", wraps=self.app_module.verificar_hash) as verificar:
+            for _ in range(3):
+                response = self._login("user@local.test", "errada")
+                self.assertIn("Email ou senha invalidos.", response.data.decode("utf-8"))
+
+            token = self._csrf_from("/login")
+            response = self.client.post(
+                "/login",
+                data={"email": "USER@local.test", "senha": "user123", "csrf_token": token},
+            )
+            self.assertEqual(response.status_code, 429)
+            self.assertGreater(int(response.headers["Retry-After"]), 0)
+            self.assertEqual(verificar.call_count, 3)
+
+            # O balde do email e compartilhado com a recuperacao de senha.
+            token = self._csrf_from("/recuperar-senha")
+            response = self.client.post(
+                "/recuperar-senha",
+                data={"email": "user@local.test", "senha": "nova", "confirmar_senha": "nova", "csrf_token": token},
+            )
+            self.assertEqual(response.status_code, 429)
+
+    def test_limite_por_ip_recupera_fichas_com_o_tempo(self):
+        with patch.object(limites, "TENTATIVAS_IP", 2), patch.object(limites, "JANELA_IP", 10):
+            limites.verificar_tentativa("10.0.0.1", "a@x.test", agora=1000)
+            limites.verificar_tentativa("10.0.0.1", "b@x.test", agora=1000)
+            with self.assertRaises(limites.LimiteExcedido) as contexto:
+                limites.verificar_tentativa("10.0.0.1", "c@x.test", agora=1001)
+            self.assertEqual(contexto.exception.espera, 9)
+
+            limites.verificar_tentativa("10.0.0.2", "c@x.test", agora=1001)
+            limites.verificar_tentativa("10.0.0.1", "c@x.test", agora=1011)
+
+    def test_limite_por_ip_usa_cliente_atras_do_proxy(self):
+        app = self.app_module.create_app({"TESTING": True, "PROXIES_CONFIAVEIS": 1})
+        cliente = app.test_client()
+
+        def tentar(ip):
+            token = self._csrf_from_cliente(cliente, "/login")
+            return cliente.post(
+                "/login",
+                data={"email": "user@local.test", "senha": "errada", "csrf_token": token},
+                headers={"X-Forwarded-For": ip},
+                environ_base={"REMOTE_ADDR": "10.0.0.1"},
+            )
+
+        with patch.object(limites, "TENTATIVAS_IP", 1), patch.object(limites, "TENTATIVAS_EMAIL", 0):
+            self.assertEqual(tentar("203.0.113.1").status_code, 200)
+            self.assertEqual(tentar("203.0.113.2").status_code, 200)
+            self.assertEqual(tentar("203.0.113.1").status_code, 429)
+
+    def test_limite_e_compartilhado_entre_processos(self):
+        contexto = multiprocessing.get_context("spawn")
+        processo = contexto.Process(target=_tentar_login_em_outro_processo, args=(self._db_path, "10.0.0.9", 20))
+        processo.start()
+        processo.join(60)
+        self.assertEqual(processo.exitcode, 0)
+
+        with self.assertRaises(limites.LimiteExcedido):
+            limites.verificar_tentativa("10.0.0.9", None)
+
+    def test_unidades_tem_bancos_separados_e_busca_em_paralelo(self):
+        unidades = {nome: os.path.join(self._tmpdir.name, f"{nome}.db") for nome in ("norte", "sul")}
+        for caminho in unidades.values():
+            if os.path.exists(caminho):
+                os.remove(caminho)
+
+        with patch.dict(database.UNIDADES, unidades):
+            resultado = self.app.test_cli_runner().invoke(args=["init-db"])
+            self.assertEqual(resultado.exit_code, 0, resultado.output)
+            self.assertIn("[norte] Admin padrao criado", resultado.output)
+
+            for nome, titulo in (("norte", "Python no Norte"), ("sul", "Python no Sul")):
+                with database.usando_unidade(nome):
+                    services.adicionar_livro(Livro(titulo, "Autor N", 2024))
+            self.assertEqual(database.caminho_atual(), self._db_path)
+
+            norte = self.app.test_client()
+            token = self._csrf_from_cliente(norte, "http://norte.localhost/login")
+            norte.post(
+                "/login",
+                base_url="http://norte.localhost",
+                data={"email": "admin@admin.com", "senha": "admin", "csrf_token": token},
+            )
+            response = norte.get("/?busca=python", base_url="http://norte.localhost")
+            html = response.data.decode("utf-8")
+            self.assertIn("Python no Norte", html)
+            self.assertNotIn("Python no Sul", html)
+            self.assertNotIn("Python Limpo", html)
+
+            response = norte.get("/api/v1/unidades/livros?q=python", base_url="http://norte.localhost")
+            self.assertEqual(
+                sorted((item["unidade"], item["titulo"]) for item in response.json["dados"]),
+                [("norte", "Python no Norte"), ("sul", "Python no Sul")],
+            )
+
+            # A exportacao e lida depois do teardown do request e ainda assim
+            # vem do banco da unidade.
+            for formato in ("csv", "jsonl"):
+                response = norte.get(f"/exportar/livros.{formato}", base_url="http://norte.localhost")
+                corpo = response.get_data(as_text=True)
+                self.assertIn("Python no Norte", corpo)
+                self.assertNotIn("Python Limpo", corpo)
+
+            # O mesmo login nao vale no banco principal.
+            self.assertEqual(norte.get("/").status_code, 302)
+
+    def test_emprestimo_concorrente_tem_um_unico_vencedor(self):
+        contexto = multiprocessing.get_context("spawn")
+        processos, threads = 4, 12
+        barreira = contexto.Barrier(processos + threads, timeout=60)
+        resultados = contexto.Queue()
+
+        trabalhadores = [
+            contexto.Process(target=_emprestar_em_paralelo, args=(self._db_path, 2, barreira, resultados))
+            for _ in range(processos)
+        ] + [
+            threading.Thread(target=_emprestar_em_paralelo, args=(self._db_path, 2, barreira, resultados))
+            for _ in range(threads)
+        ]
+        for trabalhador in trabalhadores:
+            trabalhador.start()
+        for trabalhador in trabalhadores:
+            trabalhador.join(60)
+
+        obtidos = sorted(resultados.get(timeout=10) for _ in trabalhadores)
+        self.assertEqual(obtidos.count(services.OK), 1)
+        self.assertEqual(obtidos.count(services.CONFLITO), processos + threads - 1)
+
+        conn = database.conectar()
+        abertos = conn.execute(
+            "SELECT COUNT(*) AS total FROM emprestimos WHERE livro_id = 1 AND devolvido_em IS NULL"
+        ).fetchone()["total"]
+        conn.close()
+        self.assertEqual(abertos, 1)
+
+        self.assertEqual(services.devolver_livro(1), services.OK)
+        self.assertEqual(services.devolver_livro(1), services.CONFLITO)
+        self.assertEqual(services.emprestar_livro(99, 2), services.NAO_ENCONTRADO)
+
+    def test_escrita_repete_enquanto_banco_esta_travado(self):
+        travando = sqlite3.connect(self._db_path, check_same_thread=False)
+        travando.execute("BEGIN IMMEDIATE")
+        threading.Timer(0.2, travando.commit).start()
+
+        conn = sqlite3.connect(self._db_path, timeout=0)
+        try:
+            resultado = database.escrever(
+                conn,
+                lambda cursor: cursor.execute("UPDATE livros SET ano = 2025 WHERE id = 1").rowcount,
+                tentativas=10,
+                espera=0.02,
+            )
+        finally:
+            conn.close()
+            travando.close()
+        self.assertEqual(resultado, 1)
+        self.assertEqual(services.buscar_por_id(1).ano, 2025)
+
+    def test_emprestimo_em_lote_numa_transacao_com_resultado_por_item(self):
+        services.adicionar_livro(Livro("Livro Novo", "Autor C", 2025))
+
+        with patch.object(services, "escrever", wraps=database.escrever) as escrever:
+            resultados = services.emprestar_lote([1, 2, 99, 3, 1], usuario_id=2)
+        self.assertEqual(escrever.call_count, 1)
+        self.assertEqual(
+            resultados,
+            [(1, services.OK), (2, services.CONFLITO), (99, services.NAO_ENCONTRADO),
+             (3, services.OK), (1, services.CONFLITO)],
+        )
+
+        conn = database.conectar()
+        abertos = conn.execute(
+            "SELECT livro_id FROM emprestimos WHERE devolvido_em IS NULL ORDER BY livro_id"
+        ).fetchall()
+        conn.close()
+        self.assertEqual([linha["livro_id"] for linha in abertos], [1, 2, 3])
+
+        resultados = services.devolver_lote([1, 2, 3, 3])
+        self.assertEqual([resultado for _, resultado in resultados], ["ok", "ok", "ok", "conflito"])
+        self.assertTrue(all(livro.disponivel for livro in services.buscar_por_ids([1, 2, 3])))
+
+    def test_circulacao_em_lote_pela_tela_e_pela_api(self):
+        self._login("admin@local.test", "admin123")
+        token = self._csrf_from("/circulacao")
+
+        response = self.client.post(
+            "/circulacao",
+            data={"livros": "1\n2\n99", "usuario_id": 2, "acao": "emprestar", "csrf_token": token},
+        )
+        html = response.data.decode("utf-8")
+        self.assertIn("1 de 3 livros processados", html)
+        self.assertIn("ja emprestado", html)
+        self.assertIn("nao encontrado", html)
+
+        response = self.client.post(
+            "/api/v1/emprestimos/lote",
+            json={"acao": "devolver", "livros": [1, 2]},
+            headers={"X-CSRFToken": token},
+        )
+        self.assertEqual(
+            response.json["resultados"],
+            [{"id": 1, "resultado": "ok"}, {"id": 2, "resultado": "ok"}],
+        )
+        response = self.client.post(
+            "/api/v1/emprestimos/lote",
+            json={"acao": "emprestar", "livros": [1]},
+            headers={"X-CSRFToken": token},
+        )
+        self.assertEqual(response.status_code, 400)
+
+    def _cadastrar_usuarios(self, nomes):
+        conn = database.conectar()
+        conn.executemany(
+            "INSERT INTO usuarios (nome, email, senha, tipo) VALUES (?, ?, 'x', 'usuario')",
+            [(nome, f"{nome.split()[0].lower()}{numero}@exemplo.test") for numero, nome in enumerate(nomes)],
+        )
+        conn.commit()
+        conn.close()
+
+    def test_usuarios_paginados_por_nome_e_id(self):
+        self._cadastrar_usuarios(["bruno Lima", "Ana Silva", "Ana Silva", "Carla Souza", "Davi Rocha"])
+        nomes = []
+        pagina = services.listar_usuarios_pagina(limite=3)
+        while True:
+            nomes += [usuario["nome"] for usuario in pagina["usuarios"]]
+            if not pagina["proximo"]:
+                break
+            pagina = services.listar_usuarios_pagina(apos=pagina["proximo"], limite=3)
+        self.assertEqual(
+            nomes,
+            ["Admin", "Ana Silva", "Ana Silva", "bruno Lima", "Carla Souza", "Davi Rocha", "Usuario"],
+        )
+
+        voltando = services.listar_usuarios_pagina(antes=pagina["anterior"], limite=3)
+        self.assertEqual([usuario["nome"] for usuario in voltando["usuarios"]], ["bruno Lima", "Carla Souza", "Davi Rocha"])
+
+        conn = database.conectar()
+        plano = conn.execute(
+            """
+            EXPLAIN QUERY PLAN SELECT id, nome FROM usuarios
+            WHERE nome COLLATE NOCASE >= ? AND (nome COLLATE NOCASE > ? OR id > ?)
+            ORDER BY nome COLLATE NOCASE, id LIMIT 26
+            """,
+            ("Carla", "Carla", 5),
+        ).fetchall()
+        conn.close()
+        self.assertIn("USING COVERING INDEX idx_usuarios_nome (nome>?)", plano[0]["detail"])
+
+    def test_busca_de_usuarios_por_palavra_ou_email(self):
+        self._cadastrar_usuarios(["Ana Silva", "Joao Silveira", "Carla Souza"])
+        self.assertEqual(
+            [usuario["nome"] for usuario in services.listar_usuarios_pagina("silv")["usuarios"]],
+            ["Ana Silva", "Joao Silveira"],
+        )
+        self.assertEqual(services.contar_usuarios("silv"), 2)
+        self.assertEqual(
+            [usuario["nome"] for usuario in services.listar_usuarios_pagina("carla2@")["usuarios"]],
+            ["Carla Souza"],
+        )
+
+        # Sem FTS5 a busca e por prefixo do nome ou do email.
+        with patch.object(services, "indice_fts", return_value=False):
+            self.assertEqual(
+                [usuario["nome"] for usuario in services.listar_usuarios_pagina("ana")["usuarios"]],
+                ["Ana Silva"],
+            )
+            self.assertEqual(services.contar_usuarios("joao1@"), 1)
+
+    def test_pagina_de_usuarios_reaproveita_contagem(self):
+        self._login("admin@local.test", "admin123")
+        self.assertIn(b"Total: 2", self.client.get("/usuarios").data)
+
+        with patch.object(self.app_module, "contar_usuarios") as contar:
+            response = self.client.get("/usuarios")
+        contar.assert_not_called()
+        self.assertIn(b"Total: 2", response.data)
+
+    def test_sugestoes_de_leitor_para_o_emprestimo(self):
+        self._cadastrar_usuarios(["Ana Silva", "Anabela Costa", "Bruno Lima"])
+        conn = database.conectar()
+        conn.execute("UPDATE usuarios SET tipo = 'admin' WHERE nome = 'Anabela Costa'")
+        conn.commit()
+        conn.close()
+
+        self._login("admin@local.test", "admin123")
+        with patch.object(self.app_module, "listar_usuarios_pagina") as listar:
+            response = self.client.get("/emprestar/1")
+        listar.assert_not_called()
+        self.assertIn(b'data-url="/api/v1/usuarios/sugestoes"', response.data)
+
+        response = self.client.get("/api/v1/usuarios/sugestoes?q=an")
+        self.assertEqual(response.json["dados"], [{"id": 3, "nome": "Ana Silva", "email": "ana0@exemplo.test"}])
+        self.assertIn("max-age", response.headers["Cache-Control"])
+        self.assertEqual(self.client.get("/api/v1/usuarios/sugestoes?q=a").json["dados"], [])
+
+        self._login("user@local.test", "user123")
+        self.assertEqual(self.client.get("/api/v1/usuarios/sugestoes?q=an").status_code, 403)
+
+    def test_boot_do_app_nao_importa_o_benchmark(self):
+        codigo = "import sys, app; print('benchmark' in sys.modules)"
+        ambiente = dict(os.environ, DATABASE_PATH=os.path.join(self._tmpdir.name, "boot.db"))
+        saida = subprocess.run([sys.executable, "-c", codigo], capture_output=True, text=True, env=ambiente,
+                               cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))), check=True)
+        self.assertEqual(saida.stdout.strip(), "False")
+        self.assertEqual(comandos.ESCALAS_BENCHMARK, tuple(sorted(benchmark.ESCALAS)))
+
+    def test_percentil_por_posicao_mais_proxima(self):
+        valores = list(range(1, 101))
+        self.assertEqual(benchmark.percentil(valores, 50), 50)
+        self.assertEqual(benchmark.percentil(valores, 95), 95)
+        self.assertEqual(benchmark.percentil(valores, 99), 99)
+        self.assertEqual(benchmark.percentil(valores, 100), 100)
+        self.assertEqual(benchmark.percentil([10, 20, 30, 40], 50), 20)
+        self.assertEqual(benchmark.percentil([10, 20, 30, 40], 0), 10)
+        self.assertEqual(benchmark.percentil([], 95), 0.0)
+
+    def test_benchmark_gera_dados_e_mede_rotas(self):
+        gerados = benchmark.gerar_dados(livros=40, usuarios=6, emprestados=0.25)
+        self.assertEqual(gerados["emprestados"], 10)
+
+        resultado = benchmark.executar(
+            lambda: benchmark.SessaoCliente(self.app), requisicoes=60, concorrencia=2
+        )
+        self.assertEqual(resultado["requisicoes"], 60)
+        self.assertEqual(resultado["erros"], 0)
+        self.assertLessEqual(set(resultado["rotas"]), set(benchmark.MISTURA))
+        for medidas in resultado["rotas"].values():
+            self.assertLessEqual(medidas["p50_ms"], medidas["p95_ms"])
+            self.assertLessEqual(medidas["p95_ms"], medidas["p99_ms"])
+
+        pior = json.loads(json.dumps(resultado))
+        pior["throughput_rps"] = resultado["throughput_rps"] / 2
+        rota = next(iter(pior["rotas"]))
+        pior["rotas"][rota]["p95_ms"] = resultado["rotas"][rota]["p95_ms"] * 2 + 1
+        self.assertEqual(benchmark.comparar(resultado, resultado), [])
+        self.assertEqual(len(benchmark.comparar(pior, resultado)), 2)
+
+    def test_metricas_desligadas_nao_alteram_respostas(self):
+        self.assertEqual(self.client.get("/metrics").status_code, 404)
+        self.assertNotIn("Server-Timing", self.client.get("/login").headers)
+
+    def test_metricas_por_request_e_endpoint_prometheus(self):
+        metricas.registro.limpar()
+        with patch.object(metricas, "ATIVO", True), patch.object(metricas, "DIRETORIO", self._tmpdir.name):
+            database.fechar_pools()
+            app = self.app_module.create_app({"TESTING": True})
+            self.client = app.test_client()
+            self._login("admin@local.test", "admin123")
+
+            response = self.client.get("/")
+            timing = response.headers["Server-Timing"]
+            consultas = int(re.search(r'desc="(\d+) consultas"', timing).group(1))
+            self.assertGreater(consultas, 0)
+            self.assertRegex(timing, r"render;dur=[1-9]|render;dur=0\.\d*[1-9]")
+
+            # Acumulados de outro worker, gravados no diretorio compartilhado.
+            outro = {"biblioteca.index": dict(metricas.Registro._nova_rota(), requests=3, consultas=7)}
+            outro["biblioteca.index"]["faixas"][0] = 3
+            with open(os.path.join(self._tmpdir.name, "1.json"), "w", encoding="utf-8") as arquivo:
+                json.dump(outro, arquivo)
+
+            local = metricas.registro.exportar()["biblioteca.index"]
+            texto = self.client.get("/metrics").get_data(as_text=True)
+            os.remove(os.path.join(self._tmpdir.name, "1.json"))
+
+        requests = local["requests"] + 3
+        self.assertIn(f'biblioteca_request_duration_seconds_count{{rota="biblioteca.index"}} {requests}', texto)
+        self.assertIn(f'biblioteca_sql_queries_total{{rota="biblioteca.index"}} {local["consultas"] + 7}', texto)
+        self.assertIn('biblioteca_hash_seconds_total{rota="biblioteca.login"}', texto)
+        self.assertNotIn('rota="metricas.metrics"', texto)
+
+    def test_metrics_sem_token_so_para_clientes_locais(self):
+        with patch.object(metricas, "ATIVO", True), patch.object(metricas, "TOKEN", None):
+            self.assertEqual(self.client.get("/metrics").status_code, 200)
+            resposta = self.client.get("/metrics", environ_base={"REMOTE_ADDR": "203.0.113.7"})
+            self.assertEqual(resposta.status_code, 403)
+
+        with patch.object(metricas, "ATIVO", True), patch.object(metricas, "TOKEN", "segredo"):
+            externo = {"REMOTE_ADDR": "203.0.113.7"}
+            self.assertEqual(self.client.get("/metrics", environ_base=externo).status_code, 401)
+            resposta = self.client.get(
+                "/metrics", environ_base=externo, headers={"Authorization": "Bearer segredo"}
+            )
+            self.assertEqual(resposta.status_code, 200)
+
+    def test_modo_estrito_falha_com_varredura_ou_sql_demais(self):
+        self._login("admin@local.test", "admin123")
+
+        with patch.object(services, "indice_fts", return_value=False):
+            with self.assertRaisesRegex(metricas.ConsultaProibida, "Varredura sem indice em livros"):
+                self.client.get("/?busca=python")
+
+        with patch.object(metricas, "MAX_CONSULTAS", 0):
+            with self.assertRaisesRegex(metricas.ConsultaProibida, "instrucoes SQL na rota biblioteca.index"):
+                self.client.get("/")
+
+    def test_log_de_consulta_lenta_com_plano(self):
+        self._login("admin@local.test", "admin123")
+
+        with patch.object(metricas, "LENTA_MS", 0.0), self.assertLogs("biblioteca.consultas") as logs:
+            self.client.get("/api/v1/livros/1")
+
+        mensagem = next(linha for linha in logs.output if "FROM livros WHERE id = ?" in linha)
+        self.assertIn("em api.livro", mensagem)
+        self.assertIn("parametros (int)", mensagem)
+        self.assertIn("SEARCH livros USING INTEGER PRIMARY KEY", mensagem)
+
+        conn = database.conectar()
+        detalhes = metricas.plano(conn, "SELECT id FROM livros WHERE titulo LIKE ?", ("%a%",))
+        conn.close()
+        self.assertEqual(metricas.varreduras(detalhes), ["livros"])
+
 
 if __name__ == "__main__":
     unittest.main()
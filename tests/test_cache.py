@@ -0,0 +1,66 @@
+import unittest
+from unittest.mock import patch
+
+from cache import CacheLRU
+
+
+class CacheLRUTests(unittest.TestCase):
+    def test_descarta_item_menos_usado(self):
+        cache = CacheLRU(tamanho_max=2)
+        cache.guardar("a", 1)
+        cache.guardar("b", 2)
+        cache.obter("a")
+        cache.guardar("c", 3)
+
+        self.assertEqual(cache.obter("a"), 1)
+        self.assertIsNone(cache.obter("b"))
+        self.assertEqual(cache.obter("c"), 3)
+
+    def test_item_expira_apos_ttl(self):
+        cache = CacheLRU(ttl=10)
+        with patch("cache.time.monotonic", return_value=100.0):
+            cache.guardar("a", 1)
+        with patch("cache.time.monotonic", return_value=105.0):
+            self.assertEqual(cache.obter("a"), 1)
+        with patch("cache.time.monotonic", return_value=111.0):
+            self.assertIsNone(cache.obter("a"))
+
+        self.assertEqual(cache.estatisticas()["hits"], 1)
+        self.assertEqual(cache.estatisticas()["misses"], 1)
+
+    def test_nova_versao_limpa_cache(self):
+        cache = CacheLRU()
+        cache.sincronizar_versao(1)
+        cache.guardar("a", 1)
+        cache.sincronizar_versao(1)
+        self.assertEqual(cache.obter("a"), 1)
+
+        cache.sincronizar_versao(2)
+        self.assertIsNone(cache.obter("a"))
+
+    def test_versao_vencida_no_maximo_uma_vez_por_intervalo(self):
+        cache = CacheLRU()
+        with patch("cache.time.monotonic", return_value=100.0):
+            self.assertTrue(cache.versao_vencida(5))
+            self.assertFalse(cache.versao_vencida(5))
+        with patch("cache.time.monotonic", return_value=104.0):
+            self.assertFalse(cache.versao_vencida(5))
+        with patch("cache.time.monotonic", return_value=105.0):
+            self.assertTrue(cache.versao_vencida(5))
+            self.assertFalse(cache.versao_vencida(5))
+
+    def test_limite_de_bytes_descarta_itens_antigos(self):
+        cache = CacheLRU(bytes_max=10)
+        cache.guardar("a", "x" * 6)
+        cache.guardar("b", "y" * 3)
+        cache.guardar("c", "z" * 4)
+        cache.guardar("d", "w" * 11)
+
+        self.assertIsNone(cache.obter("a"))
+        self.assertEqual(cache.obter("b"), "yyy")
+        self.assertIsNone(cache.obter("d"))
+        self.assertEqual(cache.estatisticas()["bytes"], 7)
+
+
+if __name__ == "__main__":
+    unittest.main()
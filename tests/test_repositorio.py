@@ -0,0 +1,285 @@
+import importlib.util
+import os
+import tempfile
+import unittest
+from datetime import date, timedelta
+
+import database
+import services
+from models import CONFLITO, NAO_ENCONTRADO, OK, SEM_ALTERACAO, ULTIMO_ADMIN, EmailDuplicado, Livro, chave_livro
+
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL")
+PSYCOPG_DISPONIVEL = importlib.util.find_spec("psycopg") is not None
+
+
+class ContratoRepositorio:
+    # Os mesmos testes para todos os backends de repositorio.BACKENDS; cada
+    # subclasse prepara um banco vazio e aponta self.repo para o modulo.
+    repo = None
+
+    def _livro(self, titulo, autor="Autor", ano=2000):
+        self.repo.adicionar_livro(Livro(titulo, autor, ano))
+        return self.repo.buscar_por_titulo(titulo, limite=1)[0].id
+
+    def _usuario(self, nome, email, tipo="usuario"):
+        return self.repo.criar_usuario(nome, email, "hash", tipo)
+
+    def test_livros_crud_e_busca_por_prefixo(self):
+        id_livro = self._livro("Dom Casmurro", "Machado de Assis", 1899)
+        self._livro("Memorias Postumas", "Machado de Assis", 1881)
+
+        livro = self.repo.buscar_por_id(id_livro)
+        self.assertEqual((livro.titulo, livro.autor, livro.ano, livro.disponivel), ("Dom Casmurro", "Machado de Assis", 1899, 1))
+        self.assertEqual([l.titulo for l in self.repo.buscar_por_titulo("dom casm")], ["Dom Casmurro"])
+        self.assertEqual(len(self.repo.buscar_por_titulo("machado")), 2)
+        self.assertEqual(self.repo.buscar_por_titulo("!!!"), [])
+
+        self.repo.atualizar_livro(id_livro, "Dom Casmurro", "Machado", 1900)
+        self.assertEqual(self.repo.buscar_por_id(id_livro).ano, 1900)
+
+        self.assertEqual(self.repo.remover_livro(id_livro), OK)
+        self.assertIsNone(self.repo.buscar_por_id(id_livro))
+        self.assertEqual(self.repo.remover_livro(id_livro), NAO_ENCONTRADO)
+
+    def test_buscar_por_ids_preserva_ordem_pedida(self):
+        ids = [self._livro(f"Livro {n}") for n in range(3)]
+
+        livros = self.repo.buscar_por_ids([ids[2], 999999, ids[0], ids[2]])
+
+        self.assertEqual([livro.id for livro in livros], [ids[2], ids[0]])
+        self.assertEqual(self.repo.buscar_por_ids([]), [])
+
+    def test_paginacao_por_cursor_de_livros(self):
+        ids = [self._livro(f"Livro {n}") for n in range(5)]
+
+        primeira = self.repo.listar_livros_pagina(limite=2)
+        segunda = self.repo.listar_livros_pagina(apos=primeira["proximo"], limite=2)
+        volta = self.repo.listar_livros_pagina(antes=segunda["anterior"], limite=2)
+
+        self.assertEqual([l.id for l in primeira["livros"]], ids[:2])
+        self.assertIsNone(primeira["anterior"])
+        self.assertEqual([l.id for l in segunda["livros"]], ids[2:4])
+        self.assertEqual([l.id for l in volta["livros"]], ids[:2])
+
+    def test_emprestimo_e_devolucao_condicionais(self):
+        leitor = self._usuario("Leitor", "leitor@example.com")
+        id_livro = self._livro("Iracema")
+
+        self.assertEqual(self.repo.emprestar_livro(id_livro, leitor), OK)
+        self.assertEqual(self.repo.emprestar_livro(id_livro, leitor), CONFLITO)
+        self.assertEqual(self.repo.emprestar_livro(999999, leitor), NAO_ENCONTRADO)
+        self.assertEqual([l.id for l in self.repo.listar_livros_do_usuario(leitor)], [id_livro])
+        livro = self.repo.buscar_por_id(id_livro)
+        self.assertEqual((livro.id, livro.disponivel, livro.usuario_id), (id_livro, 0, leitor))
+        self.assertIsNotNone(livro.data_devolucao)
+
+        self.assertEqual(self.repo.remover_livro(id_livro), CONFLITO)
+
+        self.assertEqual(self.repo.devolver_livro(id_livro), OK)
+        self.assertEqual(self.repo.devolver_livro(id_livro), CONFLITO)
+        self.assertEqual(self.repo.listar_livros_do_usuario(leitor), [])
+
+    def test_lotes_classificam_cada_livro(self):
+        leitor = self._usuario("Leitor", "leitor@example.com")
+        a, b = self._livro("A"), self._livro("B")
+        self.repo.emprestar_livro(b, leitor)
+
+        self.assertEqual(
+            self.repo.emprestar_lote([a, b, 999999, a], leitor),
+            [(a, OK), (b, CONFLITO), (999999, NAO_ENCONTRADO), (a, CONFLITO)],
+        )
+        self.assertEqual(self.repo.devolver_lote([a, b]), [(a, OK), (b, OK)])
+        self.assertEqual(self.repo.emprestar_lote([], leitor), [])
+
+    def test_atrasados_paginados(self):
+        leitor = self._usuario("Leitor", "leitor@example.com")
+        ids = [self._livro(f"Livro {n}") for n in range(3)]
+        for id_livro in ids:
+            self.repo.emprestar_livro(id_livro, leitor, dias=1)
+
+        depois = date.today() + timedelta(days=5)
+        primeira = self.repo.listar_atrasados(hoje=depois, limite=2)
+        segunda = self.repo.listar_atrasados(hoje=depois, apos=primeira["proximo"], limite=2)
+
+        self.assertEqual([a["livro_id"] for a in primeira["atrasados"]], ids[:2])
+        self.assertEqual([a["livro_id"] for a in segunda["atrasados"]], ids[2:])
+        self.assertEqual(segunda["atrasados"][0]["usuario_nome"], "Leitor")
+        self.assertIsNone(segunda["proximo"])
+        self.assertEqual(self.repo.listar_atrasados()["atrasados"], [])
+
+    def test_usuarios(self):
+        id_usuario = self._usuario("Ana", "ana@example.com")
+
+        with self.assertRaises(EmailDuplicado):
+            self._usuario("Outra Ana", "ana@example.com")
+
+        self.assertEqual(self.repo.total_usuarios(), 1)
+        self.assertEqual(self.repo.buscar_usuario(id_usuario)["email"], "ana@example.com")
+        self.assertEqual(self.repo.buscar_usuario_por_email("ana@example.com")["id"], id_usuario)
+        self.assertIsNone(self.repo.buscar_usuario_por_email("nao@example.com"))
+
+        self.repo.atualizar_senha(id_usuario, "outro-hash")
+        self.assertEqual(self.repo.buscar_usuario(id_usuario)["senha"], "outro-hash")
+
+    def test_alterar_tipo_protege_ultimo_admin(self):
+        admin = self._usuario("Admin", "admin@example.com", "admin")
+        leitor = self._usuario("Leitor", "leitor@example.com")
+
+        self.assertEqual(self.repo.alterar_tipo_usuario(admin, "usuario"), ULTIMO_ADMIN)
+        self.assertEqual(self.repo.alterar_tipo_usuario(admin, "admin"), SEM_ALTERACAO)
+        self.assertEqual(self.repo.alterar_tipo_usuario(999999, "admin"), NAO_ENCONTRADO)
+        self.assertEqual(self.repo.alterar_tipo_usuario(leitor, "admin"), OK)
+        self.assertEqual(self.repo.alterar_tipo_usuario(admin, "usuario"), OK)
+
+    def test_busca_e_paginacao_de_usuarios(self):
+        for nome in ["carla", "Bruno", "Ana", "Daniel"]:
+            self._usuario(nome, f"{nome.lower()}@example.com")
+        self._usuario("Admin", "chefe@example.com", "admin")
+
+        primeira = self.repo.listar_usuarios_pagina(limite=2)
+        segunda = self.repo.listar_usuarios_pagina(apos=primeira["proximo"], limite=2)
+        volta = self.repo.listar_usuarios_pagina(antes=segunda["anterior"], limite=2)
+
+        self.assertEqual([u["nome"] for u in primeira["usuarios"]], ["Admin", "Ana"])
+        self.assertEqual([u["nome"] for u in segunda["usuarios"]], ["Bruno", "carla"])
+        self.assertEqual([u["nome"] for u in volta["usuarios"]], ["Admin", "Ana"])
+
+        self.assertEqual(self.repo.contar_usuarios(), 5)
+        self.assertEqual(self.repo.contar_usuarios("dan"), 1)
+        self.assertEqual([u["nome"] for u in self.repo.listar_usuarios_pagina("carla@")["usuarios"]], ["carla"])
+        self.assertEqual([u["nome"] for u in self.repo.sugerir_usuarios("ch")], [])
+        self.assertEqual([u["nome"] for u in self.repo.sugerir_usuarios("b")], ["Bruno"])
+
+    def test_inserir_livros_novos_ignora_duplicados(self):
+        self._livro("Existente", "Autor", 2000)
+        lote = [
+            ("Existente", "Autor", 2000, chave_livro("Existente", "Autor", 2000)),
+            ("Novo", "Autor", 2001, chave_livro("Novo", "Autor", 2001)),
+            ("Novo", "Autor", 2001, chave_livro("Novo", "Autor", 2001)),
+        ]
+
+        self.assertEqual(self.repo.inserir_livros_novos(lote), 1)
+        self.assertEqual(len(self.repo.buscar_por_titulo("novo")), 1)
+
+    def test_ler_em_lotes(self):
+        ids = [self._livro(f"Livro {n}") for n in range(5)]
+
+        lotes = self.repo.ler_em_lotes("SELECT id, titulo FROM livros ORDER BY id", 2)
+
+        self.assertEqual(list(next(lotes)), ["id", "titulo"])
+        linhas = [tuple(linha) for lote in lotes for linha in lote]
+        self.assertEqual([linha[0] for linha in linhas], ids)
+
+    def test_busca_ignora_acentos(self):
+        id_livro = self._livro("Ação e Reação", "Zé Ninguém")
+        self._usuario("João Araújo", "joao@example.com")
+
+        self.assertEqual([l.id for l in self.repo.buscar_por_titulo("acao reac")], [id_livro])
+        self.assertEqual([l.id for l in self.repo.buscar_por_titulo("ninguem")], [id_livro])
+        self.assertEqual([l.id for l in self.repo.buscar_por_titulo("reação")], [id_livro])
+        self.assertEqual(self.repo.contar_usuarios("araujo"), 1)
+
+    def test_buscar_nas_unidades_sem_unidades(self):
+        id_livro = self._livro("Triste Fim")
+
+        encontrados = self.repo.buscar_nas_unidades("triste")
+
+        self.assertEqual([(unidade, livro.id) for unidade, livro in encontrados], [(None, id_livro)])
+
+    def test_painel_acompanha_escritas(self):
+        leitor = self._usuario("Leitor", "leitor@example.com")
+        self._usuario("Admin", "admin@example.com", "admin")
+        a = self._livro("A", "Autor A")
+        b, c = self._livro("B", "Autor B"), self._livro("C", "Autor B")
+        self.repo.emprestar_livro(a, leitor)
+        self.repo.emprestar_livro(b, leitor)
+        self.repo.emprestar_livro(c, leitor)
+        self.repo.devolver_livro(b)
+
+        painel = self.repo.ler_painel()
+        self.assertEqual(
+            (painel["livros"], painel["emprestados"], painel["disponiveis"], painel["atrasados"]),
+            (3, 2, 1, 0),
+        )
+        self.assertEqual((painel["leitores"], painel["leitores_ativos"], painel["emprestimos_total"]), (1, 1, 3))
+        self.assertEqual(
+            painel["autores"],
+            [{"autor": "Autor B", "livros": 2, "emprestimos": 2}, {"autor": "Autor A", "livros": 1, "emprestimos": 1}],
+        )
+        self.assertEqual(
+            painel["movimento"][-1],
+            {"dia": date.today().isoformat(), "emprestimos": 3, "devolucoes": 1},
+        )
+        depois = date.today() + timedelta(days=self.repo.PRAZO_EMPRESTIMO_DIAS + 1)
+        self.assertEqual(self.repo.ler_painel(hoje=depois)["atrasados"], 2)
+
+        # O historico de B vai com ele para o novo autor e sai com a remocao.
+        self.repo.atualizar_livro(b, "B", "Autor A", 2000)
+        self.assertEqual(
+            self.repo.ler_painel()["autores"],
+            [{"autor": "Autor A", "livros": 2, "emprestimos": 2}, {"autor": "Autor B", "livros": 1, "emprestimos": 1}],
+        )
+        self.assertEqual(self.repo.remover_livro(b), OK)
+        self.repo.devolver_livro(a)
+
+        painel = self.repo.ler_painel()
+        self.assertEqual((painel["livros"], painel["emprestados"], painel["leitores_ativos"]), (2, 1, 1))
+        self.assertEqual(self.repo.reconstruir_estatisticas(verificar=True), [])
+        self.assertEqual(self.repo.reconstruir_estatisticas(), [])
+
+    def test_versoes_avancam_com_escritas(self):
+        catalogo = self.repo.ler_versao("catalogo")
+        usuarios = self.repo.ler_versao("usuarios")
+
+        self._livro("Versionado")
+        leitor = self._usuario("Leitor", "leitor@example.com")
+        self.assertGreater(self.repo.ler_versao("catalogo"), catalogo)
+
+        self.repo.alterar_tipo_usuario(leitor, "admin")
+        self.assertGreater(self.repo.ler_versao("usuarios"), usuarios)
+
+
+class RepositorioSQLiteTests(ContratoRepositorio, unittest.TestCase):
+    repo = services
+
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self._caminho_original = database.DATABASE
+        database.fechar_pools()
+        database.DATABASE = os.path.join(self._tmpdir.name, "repositorio.db")
+        services.criar_tabelas()
+
+    def tearDown(self):
+        database.fechar_pools()
+        database.DATABASE = self._caminho_original
+        self._tmpdir.cleanup()
+
+
+@unittest.skipUnless(
+    PSYCOPG_DISPONIVEL and TEST_DATABASE_URL,
+    "defina TEST_DATABASE_URL (e instale requirements-postgres.txt) para testar o PostgreSQL",
+)
+class RepositorioPostgresTests(ContratoRepositorio, unittest.TestCase):
+    # Apaga o schema public do banco em TEST_DATABASE_URL a cada teste; use
+    # um banco so para isso.
+    @classmethod
+    def setUpClass(cls):
+        import services_postgres
+
+        cls.repo = services_postgres
+        services_postgres.fechar_pool()
+        services_postgres.DATABASE_URL = TEST_DATABASE_URL
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.repo.fechar_pool()
+
+    def setUp(self):
+        with self.repo.obter_pool().connection() as conn:
+            conn.execute("DROP SCHEMA public CASCADE")
+            conn.execute("CREATE SCHEMA public")
+        self.repo.criar_tabelas()
+
+
+if __name__ == "__main__":
+    unittest.main()